@@ -0,0 +1,153 @@
+"""
+Prompt-size benchmark: codegen and fix prompts with the whole Manim code guide vs retrieved sections
+
+Builds the real codegen and fix requests for a few representative inputs in both
+MANIM_GUIDE_MODE settings and reports their prompt tokens (litellm's tokenizer for the model),
+estimated input cost, and the time spent building the index and selecting sections. With
+--live, each request is also sent to the model to measure time to first token and total
+latency; that needs DEEPINFRA_API_KEY and costs a few cents per run.
+
+Usage:
+    python benchmarks/prompt_guide.py [--budget 3000] [--live] [--runs 3]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+MODES = ("full", "retrieval")
+
+FAILED_CODE = """from manim import *
+
+class Solution(Scene):
+    def construct(self):
+        axes = Axes(x_range=[-3, 3], y_range=[-1, 9])
+        graph = axes.plot(lambda x: x**2, color=BLUE)
+        label = MathTex(r"y = x^2").next_to(graph, UP)
+        self.play(ShowCreation(axes), ShowCreation(graph))
+        self.play(Write(label))
+"""
+
+# (kind, name, input): codegen inputs are visual element specifications, fix inputs are render errors
+SAMPLES: List[Tuple[str, str, str]] = [
+    ("codegen", "parabola", """
+Scene 1 (0-8s): Axes from -3 to 3 with labels x and y. Plot y = x^2 in BLUE, then write the
+MathTex label "y = x^2" next to the curve. Scene 2 (8-16s): Move a Dot along the parabola with a
+ValueTracker, showing its coordinates with DecimalNumber. Scene 3 (16-24s): Shade the area under
+the curve from 0 to 2 and show the integral with a Brace below it. Fade everything out at the end.
+"""),
+    ("codegen", "triangle", """
+Scene 1 (0-10s): Draw a right triangle with vertices A, B, C using Polygon; label the sides a, b
+and c with Tex. Scene 2 (10-20s): Build squares on each side, colored RED, GREEN and BLUE, and
+Transform copies of the two small squares into the large one. Scene 3 (20-30s): Write
+a^2 + b^2 = c^2 with MathTex, Indicate each term, and Circumscribe the result.
+"""),
+    ("codegen", "sorting", """
+Scene 1 (0-6s): A row of 6 Rectangle bars with heights 3, 1, 4, 1, 5, 2 arranged with
+arrange(RIGHT, buff=0.2), numbers on top. Scene 2 (6-30s): Bubble sort: highlight compared bars
+in YELLOW, swap them with an animated move, mark sorted bars GREEN. Keep a Text step counter in
+the corner updated with each swap.
+"""),
+    ("fix", "undefined-name", """
+Traceback (most recent call last):
+  File "/tmp/scene.py", line 9, in construct
+    self.play(ShowCreation(axes), ShowCreation(graph))
+NameError: name 'ShowCreation' is not defined
+"""),
+    ("fix", "latex", """
+LaTeX compilation error: LaTeX Error: Undefined control sequence.
+  File "/usr/local/lib/python3.11/site-packages/manim/mobject/text/tex_mobject.py", line 293, in __init__
+    super().__init__(tex_string, **kwargs)
+ValueError: latex error converting to dvi. See log output above or the log file: media/Tex/8f2c.log
+"""),
+    ("fix", "updater", """
+Traceback (most recent call last):
+  File "/tmp/scene.py", line 21, in construct
+    dot.add_updater(lambda d: d.move_to(axes.c2p(t.get_value(), f(t.get_value()))))
+AttributeError: 'float' object has no attribute 'get_value'
+"""),
+]
+
+
+def build(kind: str, text: str, mode: str) -> Dict[str, Any]:
+    """Build the real request of a sample with the guide included in the given mode"""
+    from src.generation.fixed_code import fix_request
+    from src.generation.manim_code import codegen_request
+    if kind == "codegen":
+        return codegen_request(text.strip(), guide_mode=mode)
+    return fix_request(FAILED_CODE, text.strip(), guide_mode=mode)
+
+
+def prompt_tokens(request: Dict[str, Any]) -> int:
+    import litellm
+    return litellm.token_counter(model=request["model"], messages=request["messages"])
+
+
+def timed(func: Callable[[], Any]) -> Tuple[float, Any]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def measure_live(request: Dict[str, Any], runs: int) -> Tuple[float, float]:
+    """Send a request `runs` times; return the median time to first token and total latency"""
+    from src.generation.completion import complete
+    first_tokens, totals = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        first = []
+        complete(dict(request, max_tokens=512), on_token=lambda _: first or first.append(time.perf_counter()))
+        totals.append(time.perf_counter() - start)
+        first_tokens.append((first[0] if first else time.perf_counter()) - start)
+    return statistics.median(first_tokens), statistics.median(totals)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--budget", type=int, default=int(os.getenv("MANIM_GUIDE_TOKEN_BUDGET", "3000")),
+                        help="Token budget of retrieved guide sections")
+    parser.add_argument("--live", action="store_true", help="Also call the model to measure latency")
+    parser.add_argument("--runs", type=int, default=3, help="Live calls per sample and mode")
+    args = parser.parse_args()
+    # Settings are read when src is first imported
+    os.environ["MANIM_GUIDE_TOKEN_BUDGET"] = str(args.budget)
+    from src.generation.guide import guide_index
+    from src.usage import call_cost
+
+    build_seconds, index = timed(guide_index)
+    print(f"Guide index: {len(index.sections)} sections, built in {build_seconds * 1000:.1f} ms\n")
+
+    header = f"{'sample':<22}{'full tok':>10}{'retr tok':>10}{'saved':>8}{'select ms':>11}{'full $':>10}{'retr $':>10}"
+    if args.live:
+        header += f"{'full ttft':>11}{'retr ttft':>11}{'full s':>9}{'retr s':>9}"
+    print(header)
+    totals = {mode: 0 for mode in MODES}
+    for kind, name, text in SAMPLES:
+        tokens, costs, latencies = {}, {}, {}
+        for mode in MODES:
+            seconds, request = timed(lambda: build(kind, text, mode))
+            if mode == "retrieval":
+                select_ms = seconds * 1000
+            tokens[mode] = prompt_tokens(request)
+            costs[mode] = call_cost(request["model"], tokens[mode], 0) or 0.0
+            totals[mode] += tokens[mode]
+            if args.live:
+                latencies[mode] = measure_live(request, args.runs)
+        row = (f"{kind + ':' + name:<22}{tokens['full']:>10}{tokens['retrieval']:>10}"
+               f"{1 - tokens['retrieval'] / tokens['full']:>8.0%}{select_ms:>11.2f}"
+               f"{costs['full']:>10.5f}{costs['retrieval']:>10.5f}")
+        if args.live:
+            row += (f"{latencies['full'][0]:>11.2f}{latencies['retrieval'][0]:>11.2f}"
+                    f"{latencies['full'][1]:>9.1f}{latencies['retrieval'][1]:>9.1f}")
+        print(row)
+    print(f"\nTotal prompt tokens: full {totals['full']}, retrieval {totals['retrieval']} "
+          f"({1 - totals['retrieval'] / totals['full']:.0%} fewer)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Startup-time benchmark: how long importing the server takes, and which modules it goes to
+
+Each run imports the target in a fresh interpreter with `python -X importtime`, so nothing is
+warm except the OS page cache. Reports the median wall time over the runs, the cost of every
+src module (cumulative, i.e. including what it imports) and the third-party packages that
+dominate the import, grouped by top-level package.
+
+Usage:
+    python benchmarks/startup.py [--module src.app] [--runs 5] [--top 15]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """
+    Parse `-X importtime` output
+
+    Returns:
+        list: (module, self_us, cumulative_us, depth) for every imported module, in import order
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def run_once(module: str) -> Tuple[float, List[Tuple[str, int, int, int]]]:
+    """Import `module` in a new interpreter and return its wall time and import timings"""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return elapsed, parse_importtime(result.stderr)
+
+
+def summarize(rows: List[Tuple[str, int, int, int]]) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Split timings into per-module cumulative cost of src modules and self cost per top-level package"""
+    src_modules = {name: cumulative for name, _, cumulative, _ in rows if name == "src" or name.startswith("src.")}
+    packages = defaultdict(int)
+    for name, self_us, _, _ in rows:
+        if not name.startswith("src"):
+            packages[name.split(".")[0]] += self_us
+    return src_modules, dict(packages)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--module", default="src.app", help="Module to import (src.app or src.asgi)")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to time")
+    parser.add_argument("--top", type=int, default=15, help="Rows to show per table")
+    args = parser.parse_args()
+
+    # The first run also warms the page cache and bytecode caches; it is not counted
+    run_once(args.module)
+    runs = [run_once(args.module) for _ in range(args.runs)]
+    wall_times = [elapsed for elapsed, _ in runs]
+    # Per-module figures come from the run with the median wall time
+    _, rows = sorted(runs, key=lambda run: run[0])[len(runs) // 2]
+    src_modules, packages = summarize(rows)
+    import_total = sum(self_us for _, self_us, _, _ in rows)
+
+    print(f"import {args.module}: median {statistics.median(wall_times) * 1000:.0f} ms wall, "
+          f"min {min(wall_times) * 1000:.0f} ms, max {max(wall_times) * 1000:.0f} ms over {args.runs} runs")
+    print(f"  of which imports: {import_total / 1000:.0f} ms across {len(rows)} modules\n")
+
+    print("src modules (cumulative ms, including their imports):")
+    for name, cumulative in sorted(src_modules.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f}  {name}")
+
+    print("\nPackages (self ms, summed over their modules):")
+    for name, self_us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {self_us / 1000:8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
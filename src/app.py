@@ -1,47 +1,134 @@
 """
 Main application file for the image-to-manim service
 """
+import contextvars
 import os
 import uuid
-import requests
+import json
 import logging
+import queue
+import threading
 import time
-from io import BytesIO
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
-from PIL import Image
-from typing import Dict, List, Union, Optional
+from typing import Dict, List, Union, Optional, Tuple
 
 # Import from our modules
-from src.config import supabase
-from src.generation.manim_code import generate_manim_code
-from src.generation.problem_analysis import generate_problem_analysis
-from src.generation.review import review_video
-from src.generation.script import generate_script
-from src.generation.visuals import generate_visual_elements
-from src.render.render import queue_manim_rendering
-from src.storage import update_code_in_storage
+from src.batch import batch_manager, iter_archive_images
+from src.cache import artifact_cache
+from src.concurrency import Overloaded, admission_stats, check_admission
+from src.config import BATCH_MAX_BYTES, MAX_UPLOAD_BYTES
+from src.ingest import ImageRejected, IngestedImage, ingest_image
+from src.events import event_bus, publish
+from src.generation.completion import gateway_stats
+from src.generation.rule_fixes import fix_log
+from src.jobs import job_manager
+from src.journal import load_history, status_journal
+from src.llm_cache import llm_cache
+from src.metrics import render_latest
+from src.render.preflight import preflight_stats
+from src.tracing import span
+from src.usage import load_usage, usage_session
+from src.storage import LocalStorage, storage_backend
+from src.request_utils import JOB_STAGES, configure_logging, flag_enabled, parse_video_request
+from src.pipeline import (
+    Persistence,
+    analyze_problem,
+    create_project,
+    run_full_pipeline,
+    run_script_generation,
+    run_video_generation,
+    run_video_improvement,
+    run_visuals_generation,
+    split_worksheet,
+    stage_flights,
+    store_image,
+)
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log')
-    ]
-)
+configure_logging()
 logger = logging.getLogger('image-to-manim')
 
 app = Flask(__name__)
 CORS(app)
 
+# Reject oversized request bodies before they are parsed; allow some room for multipart framing.
+# Batch uploads get the larger BATCH_MAX_BYTES limit, every other endpoint is held to one image.
+SINGLE_UPLOAD_LIMIT = MAX_UPLOAD_BYTES + 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = max(BATCH_MAX_BYTES, SINGLE_UPLOAD_LIMIT)
+
+def upload_limit() -> int:
+    """Return the request body limit of the current endpoint"""
+    return app.config['MAX_CONTENT_LENGTH'] if request.endpoint == 'submit_batch' else SINGLE_UPLOAD_LIMIT
+
+@app.before_request
+def start_request_span():
+    """Trace the request, continuing the caller's trace when it sends a traceparent header"""
+    name = f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+    g.request_span = span(name, traceparent=request.headers.get('traceparent'), http_path=request.path).__enter__()
+
+@app.after_request
+def add_trace_header(response: Response) -> Response:
+    """Return the trace ID so a slow request can be looked up in the trace store"""
+    request_span = g.get('request_span')
+    if request_span is not None:
+        request_span.set_attribute("http_status", response.status_code)
+        response.headers['X-Trace-Id'] = request_span.trace_id
+    return response
+
+@app.teardown_request
+def end_request_span(error: Optional[BaseException]) -> None:
+    request_span = g.pop('request_span', None)
+    if request_span is not None:
+        request_span.__exit__(type(error) if error else None, error, None)
+
+@app.before_request
+def enforce_upload_limit():
+    """Reject bodies over the endpoint's limit based on Content-Length, before reading them"""
+    if request.content_length is not None and request.content_length > upload_limit():
+        return request_too_large(None)
+
+@app.errorhandler(413)
+def request_too_large(error) -> Dict[str, str]:
+    """Return a JSON error when a request body exceeds the upload limit"""
+    logger.error("Request body exceeds the maximum upload size")
+    return jsonify({"error": f"Upload exceeds maximum allowed size ({upload_limit() / 1024 / 1024:.0f}MB)"}), 413
+
+@app.errorhandler(Overloaded)
+def overloaded(error: Overloaded) -> Dict[str, Union[str, int]]:
+    """Refuse work for a saturated stage or job queue with a Retry-After hint"""
+    logger.warning(f"Request refused by admission control: {str(error)}")
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status_code
+
+def read_uploaded_image(image_file) -> IngestedImage:
+    """Read an uploaded file without buffering more than the size limit, then ingest it"""
+    return ingest_image(image_file.read(MAX_UPLOAD_BYTES + 1))
+
 @app.route('/health', methods=['GET'])
 def health_check() -> Dict[str, str]:
     """Simple health check endpoint"""
     logger.info("Health check endpoint accessed")
     return jsonify({"status": "ok", "message": "Server is running"})
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats() -> Dict[str, Dict[str, Union[int, float]]]:
+    """Endpoint reporting hit/miss counters of the session artifact cache, stage coalescing and the LLM response cache"""
+    return jsonify({
+        "artifact_cache": artifact_cache.stats(),
+        "single_flight": stage_flights.stats(),
+        "llm_cache": llm_cache.stats(),
+    })
+
+@app.route('/admission/stats', methods=['GET'])
+def admission_stats_endpoint() -> Dict[str, Dict[str, Union[int, float]]]:
+    """Endpoint reporting per-stage limits, in-flight calls, queue depth and wait times, and the job queue"""
+    return jsonify({
+        "stages": admission_stats(),
+        "jobs": job_manager.stats(),
+    })
+
 @app.route('/process-image', methods=['POST'])
 def process_image() -> Dict[str, Union[str, Dict]]:
     """Endpoint to process an image of a math problem and return a detailed description and solution"""
@@ -53,62 +140,35 @@ def process_image() -> Dict[str, Union[str, Dict]]:
         logger.error("No image provided in request")
         return jsonify({"error": "No image provided"}), 400
     
+    # Refuse up front rather than queue behind a saturated analysis stage
+    check_admission("analysis")
+    
     try:
         # Get image from request
         image_file = request.files['image']
         logger.info(f"Image received: {image_file.filename} ({image_file.content_type})")
-        img = Image.open(image_file)
         
         # Create a unique session ID for this request
         session_id = str(uuid.uuid4())
         logger.info(f"Generated session ID: {session_id}")
         
+        # Validate the upload and prepare the downscaled variant for the vision model
+        image = read_uploaded_image(image_file)
+        
         # Upload the original image to Supabase
         logger.info("Uploading image to Supabase storage")
-        # Detect original format or use JPEG as fallback
-        img_format = image_file.content_type.split('/')[-1] if image_file.content_type else 'jpeg'
-        if img_format.lower() not in ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']:
-            img_format = 'jpeg'  # Default to JPEG for unsupported formats
-        
-        # Use original extension for the file path
-        file_ext = img_format.lower()
-        if file_ext == 'jpeg':
-            file_ext = 'jpg'
-        
-        buffered = BytesIO()
-        img.save(buffered, format=img_format.upper())
-        img_bytes = buffered.getvalue()
-        
-        # Upload to Supabase storage with correct extension
-        image_path = f"{session_id}/original.{file_ext}"
-        logger.info(f"Storing image at path: {image_path}")
-        supabase.storage.from_("manim-generator").upload(
-            image_path,
-            img_bytes,
-            {    "cacheControl": '3600',    "upsert": "true"  }
-        )
-        
-        # Get public URL
-        image_url = supabase.storage.from_("manim-generator").get_public_url(image_path)
-        logger.info(f"Image accessible at URL: {image_url}")
+        persistence = Persistence()
+        image_url = store_image(session_id, image, persistence)
         
         # Analyze the math problem from the image
         logger.info("Starting math problem analysis")
-        problem_analysis = generate_problem_analysis(image=img)
+        publish(session_id, "stage", stage="analyzing_problem")
+        with usage_session(session_id):
+            problem_analysis = analyze_problem(image, bypass_cache=flag_enabled(request.form.get('no_cache')))
         logger.info("Math problem analysis completed")
         
         # Store the project metadata in Supabase database
-        project_data = {
-            "id": session_id,
-            "problem_analysis": problem_analysis,
-            "status": "image_processed",
-            "image_url": image_url,
-            "created_at": "now()"
-        }
-        
-        # Insert into database
-        logger.info(f"Inserting project data into database with ID: {session_id}")
-        supabase.table("manim_projects").insert(project_data).execute()
+        create_project(session_id, problem_analysis, image_url, persistence)
         
         response = {
             "session_id": session_id,
@@ -122,289 +182,138 @@ def process_image() -> Dict[str, Union[str, Dict]]:
         logger.info(f"Image processing completed in {process_time}s")
         return jsonify(response)
     
+    except ImageRejected as e:
+        logger.error(f"Image rejected: {str(e)}")
+        return jsonify({"error": str(e)}), e.status_code
+    
+    except Overloaded:
+        raise
+    
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         logger.error(f"Error in process_image: {str(e)}\n{error_trace}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/generate-script', methods=['POST'])
-def generate_script_endpoint() -> Dict[str, str]:
-    """Endpoint to generate a script based on a problem analysis"""
-    start_time = time.time()
-    logger.info("Starting script generation")
-    data = request.json
+def stream_stage(stage_func, **kwargs) -> Response:
+    """
+    Run a text generation stage in the background and stream its output as Server-Sent Events.
+
+    The stream carries "token" events with text chunks, then one "result" event holding the same
+    payload the blocking endpoint returns, or an "error" event. The artifact is persisted even if
+    the client disconnects before the stream ends.
+    """
+    events = queue.Queue()
     
-    if not data or 'session_id' not in data:
-        logger.error("No session_id provided in request")
-        return jsonify({"error": "No session_id provided"}), 400
+    def worker():
+        try:
+            result, status_code = stage_func(on_token=lambda text: events.put(("token", {"text": text})), **kwargs)
+            events.put(("result" if status_code < 400 else "error", dict(result, http_status=status_code)))
+        except Overloaded as e:
+            logger.warning(f"Streamed {stage_func.__name__} refused by admission control: {str(e)}")
+            events.put(("error", {"error": str(e), "http_status": e.status_code, "retry_after": e.retry_after}))
+        except Exception as e:
+            import traceback
+            logger.error(f"Error in streamed {stage_func.__name__}: {str(e)}\n{traceback.format_exc()}")
+            publish(kwargs.get("session_id"), "error", stage=stage_func.__name__, error=str(e))
+            events.put(("error", {"error": str(e), "http_status": 500}))
+        finally:
+            events.put(None)
     
-    try:
-        session_id = data['session_id']
-        logger.info(f"Processing script generation for session: {session_id}")
-        
-        # Get the project data from Supabase
-        logger.info(f"Fetching project data for session: {session_id}")
-        response = supabase.table("manim_projects").select("*").eq("id", session_id).execute()
-        if not response.data:
-            logger.error(f"No project found with session_id: {session_id}")
-            return jsonify({"error": f"No project found with session_id: {session_id}"}), 404
-        
-        project_data = response.data[0]
-        
-        # Check if the project has been processed
-        if not project_data.get('problem_analysis'):
-            logger.error(f"Problem analysis not found for session: {session_id}")
-            return jsonify({"error": "Problem analysis has not been generated yet"}), 400
-        
-        # Generate script
-        logger.info("Generating script from problem analysis")
-        script = generate_script(problem_analysis=project_data['problem_analysis'])
-        logger.info("Script generation completed")
-        
-        # Store script in Supabase
-        script_path = f"{session_id}/script.txt"
-        logger.info(f"Storing script at path: {script_path}")
-        supabase.storage.from_("manim-generator").upload(
-            script_path,
-            script.encode('utf-8'),
-            {    "cacheControl": '3600',    "upsert": "true"  }
-        )
-        script_url = supabase.storage.from_("manim-generator").get_public_url(script_path)
-        logger.info(f"Script accessible at URL: {script_url}")
-        
-        # Update the project status
-        logger.info(f"Updating project status to 'script_generated' for session: {session_id}")
-        supabase.table("manim_projects").update({
-            "status": "script_generated",
-            "script_url": script_url
-        }).eq("id", session_id).execute()
-        
-        response = {
-            "session_id": session_id,
-            "script_url": script_url,
-            "script_text": script,
-            "status": "script_generated",
-            "message": "Script generated successfully. Use the session_id to generate a video."
-        }
-        
-        process_time = round(time.time() - start_time, 2)
-        logger.info(f"Script generation completed in {process_time}s")
-        return jsonify(response)
+    threading.Thread(
+        target=contextvars.copy_context().run, args=(worker,), name=f"stream-{stage_func.__name__}", daemon=True
+    ).start()
     
-    except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        logger.error(f"Error in generate_script: {str(e)}\n{error_trace}")
-        return jsonify({"error": str(e)}), 500
+    def generate():
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            event, data = item
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
-@app.route('/generate-visuals', methods=['POST'])
-def generate_visuals_endpoint() -> Dict[str, str]:
-    """Endpoint to generate visual element descriptions from a script"""
+def run_text_stage(stage_name: str, stage_func, admission_stage: str) -> Dict[str, str]:
+    """Shared request handling for the script and visuals endpoints, streamed or blocking"""
     start_time = time.time()
-    logger.info("Starting visual elements generation")
     data = request.json
     
     if not data or 'session_id' not in data:
         logger.error("No session_id provided in request")
         return jsonify({"error": "No session_id provided"}), 400
     
+    session_id = data['session_id']
+    bypass_cache = flag_enabled(data.get('no_cache'))
+    logger.info(f"Processing {stage_name} for session: {session_id}")
+    check_admission(admission_stage)
+    
+    if flag_enabled(data.get('stream')):
+        return stream_stage(stage_func, session_id=session_id, bypass_cache=bypass_cache)
+    
     try:
-        session_id = data['session_id']
-        logger.info(f"Processing visual elements generation for session: {session_id}")
-        
-        # Get the project data from Supabase
-        logger.info(f"Fetching project data for session: {session_id}")
-        response = supabase.table("manim_projects").select("*").eq("id", session_id).execute()
-        if not response.data:
-            logger.error(f"No project found with session_id: {session_id}")
-            return jsonify({"error": f"No project found with session_id: {session_id}"}), 404
-        
-        project_data = response.data[0]
-        
-        # Check if we have a script
-        if not project_data.get('script_url'):
-            logger.error(f"Script URL not found for session: {session_id}")
-            return jsonify({"error": "Script has not been generated yet"}), 400
-            
-        # Get the script from the stored URL
-        script_url = project_data.get('script_url')
-        logger.info(f"Retrieving script from URL: {script_url}")
-        
-        try:
-            # Download the script content from the URL
-            response = requests.get(script_url)
-            if response.status_code == 200:
-                script = response.text
-                logger.info("Successfully retrieved script content")
-            else:
-                logger.error(f"Failed to retrieve script. Status code: {response.status_code}")
-                return jsonify({"error": f"Failed to retrieve script. Status code: {response.status_code}"}), 500
-        except Exception as e:
-            logger.error(f"Exception while retrieving script: {str(e)}")
-            return jsonify({"error": f"Failed to retrieve script: {str(e)}"}), 500
-        
-        # Generate visual elements
-        logger.info("Generating visual elements from script")
-        visual_elements = generate_visual_elements(script=script)
-        logger.info("Visual elements generation completed")
-        
-        # Store visual elements in Supabase
-        visuals_path = f"{session_id}/visuals.txt"
-        logger.info(f"Storing visual elements at path: {visuals_path}")
-        supabase.storage.from_("manim-generator").upload(
-            visuals_path,
-            visual_elements.encode('utf-8'),
-            {    "cacheControl": '3600',    "upsert": "true"  }
-        )
-        visuals_url = supabase.storage.from_("manim-generator").get_public_url(visuals_path)
-        logger.info(f"Visual elements accessible at URL: {visuals_url}")
-        
-        # Update the project status
-        logger.info(f"Updating project status to 'visuals_generated' for session: {session_id}")
-        supabase.table("manim_projects").update({
-            "status": "visuals_generated",
-            "visuals_url": visuals_url
-        }).eq("id", session_id).execute()
-        
-        response = {
-            "session_id": session_id,
-            "visuals_url": visuals_url,
-            "visuals_text": visual_elements,
-            "status": "visuals_generated",
-            "message": "Visual elements generated successfully. Use the session_id to generate a video."
-        }
+        response, status_code = stage_func(session_id=session_id, bypass_cache=bypass_cache)
         
         process_time = round(time.time() - start_time, 2)
-        logger.info(f"Visual elements generation completed in {process_time}s")
-        return jsonify(response)
+        logger.info(f"{stage_name.capitalize()} completed in {process_time}s")
+        return jsonify(response), status_code
+    
+    except Overloaded:
+        raise
     
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
-        logger.error(f"Error in generate_visuals: {str(e)}\n{error_trace}")
+        logger.error(f"Error in {stage_func.__name__}: {str(e)}\n{error_trace}")
+        publish(session_id, "error", stage=stage_func.__name__, error=str(e))
         return jsonify({"error": str(e)}), 500
 
+@app.route('/generate-script', methods=['POST'])
+def generate_script_endpoint() -> Dict[str, str]:
+    """Endpoint to generate a script based on a problem analysis; set "stream": true to receive tokens as SSE"""
+    logger.info("Starting script generation")
+    return run_text_stage("script generation", run_script_generation, "script")
+
+@app.route('/generate-visuals', methods=['POST'])
+def generate_visuals_endpoint() -> Dict[str, str]:
+    """Endpoint to generate visual element descriptions from a script; set "stream": true to receive tokens as SSE"""
+    logger.info("Starting visual elements generation")
+    return run_text_stage("visual elements generation", run_visuals_generation, "visuals")
+
 @app.route('/generate-video', methods=['POST'])
 def generate_video() -> Dict[str, Union[str, Dict]]:
     """Endpoint to generate a video from visual elements"""
     start_time = time.time()
     logger.info("Starting video generation")
-    data = request.json
+    session_id, video_quality = parse_video_request(request.json)
+    bypass_cache = flag_enabled((request.json or {}).get('no_cache'))
     
-    if not data or 'session_id' not in data:
+    if not session_id:
         logger.error("No session_id provided in request")
         return jsonify({"error": "No session_id provided"}), 400
     
-    # Optional video quality parameter with default value
-    video_quality = data.get('video_quality', 'medium')
-    if video_quality not in ['low', 'medium', 'high']:
-        logger.warning(f"Invalid video quality '{video_quality}' requested, defaulting to 'medium'")
-        video_quality = 'medium'  # Default to medium if invalid quality is provided
-    
+    check_admission("codegen")
     try:
-        session_id = data['session_id']
-        
-        # Get the project data from Supabase
-        logger.info(f"Fetching project data for session: {session_id}")
-        response = supabase.table("manim_projects").select("*").eq("id", session_id).execute()
-        if not response.data:
-            logger.error(f"No project found with session_id: {session_id}")
-            return jsonify({"error": f"No project found with session_id: {session_id}"}), 404
-        
-        project_data = response.data[0]
-        
-        # Check if we have visuals
-        if not project_data.get('visuals_url'):
-            logger.error(f"Visuals URL not found for session: {session_id}")
-            return jsonify({"error": "Visuals has not been generated yet"}), 400
-    
-        # Get the visual elements from the stored URL
-        visuals_url = project_data.get('visuals_url')
-        logger.info(f"Retrieving visual elements from URL: {visuals_url}")
-        
-        try:
-            # Download the visual elements content from the URL
-            response = requests.get(visuals_url)
-            if response.status_code == 200:
-                visual_elements = response.text
-                logger.info("Successfully retrieved visual elements content")
-            else:
-                logger.error(f"Failed to retrieve visual elements. Status code: {response.status_code}")
-                return jsonify({"error": f"Failed to retrieve visual elements. Status code: {response.status_code}"}), 500
-        except Exception as e:
-            logger.error(f"Exception while retrieving visual elements: {str(e)}")
-            return jsonify({"error": f"Failed to retrieve visual elements: {str(e)}"}), 500
-
-        # Generate Manim code
-        logger.info("Generating Manim code from visual elements")
-        manim_code = generate_manim_code(visual_elements=visual_elements, session_id=session_id)
-        logger.info("Manim code generation completed")
-        
-        # Store Manim code in Supabase
-        code_path = f"{session_id}/scene.py"
-        logger.info(f"Storing Manim code at path: {code_path}")
-        update_code_in_storage(code_path, manim_code)
-        code_url = supabase.storage.from_("manim-generator").get_public_url(code_path)
-        logger.info(f"Manim code accessible at URL: {code_url}")
-        
-        # Update the project data
-        logger.info(f"Updating project with code URL for session: {session_id}")
-        supabase.table("manim_projects").update({
-            "code_url": code_url
-        }).eq("id", session_id).execute()
-        
-        # Queue the Manim rendering job on Modal
-        logger.info(f"Queuing Manim rendering job with quality: {video_quality}")
-        
-        # Add video quality to the rendering parameters
-        render_result = queue_manim_rendering(
-            session_id=session_id,
-            manim_code=manim_code,
-            code_path=f"{session_id}/scene.py",
-            quality=video_quality
+        response, status_code = run_video_generation(
+            session_id=session_id, video_quality=video_quality, bypass_cache=bypass_cache
         )
         
-        video_url = render_result.get("video_url")
-        error_message = render_result.get("error")
-        
-        if video_url:
-            logger.info(f"Rendering completed successfully, video URL: {video_url}")
-            # Update the project status
-            logger.info(f"Updating project status to 'video_generated' for session: {session_id}")
-            supabase.table("manim_projects").update({
-                "status": "video_generated",
-                "video_url": video_url
-            }).eq("id", session_id).execute()
-            
-            response = {
-                "session_id": session_id,
-                "visuals_url": visuals_url,
-                "code_url": code_url,
-                "video_url": video_url,
-                "status": "video_generated",
-                "message": "Video generated successfully."
-            }
-        else:
-            # Rendering failed
-            logger.error(f"Video rendering failed: {error_message}")
-            response = {
-                "session_id": session_id,
-                "visuals_url": visuals_url,
-                "code_url": code_url,
-                "status": "code_generated",
-                "message": "Code generation complete, but video rendering failed.",
-                "error": error_message
-            }
-        
         process_time = round(time.time() - start_time, 2)
         logger.info(f"Video generation process completed in {process_time}s")
-        return jsonify(response)
+        return jsonify(response), status_code
+    
+    except Overloaded:
+        raise
     
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         logger.error(f"Error in generate_video: {str(e)}\n{error_trace}")
+        publish(session_id, "error", stage="generate_video", error=str(e))
         return jsonify({"error": str(e)}), 500
 
 @app.route('/improve-video', methods=['POST'])
@@ -412,152 +321,311 @@ def improve_video() -> Dict[str, Union[str, int, Dict]]:
     """Endpoint to review and improve a generated video"""
     start_time = time.time()
     logger.info("Starting video improvement process")
-    data = request.json
+    session_id, video_quality = parse_video_request(request.json)
+    bypass_cache = flag_enabled((request.json or {}).get('no_cache'))
     
-    if not data or 'session_id' not in data:
+    if not session_id:
         logger.error("No session_id provided in request")
         return jsonify({"error": "No session_id provided"}), 400
     
-    # Optional video quality parameter with default value
-    video_quality = data.get('video_quality', 'medium')
-    if video_quality not in ['low', 'medium', 'high']:
-        logger.warning(f"Invalid video quality '{video_quality}' requested, defaulting to 'medium'")
-        video_quality = 'medium'  # Default to medium if invalid quality is provided
-    
+    check_admission("review")
     try:
-        session_id = data['session_id']
-        
-        # Get the project data from Supabase
-        logger.info(f"Fetching project data for session: {session_id}")
-        response = supabase.table("manim_projects").select("*").eq("id", session_id).execute()
-        if not response.data:
-            logger.error(f"No project found with session_id: {session_id}")
-            return jsonify({"error": f"No project found with session_id: {session_id}"}), 404
-        
-        project_data = response.data[0]
-        
-        # Check if we have a video to improve
-        if not project_data.get('video_url'):
-            logger.error(f"Video URL not found for session: {session_id}")
-            return jsonify({"error": "Video has not been generated yet"}), 400
-        
-        video_url = project_data.get('video_url')
-        code_url = project_data.get('code_url')
-        visuals_url = project_data.get('visuals_url')
-        
-        # Review the video
-        logger.info(f"Reviewing video quality at URL: {video_url}")
-        review_result = review_video(video_url=video_url)
-        
-        score = review_result["score"]
-        review_text = review_result["review"]
-        needs_improvement = review_result["needs_improvement"]
-        logger.info(f"Video review completed. Score: {score}/100. Needs improvement: {needs_improvement}")
-        
-        # Update the database with review results
-        logger.info(f"Updating project status to 'review_complete' for session: {session_id}")
-        supabase.table("manim_projects").update({
-            "status": "review_complete",
-        }).eq("id", session_id).execute()
-        
-        # If the video needs improvement
-        if needs_improvement:
-            logger.info(f"Video quality score is low ({score}/100). Regenerating based on feedback")
-    
-            logger.info(f"Retrieving visual elements from URL: {visuals_url}")
-            
-            try:
-                # Download the visual elements content from the URL
-                response = requests.get(visuals_url)
-                if response.status_code == 200:
-                    visual_elements = response.text
-                    logger.info("Successfully retrieved visual elements content")
-                else:
-                    logger.error(f"Failed to retrieve visual elements. Status code: {response.status_code}")
-                    return jsonify({"error": f"Failed to retrieve visual elements. Status code: {response.status_code}"}), 500
-            except Exception as e:
-                logger.error(f"Exception while retrieving visual elements: {str(e)}")
-                return jsonify({"error": f"Failed to retrieve visual elements: {str(e)}"}), 500
-            
-            # Attempt to improve the video based on feedback
-            logger.info("Attempting to improve video based on feedback")
-            improved_code = generate_manim_code(
-                visual_elements=visual_elements,
-                improvements=review_text,
-                session_id=session_id,
-            )
-            
-            # Store the improved code
-            logger.info(f"Storing improved manim code")
-            update_code_in_storage(f"{session_id}/scene.py", improved_code)
-            
-            logger.info(f"Queuing improved Manim rendering job with quality: {video_quality}")
-            # Call the function to queue the rendering job with quality parameter
-            render_result = queue_manim_rendering(
-                session_id=session_id,
-                manim_code=improved_code,
-                code_path=f"{session_id}/scene.py",
-                quality=video_quality
-            )
-            
-            improved_video_url = render_result.get("video_url")
-            
-            if improved_video_url:
-                # Update the database with the improved video
-                logger.info(f"Rendering of improved video completed successfully, URL: {improved_video_url}")
-                logger.info(f"Updating project status to 'improved_render_complete' for session: {session_id}")
-                supabase.table("manim_projects").update({
-                    "status": "improved_render_complete",
-                    "video_url": improved_video_url,
-                }).eq("id", session_id).execute()
-                
-                response = {
-                    "session_id": session_id,
-                    "improved_video_url": improved_video_url,
-                    "code_url": code_url,
-                    "visuals_url": visuals_url,
-                    "status": "improved_render_complete",
-                    "review_score": score,
-                    "review_text": review_text,
-                    "message": f"Video has been improved based on feedback. Original score: {score}/100."
-                }
-            else:
-                # Improvement rendering failed
-                error = render_result.get("error", "Unknown error during rendering")
-                logger.error(f"Improved video rendering failed: {error}")
-                response = {
-                    "session_id": session_id,
-                    "code_url": code_url,
-                    "visuals_url": visuals_url,
-                    "status": "review_complete",
-                    "review_score": score,
-                    "review_text": review_text,
-                    "message": f"Video was reviewed (score: {score}/100), but improvement rendering failed: {error}"
-                }
-        else:
-            # No improvement needed
-            logger.info(f"Video doesn't need improvement (score: {score}/100)")
-            response = {
-                "session_id": session_id,
-                "improved_video_url": video_url,
-                "code_url": code_url,
-                "visuals_url": visuals_url,
-                "status": "review_complete",
-                "review_score": score,
-                "review_text": review_text,
-                "message": f"Video was reviewed. Score: {score}/100. No improvement needed."
-            }
+        response, status_code = run_video_improvement(
+            session_id=session_id, video_quality=video_quality, bypass_cache=bypass_cache
+        )
         
         process_time = round(time.time() - start_time, 2)
         logger.info(f"Video improvement process completed in {process_time}s")
-        return jsonify(response)
+        return jsonify(response), status_code
+    
+    except Overloaded:
+        raise
     
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         logger.error(f"Error in improve_video: {str(e)}\n{error_trace}")
+        publish(session_id, "error", stage="improve_video", error=str(e))
         return jsonify({"error": str(e)}), 500
 
+@app.route('/jobs/<job_type>', methods=['POST'])
+def submit_job(job_type: str) -> Dict[str, str]:
+    """Endpoint to queue a video generation or improvement job and return its id immediately"""
+    if job_type not in JOB_STAGES:
+        logger.error(f"Unknown job type requested: {job_type}")
+        return jsonify({"error": f"Unknown job type: {job_type}. Expected one of: {', '.join(JOB_STAGES)}"}), 404
+    
+    session_id, video_quality = parse_video_request(request.json)
+    if not session_id:
+        logger.error("No session_id provided in request")
+        return jsonify({"error": "No session_id provided"}), 400
+    
+    job_id = job_manager.submit(
+        job_type,
+        JOB_STAGES[job_type],
+        session_id=session_id,
+        video_quality=video_quality,
+        bypass_cache=flag_enabled((request.json or {}).get('no_cache')),
+    )
+    
+    return jsonify({
+        "job_id": job_id,
+        "session_id": session_id,
+        "type": job_type,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "message": "Job queued. Poll the status_url for stage, progress and result."
+    }), 202
+
+@app.route('/pipeline', methods=['POST'])
+def pipeline_endpoint() -> Dict[str, Union[str, Dict]]:
+    """Endpoint to run every stage from image analysis to rendered video in a single call"""
+    logger.info("Starting end-to-end pipeline")
+    
+    # Check if image is provided
+    if 'image' not in request.files:
+        logger.error("No image provided in request")
+        return jsonify({"error": "No image provided"}), 400
+    
+    image_file = request.files['image']
+    logger.info(f"Image received: {image_file.filename} ({image_file.content_type})")
+    try:
+        image = read_uploaded_image(image_file)
+    except ImageRejected as e:
+        logger.error(f"Image rejected: {str(e)}")
+        return jsonify({"error": str(e)}), e.status_code
+    
+    _, video_quality = parse_video_request({"session_id": None, **request.form.to_dict()})
+    review = flag_enabled(request.form.get('review'))
+    wait = flag_enabled(request.args.get('wait'))
+    
+    # Create a unique session ID up front so clients can subscribe to its events immediately
+    session_id = str(uuid.uuid4())
+    logger.info(f"Generated session ID: {session_id}")
+    stage_kwargs = {
+        "session_id": session_id,
+        "image": image,
+        "video_quality": video_quality,
+        "review": review,
+        "bypass_cache": flag_enabled(request.form.get('no_cache')),
+    }
+    
+    if wait:
+        check_admission("analysis")
+        start_time = time.time()
+        try:
+            response, status_code = run_full_pipeline(**stage_kwargs)
+            process_time = round(time.time() - start_time, 2)
+            logger.info(f"Pipeline completed in {process_time}s")
+            return jsonify(response), status_code
+        except Overloaded:
+            raise
+        except Exception as e:
+            import traceback
+            error_trace = traceback.format_exc()
+            logger.error(f"Error in pipeline: {str(e)}\n{error_trace}")
+            publish(session_id, "error", stage="pipeline", error=str(e))
+            return jsonify({"session_id": session_id, "error": str(e)}), 500
+    
+    job_id = job_manager.submit("pipeline", run_full_pipeline, **stage_kwargs)
+    return jsonify({
+        "job_id": job_id,
+        "session_id": session_id,
+        "type": "pipeline",
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "events_url": f"/sessions/{session_id}/events",
+        "message": "Pipeline queued. Follow the events_url or poll the status_url for the result."
+    }), 202
+
+@app.route('/batch', methods=['POST'])
+def submit_batch() -> Dict[str, Union[str, Dict]]:
+    """Endpoint to run the full pipeline for many images, uploaded as files and/or a zip archive"""
+    logger.info("Starting batch ingestion")
+    
+    image_files = request.files.getlist('images')
+    archive_file = request.files.get('archive')
+    if not image_files and not archive_file:
+        logger.error("No images or archive provided in request")
+        return jsonify({"error": "No images provided. Send 'images' files and/or an 'archive' zip."}), 400
+    
+    _, video_quality = parse_video_request({"session_id": None, **request.form.to_dict()})
+    
+    try:
+        images = []
+        for image_file in image_files:
+            image_data = image_file.read(MAX_UPLOAD_BYTES + 1)
+            error = None
+            if len(image_data) > MAX_UPLOAD_BYTES:
+                image_data, error = None, f"Image exceeds maximum allowed size ({MAX_UPLOAD_BYTES / 1024 / 1024:.0f}MB)"
+            images.append((image_file.filename, image_data, error))
+        if archive_file:
+            logger.info(f"Archive received: {archive_file.filename}")
+            images.extend(iter_archive_images(archive_file.read()))
+        
+        batch = batch_manager.submit(
+            images,
+            video_quality=video_quality,
+            review=flag_enabled(request.form.get('review')),
+            bypass_cache=flag_enabled(request.form.get('no_cache')),
+        )
+    except ImageRejected as e:
+        logger.error(f"Batch rejected: {str(e)}")
+        return jsonify({"error": str(e)}), e.status_code
+    
+    return jsonify({
+        **batch,
+        "status_url": f"/batch/{batch['batch_id']}",
+        "message": "Batch queued. Poll the status_url for aggregate progress and per-image results."
+    }), 202
+
+@app.route('/process-worksheet', methods=['POST'])
+def process_worksheet() -> Dict[str, Union[str, Dict]]:
+    """Endpoint to split a worksheet image into its problems and run one pipeline per problem in parallel"""
+    start_time = time.time()
+    logger.info("Starting worksheet processing")
+    
+    # Check if image is provided
+    if 'image' not in request.files:
+        logger.error("No image provided in request")
+        return jsonify({"error": "No image provided"}), 400
+    
+    image_file = request.files['image']
+    logger.info(f"Image received: {image_file.filename} ({image_file.content_type})")
+    _, video_quality = parse_video_request({"session_id": None, **request.form.to_dict()})
+    bypass_cache = flag_enabled(request.form.get('no_cache'))
+    
+    # The worksheet gets its own session; every problem becomes a child session linked to it
+    session_id = str(uuid.uuid4())
+    logger.info(f"Generated worksheet session ID: {session_id}")
+    check_admission("regions")
+    
+    try:
+        image = read_uploaded_image(image_file)
+        image_url, regions, crops = split_worksheet(session_id, image, bypass_cache=bypass_cache)
+        batch = batch_manager.submit(
+            [(f"problem-{region['label']}", crop, None) for region, crop in zip(regions, crops)],
+            video_quality=video_quality,
+            review=flag_enabled(request.form.get('review')),
+            bypass_cache=bypass_cache,
+            parent_id=session_id,
+        )
+    except ImageRejected as e:
+        logger.error(f"Image rejected: {str(e)}")
+        return jsonify({"error": str(e)}), e.status_code
+    except Overloaded:
+        raise
+    
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        logger.error(f"Error in process_worksheet: {str(e)}\n{error_trace}")
+        publish(session_id, "error", stage="process_worksheet", error=str(e))
+        return jsonify({"session_id": session_id, "error": str(e)}), 500
+    
+    process_time = round(time.time() - start_time, 2)
+    logger.info(f"Worksheet split into {len(regions)} problems in {process_time}s")
+    return jsonify({
+        **batch,
+        "session_id": session_id,
+        "image_url": image_url,
+        "regions": regions,
+        "status_url": f"/batch/{session_id}",
+        "message": "Worksheet split. Each problem runs as its own session; poll the status_url for their videos."
+    }), 202
+
+@app.route('/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id: str) -> Dict[str, Union[str, float, Dict]]:
+    """Endpoint to report aggregate progress and per-image status of a batch"""
+    batch = batch_manager.get(batch_id)
+    if not batch:
+        return jsonify({"error": f"No batch found with batch_id: {batch_id}"}), 404
+    return jsonify(batch)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str) -> Dict[str, Union[str, float, Dict]]:
+    """Endpoint to report the stage, progress and result of a background job"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": f"No job found with job_id: {job_id}"}), 404
+    return jsonify(job)
+
+@app.route('/files/<path:path>', methods=['GET'])
+def serve_file(path: str) -> Response:
+    """Serve an artifact kept in local storage (STORAGE_BACKEND=local)"""
+    if not isinstance(storage_backend, LocalStorage):
+        return jsonify({"error": "Artifacts are not stored locally"}), 404
+    return send_from_directory(storage_backend.root, path, max_age=3600)
+
+@app.route('/journal/stats', methods=['GET'])
+def journal_stats() -> Dict[str, Union[int, float]]:
+    """Endpoint reporting how many project row writes were recorded, coalesced and flushed"""
+    return jsonify(status_journal.stats())
+
+@app.route('/llm/stats', methods=['GET'])
+def llm_stats() -> Dict[str, Dict]:
+    """Endpoint reporting the model of each stage and the circuit state and rate limit of each LLM provider"""
+    return jsonify(gateway_stats())
+
+@app.route('/preflight/stats', methods=['GET'])
+def preflight_stats_endpoint() -> Dict[str, Union[int, float]]:
+    """Endpoint reporting how many generated programs were checked before rendering and the renders saved"""
+    return jsonify(preflight_stats.stats())
+
+@app.route('/fixes/stats', methods=['GET'])
+def fix_stats() -> Dict[str, Union[int, float]]:
+    """Endpoint reporting how failed code was fixed (rules or LLM) and the failures no rule handles yet"""
+    return jsonify(fix_log.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics() -> Response:
+    """Endpoint exposing stage latencies, token counts, render outcomes and storage traffic to Prometheus"""
+    body, content_type = render_latest()
+    return Response(body, content_type=content_type)
+
+@app.route('/sessions/<session_id>/history', methods=['GET'])
+def session_history(session_id: str) -> Dict[str, Union[str, List]]:
+    """Endpoint listing a session's status transitions with the time spent in each status"""
+    try:
+        transitions = load_history(session_id)
+    except Exception as e:
+        logger.error(f"Failed to load status history for session {session_id}: {str(e)}")
+        return jsonify({"error": f"Failed to load status history: {str(e)}"}), 500
+    if not transitions:
+        return jsonify({"error": f"No status history found for session_id: {session_id}"}), 404
+    return jsonify({"session_id": session_id, "transitions": transitions})
+
+@app.route('/sessions/<session_id>/usage', methods=['GET'])
+def session_usage(session_id: str) -> Dict[str, Union[str, Dict]]:
+    """Endpoint reporting a session's LLM tokens, latency and cost per stage"""
+    try:
+        usage = load_usage(session_id)
+    except Exception as e:
+        logger.error(f"Failed to load LLM usage for session {session_id}: {str(e)}")
+        return jsonify({"error": f"Failed to load LLM usage: {str(e)}"}), 500
+    if usage is None:
+        return jsonify({"error": f"No project found with session_id: {session_id}"}), 404
+    return jsonify({"session_id": session_id, "usage": usage})
+
+@app.route('/sessions/<session_id>/events', methods=['GET'])
+def session_events(session_id: str) -> Response:
+    """Server-Sent Events stream of stage transitions, render attempts and artifact URLs for a session"""
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id is not None else None
+    except ValueError:
+        last_event_id = None
+    
+    logger.info(f"Client subscribed to events for session: {session_id}")
+    return Response(
+        stream_with_context(event_bus.stream(session_id, last_event_id=last_event_id)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # Disable proxy buffering so events arrive immediately
+        }
+    )
+
 if __name__ == '__main__':
     # Run the Flask app
     port = int(os.environ.get("PORT", 5000))
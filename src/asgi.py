@@ -0,0 +1,664 @@
+"""
+ASGI entry point for the image-to-manim service.
+
+Serves the same routes and response shapes as the Flask app in src/app.py, with endpoint logic on
+an asyncio event loop: analysis, script, visuals and worksheet detection use async LLM, HTTP and
+Supabase clients, so a single process holds many in-flight sessions without a thread per request.
+Code generation and rendering keep running on the background job workers; endpoints that wait for
+them await the job instead of blocking a thread.
+
+Run with: uvicorn src.asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Set
+
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from src import async_pipeline
+from src.batch import batch_manager, iter_archive_images
+from src.cache import artifact_cache
+from src.clients import close_async_clients
+from src.concurrency import Overloaded, admission_stats, check_admission
+from src.config import BATCH_MAX_BYTES, MAX_UPLOAD_BYTES
+from src.events import event_bus, publish
+from src.generation.completion import gateway_stats
+from src.generation.rule_fixes import fix_log
+from src.ingest import ImageRejected, IngestedImage, ingest_image
+from src.jobs import job_manager
+from src.journal import load_history, status_journal
+from src.llm_cache import llm_cache
+from src.metrics import render_latest
+from src.render.preflight import preflight_stats
+from src.tracing import span
+from src.usage import load_usage, usage_session
+from src.pipeline import run_full_pipeline, stage_flights
+from src.storage import LocalStorage, storage_backend
+from src.request_utils import JOB_STAGES, configure_logging, flag_enabled, parse_video_request
+
+# Configure logging
+configure_logging()
+logger = logging.getLogger('image-to-manim')
+
+# Request body limits, matching the Flask app: one image per request, except for batch uploads
+SINGLE_UPLOAD_LIMIT = MAX_UPLOAD_BYTES + 1024 * 1024
+BATCH_UPLOAD_LIMIT = max(BATCH_MAX_BYTES, SINGLE_UPLOAD_LIMIT)
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Streamed stages run as tasks that outlive a disconnected client; keep references until they finish
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def too_large(limit: int) -> JSONResponse:
+    """Return the 413 response used when a request body exceeds the upload limit"""
+    logger.error("Request body exceeds the maximum upload size")
+    return JSONResponse({"error": f"Upload exceeds maximum allowed size ({limit / 1024 / 1024:.0f}MB)"}, 413)
+
+
+def body_too_large(request: Request, limit: int) -> bool:
+    """Check the declared Content-Length against the endpoint's limit before reading the body"""
+    content_length = request.headers.get('content-length')
+    return content_length is not None and content_length.isdigit() and int(content_length) > limit
+
+
+async def read_json(request: Request) -> Optional[Dict[str, Any]]:
+    """Parse a JSON body, treating a missing or malformed body like Flask does for the checks that follow"""
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+async def read_upload(upload: UploadFile) -> bytes:
+    """Read an uploaded file without buffering more than the size limit"""
+    return await upload.read(MAX_UPLOAD_BYTES + 1)
+
+
+async def ingest_upload(upload: UploadFile) -> IngestedImage:
+    """Read and ingest an uploaded image; decoding runs off the event loop"""
+    return await asyncio.to_thread(ingest_image, await read_upload(upload))
+
+
+async def wait_for_job(job_id: str) -> JSONResponse:
+    """Await a background job and answer with its result the way the blocking endpoint would"""
+    await asyncio.wrap_future(job_manager.future(job_id))
+    job = job_manager.get(job_id)
+    if job["retry_after"] is not None:
+        raise Overloaded(job["error"], job["retry_after"], job["http_status"])
+    if job["result"] is not None:
+        return JSONResponse(job["result"], job["http_status"])
+    return JSONResponse({"session_id": job["session_id"], "error": job["error"]}, job["http_status"] or 500)
+
+
+async def overloaded(request: Request, error: Overloaded) -> JSONResponse:
+    """Refuse work for a saturated stage or job queue with a Retry-After hint"""
+    logger.warning(f"Request refused by admission control: {str(error)}")
+    return JSONResponse(
+        {"error": str(error), "retry_after": error.retry_after},
+        error.status_code,
+        headers={'Retry-After': str(error.retry_after)},
+    )
+
+
+async def health_check(request: Request) -> JSONResponse:
+    """Simple health check endpoint"""
+    logger.info("Health check endpoint accessed")
+    return JSONResponse({"status": "ok", "message": "Server is running"})
+
+
+async def cache_stats(request: Request) -> JSONResponse:
+    """Endpoint reporting hit/miss counters of the session artifact cache, stage coalescing and the LLM response cache"""
+    threaded, looped = stage_flights.stats(), async_pipeline.async_stage_flights.stats()
+    return JSONResponse({
+        "artifact_cache": artifact_cache.stats(),
+        "single_flight": {key: threaded[key] + looped[key] for key in threaded},
+        "llm_cache": await asyncio.to_thread(llm_cache.stats),
+    })
+
+
+async def admission_stats_endpoint(request: Request) -> JSONResponse:
+    """Endpoint reporting per-stage limits, in-flight calls, queue depth and wait times, and the job queue"""
+    return JSONResponse({
+        "stages": admission_stats(),
+        "jobs": job_manager.stats(),
+    })
+
+
+async def process_image(request: Request) -> JSONResponse:
+    """Endpoint to process an image of a math problem and return a detailed description and solution"""
+    start_time = time.time()
+    logger.info("Starting image processing")
+    if body_too_large(request, SINGLE_UPLOAD_LIMIT):
+        return too_large(SINGLE_UPLOAD_LIMIT)
+
+    form = await request.form()
+    image_file = form.get('image')
+    if not isinstance(image_file, UploadFile):
+        logger.error("No image provided in request")
+        return JSONResponse({"error": "No image provided"}, 400)
+
+    # Refuse up front rather than queue behind a saturated analysis stage
+    check_admission("analysis")
+
+    try:
+        logger.info(f"Image received: {image_file.filename} ({image_file.content_type})")
+        session_id = str(uuid.uuid4())
+        logger.info(f"Generated session ID: {session_id}")
+        image = await ingest_upload(image_file)
+
+        # Upload the original while the model analyzes the image
+        logger.info("Uploading image to Supabase storage and starting math problem analysis")
+        publish(session_id, "stage", stage="analyzing_problem")
+        with usage_session(session_id):
+            image_url, problem_analysis = await asyncio.gather(
+                async_pipeline.store_image(session_id, image),
+                async_pipeline.analyze_problem(image, bypass_cache=flag_enabled(form.get('no_cache'))),
+            )
+        logger.info("Math problem analysis completed")
+
+        await async_pipeline.create_project(session_id, problem_analysis, image_url)
+
+        response = {
+            "session_id": session_id,
+            "problem_analysis": problem_analysis,
+            "image_url": image_url,
+            "status": "image_processed",
+            "message": "Image processed successfully. Use the session_id to generate a script."
+        }
+
+        process_time = round(time.time() - start_time, 2)
+        logger.info(f"Image processing completed in {process_time}s")
+        return JSONResponse(response)
+
+    except ImageRejected as e:
+        logger.error(f"Image rejected: {str(e)}")
+        return JSONResponse({"error": str(e)}, e.status_code)
+
+    except Overloaded:
+        raise
+
+    except Exception as e:
+        logger.exception(f"Error in process_image: {str(e)}")
+        return JSONResponse({"error": str(e)}, 500)
+
+
+def stream_stage(stage_func: Callable, **kwargs) -> StreamingResponse:
+    """
+    Run a text generation stage as a task and stream its output as Server-Sent Events.
+
+    Same wire format as the Flask app: "token" events, then one "result" or "error" event.
+    The task keeps running, and persists the artifact, if the client disconnects.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def run() -> None:
+        try:
+            result, status_code = await stage_func(on_token=lambda text: events.put_nowait(("token", {"text": text})), **kwargs)
+            events.put_nowait(("result" if status_code < 400 else "error", dict(result, http_status=status_code)))
+        except Overloaded as e:
+            logger.warning(f"Streamed {stage_func.__name__} refused by admission control: {str(e)}")
+            events.put_nowait(("error", {"error": str(e), "http_status": e.status_code, "retry_after": e.retry_after}))
+        except Exception as e:
+            logger.exception(f"Error in streamed {stage_func.__name__}: {str(e)}")
+            publish(kwargs.get("session_id"), "error", stage=stage_func.__name__, error=str(e))
+            events.put_nowait(("error", {"error": str(e), "http_status": 500}))
+        finally:
+            events.put_nowait(None)
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+    async def generate() -> AsyncIterator[str]:
+        while True:
+            item = await events.get()
+            if item is None:
+                return
+            event, data = item
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def run_text_stage(request: Request, stage_name: str, stage_func: Callable, admission_stage: str) -> Response:
+    """Shared request handling for the script and visuals endpoints, streamed or blocking"""
+    start_time = time.time()
+    data = await read_json(request)
+
+    if not data or 'session_id' not in data:
+        logger.error("No session_id provided in request")
+        return JSONResponse({"error": "No session_id provided"}, 400)
+
+    session_id = data['session_id']
+    bypass_cache = flag_enabled(data.get('no_cache'))
+    logger.info(f"Processing {stage_name} for session: {session_id}")
+    check_admission(admission_stage)
+
+    if flag_enabled(data.get('stream')):
+        return stream_stage(stage_func, session_id=session_id, bypass_cache=bypass_cache)
+
+    try:
+        response, status_code = await stage_func(session_id=session_id, bypass_cache=bypass_cache)
+
+        process_time = round(time.time() - start_time, 2)
+        logger.info(f"{stage_name.capitalize()} completed in {process_time}s")
+        return JSONResponse(response, status_code)
+
+    except Overloaded:
+        raise
+
+    except Exception as e:
+        logger.exception(f"Error in {stage_func.__name__}: {str(e)}")
+        publish(session_id, "error", stage=stage_func.__name__, error=str(e))
+        return JSONResponse({"error": str(e)}, 500)
+
+
+async def generate_script_endpoint(request: Request) -> Response:
+    """Endpoint to generate a script based on a problem analysis; set "stream": true to receive tokens as SSE"""
+    logger.info("Starting script generation")
+    return await run_text_stage(request, "script generation", async_pipeline.run_script_generation, "script")
+
+
+async def generate_visuals_endpoint(request: Request) -> Response:
+    """Endpoint to generate visual element descriptions from a script; set "stream": true to receive tokens as SSE"""
+    logger.info("Starting visual elements generation")
+    return await run_text_stage(request, "visual elements generation", async_pipeline.run_visuals_generation, "visuals")
+
+
+async def run_video_stage(request: Request, job_type: str, admission_stage: str) -> JSONResponse:
+    """Run video generation or improvement on the job workers and answer once it finishes"""
+    start_time = time.time()
+    data = await read_json(request)
+    session_id, video_quality = parse_video_request(data)
+    if not session_id:
+        logger.error("No session_id provided in request")
+        return JSONResponse({"error": "No session_id provided"}, 400)
+
+    check_admission(admission_stage)
+    job_id = job_manager.submit(
+        job_type, JOB_STAGES[job_type], session_id=session_id, video_quality=video_quality,
+        bypass_cache=flag_enabled(data.get('no_cache')),
+    )
+    response = await wait_for_job(job_id)
+
+    process_time = round(time.time() - start_time, 2)
+    logger.info(f"{job_type} process completed in {process_time}s")
+    return response
+
+
+async def generate_video(request: Request) -> JSONResponse:
+    """Endpoint to generate a video from visual elements"""
+    logger.info("Starting video generation")
+    return await run_video_stage(request, "generate-video", "codegen")
+
+
+async def improve_video(request: Request) -> JSONResponse:
+    """Endpoint to review and improve a generated video"""
+    logger.info("Starting video improvement process")
+    return await run_video_stage(request, "improve-video", "review")
+
+
+async def submit_job(request: Request) -> JSONResponse:
+    """Endpoint to queue a video generation or improvement job and return its id immediately"""
+    job_type = request.path_params['job_type']
+    if job_type not in JOB_STAGES:
+        logger.error(f"Unknown job type requested: {job_type}")
+        return JSONResponse({"error": f"Unknown job type: {job_type}. Expected one of: {', '.join(JOB_STAGES)}"}, 404)
+
+    data = await read_json(request)
+    session_id, video_quality = parse_video_request(data)
+    if not session_id:
+        logger.error("No session_id provided in request")
+        return JSONResponse({"error": "No session_id provided"}, 400)
+
+    job_id = job_manager.submit(
+        job_type, JOB_STAGES[job_type], session_id=session_id, video_quality=video_quality,
+        bypass_cache=flag_enabled(data.get('no_cache')),
+    )
+    return JSONResponse({
+        "job_id": job_id,
+        "session_id": session_id,
+        "type": job_type,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "message": "Job queued. Poll the status_url for stage, progress and result."
+    }, 202)
+
+
+async def pipeline_endpoint(request: Request) -> JSONResponse:
+    """Endpoint to run every stage from image analysis to rendered video in a single call"""
+    logger.info("Starting end-to-end pipeline")
+    if body_too_large(request, SINGLE_UPLOAD_LIMIT):
+        return too_large(SINGLE_UPLOAD_LIMIT)
+
+    form = await request.form()
+    image_file = form.get('image')
+    if not isinstance(image_file, UploadFile):
+        logger.error("No image provided in request")
+        return JSONResponse({"error": "No image provided"}, 400)
+
+    logger.info(f"Image received: {image_file.filename} ({image_file.content_type})")
+    try:
+        image = await ingest_upload(image_file)
+    except ImageRejected as e:
+        logger.error(f"Image rejected: {str(e)}")
+        return JSONResponse({"error": str(e)}, e.status_code)
+
+    fields = {key: value for key, value in form.items() if isinstance(value, str)}
+    _, video_quality = parse_video_request({"session_id": None, **fields})
+    wait = flag_enabled(request.query_params.get('wait'))
+
+    # Create a unique session ID up front so clients can subscribe to its events immediately
+    session_id = str(uuid.uuid4())
+    logger.info(f"Generated session ID: {session_id}")
+    if wait:
+        check_admission("analysis")
+
+    job_id = job_manager.submit(
+        "pipeline",
+        run_full_pipeline,
+        session_id=session_id,
+        image=image,
+        video_quality=video_quality,
+        review=flag_enabled(form.get('review')),
+        bypass_cache=flag_enabled(form.get('no_cache')),
+    )
+    if wait:
+        return await wait_for_job(job_id)
+
+    return JSONResponse({
+        "job_id": job_id,
+        "session_id": session_id,
+        "type": "pipeline",
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "events_url": f"/sessions/{session_id}/events",
+        "message": "Pipeline queued. Follow the events_url or poll the status_url for the result."
+    }, 202)
+
+
+async def submit_batch(request: Request) -> JSONResponse:
+    """Endpoint to run the full pipeline for many images, uploaded as files and/or a zip archive"""
+    logger.info("Starting batch ingestion")
+    if body_too_large(request, BATCH_UPLOAD_LIMIT):
+        return too_large(BATCH_UPLOAD_LIMIT)
+
+    form = await request.form()
+    image_files = [upload for upload in form.getlist('images') if isinstance(upload, UploadFile)]
+    archive_file = form.get('archive')
+    if not isinstance(archive_file, UploadFile):
+        archive_file = None
+    if not image_files and not archive_file:
+        logger.error("No images or archive provided in request")
+        return JSONResponse({"error": "No images provided. Send 'images' files and/or an 'archive' zip."}, 400)
+
+    fields = {key: value for key, value in form.items() if isinstance(value, str)}
+    _, video_quality = parse_video_request({"session_id": None, **fields})
+
+    try:
+        images = []
+        for image_file in image_files:
+            image_data = await read_upload(image_file)
+            error = None
+            if len(image_data) > MAX_UPLOAD_BYTES:
+                image_data, error = None, f"Image exceeds maximum allowed size ({MAX_UPLOAD_BYTES / 1024 / 1024:.0f}MB)"
+            images.append((image_file.filename, image_data, error))
+        if archive_file:
+            logger.info(f"Archive received: {archive_file.filename}")
+            archive_data = await archive_file.read()
+            images.extend(await asyncio.to_thread(lambda: list(iter_archive_images(archive_data))))
+
+        # Ingesting every image decodes it, so run the submission off the event loop
+        batch = await asyncio.to_thread(
+            batch_manager.submit,
+            images,
+            video_quality=video_quality,
+            review=flag_enabled(form.get('review')),
+            bypass_cache=flag_enabled(form.get('no_cache')),
+        )
+    except ImageRejected as e:
+        logger.error(f"Batch rejected: {str(e)}")
+        return JSONResponse({"error": str(e)}, e.status_code)
+
+    return JSONResponse({
+        **batch,
+        "status_url": f"/batch/{batch['batch_id']}",
+        "message": "Batch queued. Poll the status_url for aggregate progress and per-image results."
+    }, 202)
+
+
+async def process_worksheet(request: Request) -> JSONResponse:
+    """Endpoint to split a worksheet image into its problems and run one pipeline per problem in parallel"""
+    start_time = time.time()
+    logger.info("Starting worksheet processing")
+    if body_too_large(request, SINGLE_UPLOAD_LIMIT):
+        return too_large(SINGLE_UPLOAD_LIMIT)
+
+    form = await request.form()
+    image_file = form.get('image')
+    if not isinstance(image_file, UploadFile):
+        logger.error("No image provided in request")
+        return JSONResponse({"error": "No image provided"}, 400)
+
+    logger.info(f"Image received: {image_file.filename} ({image_file.content_type})")
+    fields = {key: value for key, value in form.items() if isinstance(value, str)}
+    _, video_quality = parse_video_request({"session_id": None, **fields})
+    bypass_cache = flag_enabled(form.get('no_cache'))
+
+    # The worksheet gets its own session; every problem becomes a child session linked to it
+    session_id = str(uuid.uuid4())
+    logger.info(f"Generated worksheet session ID: {session_id}")
+    check_admission("regions")
+
+    try:
+        image = await ingest_upload(image_file)
+        image_url, regions, crops = await async_pipeline.split_worksheet(session_id, image, bypass_cache=bypass_cache)
+        batch = await asyncio.to_thread(
+            batch_manager.submit,
+            [(f"problem-{region['label']}", crop, None) for region, crop in zip(regions, crops)],
+            video_quality=video_quality,
+            review=flag_enabled(form.get('review')),
+            bypass_cache=bypass_cache,
+            parent_id=session_id,
+        )
+    except ImageRejected as e:
+        logger.error(f"Image rejected: {str(e)}")
+        return JSONResponse({"error": str(e)}, e.status_code)
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.exception(f"Error in process_worksheet: {str(e)}")
+        publish(session_id, "error", stage="process_worksheet", error=str(e))
+        return JSONResponse({"session_id": session_id, "error": str(e)}, 500)
+
+    process_time = round(time.time() - start_time, 2)
+    logger.info(f"Worksheet split into {len(regions)} problems in {process_time}s")
+    return JSONResponse({
+        **batch,
+        "session_id": session_id,
+        "image_url": image_url,
+        "regions": regions,
+        "status_url": f"/batch/{session_id}",
+        "message": "Worksheet split. Each problem runs as its own session; poll the status_url for their videos."
+    }, 202)
+
+
+async def get_batch(request: Request) -> JSONResponse:
+    """Endpoint to report aggregate progress and per-image status of a batch"""
+    batch_id = request.path_params['batch_id']
+    batch = batch_manager.get(batch_id)
+    if not batch:
+        return JSONResponse({"error": f"No batch found with batch_id: {batch_id}"}, 404)
+    return JSONResponse(batch)
+
+
+async def get_job(request: Request) -> JSONResponse:
+    """Endpoint to report the stage, progress and result of a background job"""
+    job_id = request.path_params['job_id']
+    job = job_manager.get(job_id)
+    if not job:
+        return JSONResponse({"error": f"No job found with job_id: {job_id}"}, 404)
+    return JSONResponse(job)
+
+
+async def journal_stats(request: Request) -> JSONResponse:
+    """Endpoint reporting how many project row writes were recorded, coalesced and flushed"""
+    return JSONResponse(status_journal.stats())
+
+
+async def llm_stats(request: Request) -> JSONResponse:
+    """Endpoint reporting the model of each stage and the circuit state and rate limit of each LLM provider"""
+    return JSONResponse(gateway_stats())
+
+
+async def preflight_stats_endpoint(request: Request) -> JSONResponse:
+    """Endpoint reporting how many generated programs were checked before rendering and the renders saved"""
+    return JSONResponse(preflight_stats.stats())
+
+
+async def fix_stats(request: Request) -> JSONResponse:
+    """Endpoint reporting how failed code was fixed (rules or LLM) and the failures no rule handles yet"""
+    return JSONResponse(await asyncio.to_thread(fix_log.stats))
+
+
+async def metrics(request: Request) -> Response:
+    """Endpoint exposing stage latencies, token counts, render outcomes and storage traffic to Prometheus"""
+    body, content_type = render_latest()
+    return Response(body, headers={'Content-Type': content_type})
+
+
+async def session_history(request: Request) -> JSONResponse:
+    """Endpoint listing a session's status transitions with the time spent in each status"""
+    session_id = request.path_params['session_id']
+    try:
+        transitions = await asyncio.to_thread(load_history, session_id)
+    except Exception as e:
+        logger.error(f"Failed to load status history for session {session_id}: {str(e)}")
+        return JSONResponse({"error": f"Failed to load status history: {str(e)}"}, 500)
+    if not transitions:
+        return JSONResponse({"error": f"No status history found for session_id: {session_id}"}, 404)
+    return JSONResponse({"session_id": session_id, "transitions": transitions})
+
+
+async def session_usage(request: Request) -> JSONResponse:
+    """Endpoint reporting a session's LLM tokens, latency and cost per stage"""
+    session_id = request.path_params['session_id']
+    try:
+        usage = await asyncio.to_thread(load_usage, session_id)
+    except Exception as e:
+        logger.error(f"Failed to load LLM usage for session {session_id}: {str(e)}")
+        return JSONResponse({"error": f"Failed to load LLM usage: {str(e)}"}, 500)
+    if usage is None:
+        return JSONResponse({"error": f"No project found with session_id: {session_id}"}, 404)
+    return JSONResponse({"session_id": session_id, "usage": usage})
+
+
+async def serve_file(request: Request) -> Response:
+    """Serve an artifact kept in local storage (STORAGE_BACKEND=local)"""
+    if not isinstance(storage_backend, LocalStorage):
+        return JSONResponse({"error": "Artifacts are not stored locally"}, 404)
+    try:
+        path = storage_backend.local_path(request.path_params['path'])
+    except ValueError:
+        path = None
+    if path is None or not os.path.isfile(path):
+        return JSONResponse({"error": "File not found"}, 404)
+    return FileResponse(path, headers={'Cache-Control': 'public, max-age=3600'})
+
+
+async def session_events(request: Request) -> StreamingResponse:
+    """Server-Sent Events stream of stage transitions, render attempts and artifact URLs for a session"""
+    session_id = request.path_params['session_id']
+    last_event_id = request.headers.get('last-event-id', request.query_params.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id is not None else None
+    except ValueError:
+        last_event_id = None
+
+    logger.info(f"Client subscribed to events for session: {session_id}")
+    return StreamingResponse(
+        event_bus.astream(session_id, last_event_id=last_event_id),
+        media_type='text/event-stream',
+        headers=SSE_HEADERS,
+    )
+
+
+class TracingMiddleware:
+    """Trace each HTTP request, continuing the caller's trace when it sends a traceparent header"""
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        traceparent = dict(scope['headers']).get(b'traceparent', b'').decode('latin-1')
+        with span(f"{scope['method']} {scope['path']}", traceparent=traceparent, http_path=scope['path']) as request_span:
+            async def send_with_trace(message: Dict[str, Any]) -> None:
+                if message['type'] == 'http.response.start':
+                    request_span.set_attribute("http_status", message['status'])
+                    # Return the trace ID so a slow request can be looked up in the trace store
+                    message['headers'] = list(message.get('headers', [])) + [(b'x-trace-id', request_span.trace_id.encode())]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
+            # Name the span after the route template rather than the concrete path
+            route = scope.get('route')
+            if route is not None:
+                request_span.name = f"{scope['method']} {route.path}"
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette) -> AsyncIterator[None]:
+    yield
+    await close_async_clients()
+    # Write out pending project row updates before the process exits
+    await asyncio.to_thread(status_journal.close)
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/cache/stats', cache_stats, methods=['GET']),
+        Route('/admission/stats', admission_stats_endpoint, methods=['GET']),
+        Route('/process-image', process_image, methods=['POST']),
+        Route('/generate-script', generate_script_endpoint, methods=['POST']),
+        Route('/generate-visuals', generate_visuals_endpoint, methods=['POST']),
+        Route('/generate-video', generate_video, methods=['POST']),
+        Route('/improve-video', improve_video, methods=['POST']),
+        Route('/jobs/{job_type}', submit_job, methods=['POST']),
+        Route('/jobs/{job_id}', get_job, methods=['GET']),
+        Route('/pipeline', pipeline_endpoint, methods=['POST']),
+        Route('/batch', submit_batch, methods=['POST']),
+        Route('/process-worksheet', process_worksheet, methods=['POST']),
+        Route('/batch/{batch_id}', get_batch, methods=['GET']),
+        Route('/journal/stats', journal_stats, methods=['GET']),
+        Route('/llm/stats', llm_stats, methods=['GET']),
+        Route('/preflight/stats', preflight_stats_endpoint, methods=['GET']),
+        Route('/fixes/stats', fix_stats, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/sessions/{session_id}/history', session_history, methods=['GET']),
+        Route('/sessions/{session_id}/usage', session_usage, methods=['GET']),
+        Route('/files/{path:path}', serve_file, methods=['GET']),
+        Route('/sessions/{session_id}/events', session_events, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(TracingMiddleware),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+    ],
+    exception_handlers={Overloaded: overloaded},
+    lifespan=lifespan,
+)
@@ -0,0 +1,282 @@
+"""
+Event-loop versions of the interactive pipeline stages, used by the ASGI server.
+
+They mirror the analysis, script, visuals and worksheet stages of src.pipeline with async
+Supabase, HTTP and LLM clients, and share its artifact cache, memo store, events and stage limits.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from src.cache import artifact_cache
+from src.clients import async_http_client, get_async_supabase
+from src.concurrency import async_stage_slot
+from src.events import publish
+from src.journal import status_journal
+from src.generation.problem_analysis import agenerate_problem_analysis
+from src.generation.problem_regions import adetect_problem_regions, parse_problem_regions
+from src.generation.script import agenerate_script
+from src.generation.visuals import agenerate_visual_elements
+from src.ingest import IngestedImage, crop_regions
+from src.llm_cache import bypass_llm_cache
+from src.memo import amemoize, memo_key
+from src.metrics import count_storage_bytes
+from src.pipeline import StageResult, TokenCallback, token_events
+from src.singleflight import AsyncSingleFlight
+from src.storage import async_upload_to_storage, get_public_url, read_from_url
+from src.usage import tracks_usage, usage_ledger
+
+logger = logging.getLogger('image-to-manim')
+
+# Identical concurrent stage inputs on the event loop share one LLM call
+async_stage_flights = AsyncSingleFlight()
+
+async def _update_project(session_id: str, fields: Dict[str, str]) -> None:
+    # Recording in the journal only takes a lock; the write happens on its flusher thread
+    status_journal.update(session_id, fields)
+
+
+async def _fetch_project(session_id: str) -> Optional[Dict]:
+    logger.info(f"Fetching project data for session: {session_id}")
+    client = await get_async_supabase()
+    response = await client.table("manim_projects").select("*").eq("id", session_id).execute()
+    project_data = status_journal.overlay(session_id, response.data[0] if response.data else None)
+    if project_data:
+        usage_ledger.seed(session_id, project_data.get("llm_usage"))
+    return project_data
+
+
+async def load_artifact(session_id: str, kind: str, url: str) -> Tuple[Optional[str], Optional[StageResult]]:
+    """Async counterpart of src.pipeline.load_artifact"""
+    cached = artifact_cache.get(session_id, kind)
+    if cached is not None:
+        logger.info(f"Using cached {kind} for session: {session_id}")
+        return cached, None
+
+    try:
+        stored = read_from_url(url)
+        if stored is not None:
+            logger.info(f"Reading {kind} from local storage: {url}")
+            text = str(stored, 'utf-8')
+            artifact_cache.put(session_id, kind, text)
+            return text, None
+
+        logger.info(f"Retrieving {kind} from URL: {url}")
+        fetch_start = time.time()
+        response = await async_http_client().get(url)
+        artifact_cache.record_miss_fetch(time.time() - fetch_start)
+        count_storage_bytes("in", len(response.content))
+        if response.status_code == 200:
+            logger.info(f"Successfully retrieved {kind} content")
+            artifact_cache.put(session_id, kind, response.text)
+            return response.text, None
+        logger.error(f"Failed to retrieve {kind}. Status code: {response.status_code}")
+        return None, ({"error": f"Failed to retrieve {kind}. Status code: {response.status_code}"}, 500)
+    except Exception as e:
+        logger.error(f"Exception while retrieving {kind}: {str(e)}")
+        return None, ({"error": f"Failed to retrieve {kind}: {str(e)}"}, 500)
+
+
+async def _run_stage(
+    stage: str, stage_input: Union[bytes, str], compute: Callable[[], Awaitable[str]], bypass_cache: bool
+) -> str:
+    """Run a generation stage once per distinct input: memoized, and coalesced while in flight"""
+    key = f"{memo_key(stage, stage_input)}:{'fresh' if bypass_cache else 'memo'}"
+
+    async def compute_in_slot() -> str:
+        async with async_stage_slot(stage):
+            with bypass_llm_cache(bypass_cache):
+                return await compute()
+
+    return await async_stage_flights.do(key, lambda: amemoize(stage, stage_input, compute_in_slot, bypass=bypass_cache))
+
+
+async def _run_streaming_stage(
+    stage: str,
+    stage_input: str,
+    generate: Callable[[Optional[TokenCallback]], Awaitable[str]],
+    bypass_cache: bool,
+    on_token: Optional[TokenCallback],
+) -> str:
+    """Run a text generation stage, forwarding the full text once on memo hits and coalesced calls"""
+    streamed = []
+
+    def forward(text: str) -> None:
+        streamed.append(True)
+        on_token(text)
+
+    result = await _run_stage(stage, stage_input, lambda: generate(forward if on_token else None), bypass_cache)
+    if on_token and not streamed:
+        on_token(result)
+    return result
+
+
+async def analyze_problem(image: IngestedImage, bypass_cache: bool = False) -> str:
+    """Analyze the problem image, reusing the analysis of byte-identical uploads"""
+    return await _run_stage(
+        "analysis",
+        image.original,
+        lambda: agenerate_problem_analysis(image.vision_data, mime_type=image.vision_mime_type),
+        bypass_cache,
+    )
+
+
+async def find_problem_regions(image: IngestedImage, bypass_cache: bool = False) -> List[Dict]:
+    """Locate the separate problems on a worksheet image, reusing results for byte-identical uploads"""
+    return parse_problem_regions(await _run_stage(
+        "regions",
+        image.original,
+        lambda: adetect_problem_regions(image.vision_data, mime_type=image.vision_mime_type),
+        bypass_cache,
+    ))
+
+
+async def store_image(session_id: str, image: IngestedImage) -> str:
+    """Upload the original image bytes, exactly as received, and return their public URL"""
+    image_path = f"{session_id}/original.{image.file_ext}"
+    logger.info(f"Storing image at path: {image_path}")
+    await async_upload_to_storage(image_path, image.original, image.content_type)
+    image_url = get_public_url(image_path)
+    logger.info(f"Image accessible at URL: {image_url}")
+    publish(session_id, "artifact", kind="image", url=image_url)
+    return image_url
+
+
+async def create_project(session_id: str, problem_analysis: str, image_url: str) -> None:
+    """Insert the project row holding the problem analysis"""
+    project_data = {
+        "id": session_id,
+        "problem_analysis": problem_analysis,
+        "status": "image_processed",
+        "image_url": image_url,
+        "created_at": "now()",
+        **usage_ledger.fields(session_id),
+    }
+    logger.info(f"Inserting project data into database with ID: {session_id}")
+    status_journal.insert(project_data)
+    publish(session_id, "stage", stage="image_processed")
+
+
+async def _store_text_artifact(session_id: str, kind: str, name: str, text: str, status: str, url_field: str) -> str:
+    """Cache and upload a text artifact, then record its URL and the new status on the project row"""
+    artifact_cache.put(session_id, kind, text)
+    path = f"{session_id}/{name}.txt"
+    logger.info(f"Storing {kind} at path: {path}")
+    await async_upload_to_storage(path, text.encode('utf-8'))
+    url = get_public_url(path)
+    logger.info(f"{kind.capitalize()} accessible at URL: {url}")
+    publish(session_id, "artifact", kind=name, url=url)
+
+    logger.info(f"Updating project status to '{status}' for session: {session_id}")
+    await _update_project(session_id, {"status": status, url_field: url})
+    publish(session_id, "stage", stage=status)
+    return url
+
+
+@tracks_usage
+async def run_script_generation(
+    session_id: str, bypass_cache: bool = False, on_token: Optional[TokenCallback] = None
+) -> StageResult:
+    """Async counterpart of src.pipeline.run_script_generation"""
+    project_data = await _fetch_project(session_id)
+    if not project_data:
+        logger.error(f"No project found with session_id: {session_id}")
+        return {"error": f"No project found with session_id: {session_id}"}, 404
+
+    if not project_data.get('problem_analysis'):
+        logger.error(f"Problem analysis not found for session: {session_id}")
+        return {"error": "Problem analysis has not been generated yet"}, 400
+
+    logger.info("Generating script from problem analysis")
+    publish(session_id, "stage", stage="generating_script")
+    problem_analysis = project_data['problem_analysis']
+    script = await _run_streaming_stage(
+        "script",
+        problem_analysis,
+        lambda forward: agenerate_script(problem_analysis, on_token=forward),
+        bypass_cache,
+        token_events(session_id, "script", on_token),
+    )
+    logger.info("Script generation completed")
+
+    script_url = await _store_text_artifact(session_id, "script", "script", script, "script_generated", "script_url")
+
+    return {
+        "session_id": session_id,
+        "script_url": script_url,
+        "script_text": script,
+        "status": "script_generated",
+        "message": "Script generated successfully. Use the session_id to generate a video."
+    }, 200
+
+
+@tracks_usage
+async def run_visuals_generation(
+    session_id: str, bypass_cache: bool = False, on_token: Optional[TokenCallback] = None
+) -> StageResult:
+    """Async counterpart of src.pipeline.run_visuals_generation"""
+    project_data = await _fetch_project(session_id)
+    if not project_data:
+        logger.error(f"No project found with session_id: {session_id}")
+        return {"error": f"No project found with session_id: {session_id}"}, 404
+
+    if not project_data.get('script_url'):
+        logger.error(f"Script URL not found for session: {session_id}")
+        return {"error": "Script has not been generated yet"}, 400
+
+    script, error_result = await load_artifact(session_id, "script", project_data.get('script_url'))
+    if error_result:
+        return error_result
+
+    logger.info("Generating visual elements from script")
+    publish(session_id, "stage", stage="generating_visuals")
+    visual_elements = await _run_streaming_stage(
+        "visuals",
+        script,
+        lambda forward: agenerate_visual_elements(script, on_token=forward),
+        bypass_cache,
+        token_events(session_id, "visuals", on_token),
+    )
+    logger.info("Visual elements generation completed")
+
+    visuals_url = await _store_text_artifact(
+        session_id, "visual elements", "visuals", visual_elements, "visuals_generated", "visuals_url"
+    )
+
+    return {
+        "session_id": session_id,
+        "visuals_url": visuals_url,
+        "visuals_text": visual_elements,
+        "status": "visuals_generated",
+        "message": "Visual elements generated successfully. Use the session_id to generate a video."
+    }, 200
+
+
+@tracks_usage
+async def split_worksheet(
+    session_id: str, image: IngestedImage, bypass_cache: bool = False
+) -> Tuple[str, List[Dict], List[bytes]]:
+    """Async counterpart of src.pipeline.split_worksheet"""
+    publish(session_id, "stage", stage="detecting_problems")
+    image_url, regions = await asyncio.gather(
+        store_image(session_id, image),
+        find_problem_regions(image, bypass_cache=bypass_cache),
+    )
+    logger.info(f"Detected {len(regions)} problem regions for session: {session_id}")
+    if len(regions) > 1:
+        # Cropping decodes the full-resolution original, so keep it off the event loop
+        crops = await asyncio.to_thread(crop_regions, image, [region["box"] for region in regions])
+    else:
+        regions = [{"label": "1", "box": [0.0, 0.0, 1.0, 1.0]}]
+        crops = [image.original]
+
+    status_journal.insert({
+        "id": session_id,
+        "status": "worksheet_split",
+        "image_url": image_url,
+        "created_at": "now()",
+        **usage_ledger.fields(session_id),
+    })
+    publish(session_id, "stage", stage="worksheet_split", problems=len(regions))
+    return image_url, regions, crops
@@ -0,0 +1,188 @@
+"""
+Batch ingestion: one pipeline job per image, tracked under a batch id
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+import zipfile
+from io import BytesIO
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from src.config import BATCH_MAX_IMAGES, JOB_TTL_SECONDS, MAX_UPLOAD_BYTES
+from src.ingest import ImageRejected, SUPPORTED_FORMATS, ingest_image
+from src.jobs import JobManager, job_manager
+from src.pipeline import run_full_pipeline
+
+logger = logging.getLogger('image-to-manim')
+
+# File extensions picked out of uploaded archives
+ARCHIVE_IMAGE_EXTENSIONS = {".jpg", ".jpeg"} | {f".{ext}" for ext, _ in SUPPORTED_FORMATS.values()}
+
+
+def iter_archive_images(archive_data: bytes) -> Iterator[Tuple[str, Optional[bytes], Optional[str]]]:
+    """
+    Yield (filename, image_bytes, error) for each image member of a zip archive
+
+    Members are size-checked from the archive directory before being decompressed, so
+    oversized entries are reported without being inflated into memory.
+
+    Raises:
+        ImageRejected: If the archive is unreadable or holds more than BATCH_MAX_IMAGES images
+    """
+    try:
+        archive = zipfile.ZipFile(BytesIO(archive_data))
+    except zipfile.BadZipFile:
+        raise ImageRejected("Uploaded archive is not a valid zip file")
+
+    with archive:
+        count = 0
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+                continue
+            if os.path.splitext(name)[1].lower() not in ARCHIVE_IMAGE_EXTENSIONS:
+                continue
+            count += 1
+            if count > BATCH_MAX_IMAGES:
+                raise ImageRejected(f"Archive contains more than {BATCH_MAX_IMAGES} images", status_code=413)
+            if info.file_size > MAX_UPLOAD_BYTES:
+                yield name, None, f"Image exceeds maximum allowed size ({MAX_UPLOAD_BYTES / 1024 / 1024:.0f}MB)"
+                continue
+            yield name, archive.read(info), None
+
+
+class BatchManager:
+    """
+    Creates one session and pipeline job per image and aggregates their progress.
+
+    Concurrency comes from the job worker pool and the per-stage limits in src.concurrency,
+    so a batch runs as many images at once as the stage caps allow instead of one by one.
+    """
+
+    def __init__(self, jobs: JobManager, ttl_seconds: int):
+        self._jobs = jobs
+        self._ttl_seconds = ttl_seconds
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        images: List[Tuple[str, Optional[bytes], Optional[str]]],
+        video_quality: str,
+        review: bool = False,
+        bypass_cache: bool = False,
+        parent_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Validate every image and queue a full pipeline job for each accepted one
+
+        Args:
+            images: (filename, image_bytes, error) tuples; entries with an error are recorded as rejected
+            video_quality: Video quality to render with (low, medium or high)
+            review: Whether each pipeline reviews and improves its video
+            bypass_cache: Regenerate stages instead of reusing memoized results
+            parent_id: Worksheet session the images were cropped from; it also serves as the batch id
+
+        Returns:
+            dict: The batch record, as returned by get()
+
+        Raises:
+            ImageRejected: If the batch is empty or holds more than BATCH_MAX_IMAGES images
+            Overloaded: If the job queue cannot take every image
+        """
+        if not images:
+            raise ImageRejected("No images found in batch")
+        if len(images) > BATCH_MAX_IMAGES:
+            raise ImageRejected(f"Batch exceeds maximum of {BATCH_MAX_IMAGES} images", status_code=413)
+
+        # Refuse the whole batch rather than queue only part of it
+        self._jobs.ensure_capacity(sum(1 for _, _, error in images if error is None))
+
+        self._prune()
+        batch_id = parent_id or str(uuid.uuid4())
+        items = []
+        for filename, image_data, error in images:
+            item = {"filename": filename, "session_id": None, "job_id": None, "error": error}
+            if error is None:
+                try:
+                    image = ingest_image(image_data)
+                    item["session_id"] = str(uuid.uuid4())
+                    item["job_id"] = self._jobs.submit(
+                        "pipeline",
+                        run_full_pipeline,
+                        session_id=item["session_id"],
+                        image=image,
+                        video_quality=video_quality,
+                        review=review,
+                        bypass_cache=bypass_cache,
+                        parent_id=parent_id,
+                    )
+                except ImageRejected as e:
+                    item["error"] = str(e)
+            items.append(item)
+
+        with self._lock:
+            self._batches[batch_id] = {
+                "batch_id": batch_id, "parent_id": parent_id, "created_at": time.time(), "items": items,
+            }
+        accepted = sum(1 for item in items if item["job_id"])
+        logger.info(f"Created batch {batch_id} with {accepted}/{len(items)} images queued")
+        return self.get(batch_id)
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """Return the batch with each item's job status and the aggregate progress"""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if not batch:
+                return None
+            items = [dict(item) for item in batch["items"]]
+            parent_id = batch["parent_id"]
+
+        counts = {"queued": 0, "running": 0, "succeeded": 0, "failed": 0, "rejected": 0}
+        progress_total = 0.0
+        for item in items:
+            job = self._jobs.get(item["job_id"]) if item["job_id"] else None
+            if job is None:
+                status = "rejected" if item["job_id"] is None else "failed"
+                item.update(status=status, stage=None, progress=0.0)
+                if status == "failed" and not item["error"]:
+                    item["error"] = "Job expired before completion"
+            else:
+                status = job["status"]
+                result = job["result"] or {}
+                item.update(
+                    status=status,
+                    stage=job["stage"],
+                    progress=job["progress"],
+                    video_url=result.get("improved_video_url") or result.get("video_url"),
+                    error=job["error"] or result.get("error"),
+                )
+            counts[status] += 1
+            if status in ("succeeded", "failed"):
+                progress_total += 1.0
+            elif status != "rejected":
+                progress_total += item["progress"]
+
+        accepted = len(items) - counts["rejected"]
+        finished = counts["succeeded"] + counts["failed"]
+        return {
+            "batch_id": batch_id,
+            "parent_id": parent_id,
+            "total": len(items),
+            "counts": counts,
+            "progress": round(progress_total / accepted, 3) if accepted else 1.0,
+            "status": "complete" if finished == accepted else "running",
+            "items": items,
+        }
+
+    def _prune(self) -> None:
+        """Drop batches older than the job retention period"""
+        cutoff = time.time() - self._ttl_seconds
+        with self._lock:
+            for batch_id in [b for b, batch in self._batches.items() if batch["created_at"] < cutoff]:
+                del self._batches[batch_id]
+
+
+batch_manager = BatchManager(job_manager, ttl_seconds=JOB_TTL_SECONDS)
@@ -0,0 +1,99 @@
+"""
+In-process cache of session artifacts (scripts, visual elements, code) generated by this process
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+
+from src.config import (
+    ARTIFACT_CACHE_MAX_BYTES,
+    ARTIFACT_CACHE_MAX_ENTRIES,
+    ARTIFACT_CACHE_TTL_SECONDS,
+)
+
+
+class SessionArtifactCache:
+    """
+    Bounded LRU cache of artifact text keyed by (session_id, kind), with a per-entry TTL.
+
+    Entries are evicted least-recently-used first once either the entry or byte limit is
+    exceeded. Misses record how long the fallback download took, so the stats can estimate
+    the latency the cache has saved.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._miss_fetch_seconds = 0.0
+        self._miss_fetches = 0
+
+    def get(self, session_id: str, kind: str) -> Optional[str]:
+        """Return the cached artifact, or None on a miss or expired entry"""
+        key = (session_id, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[0]
+            if entry:
+                self._remove(key)
+            self._misses += 1
+            return None
+
+    def put(self, session_id: str, kind: str, content: str) -> None:
+        """Store an artifact, evicting least recently used entries to stay within the limits"""
+        key = (session_id, kind)
+        size = len(content.encode('utf-8'))
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (content, time.time() + self._ttl_seconds)
+            self._size_bytes += size
+            while len(self._entries) > self._max_entries or self._size_bytes > self._max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def record_miss_fetch(self, seconds: float) -> None:
+        """Record the duration of a storage download made because of a cache miss"""
+        with self._lock:
+            self._miss_fetch_seconds += seconds
+            self._miss_fetches += 1
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Return hit/miss counters and an estimate of the download time saved by hits"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            avg_fetch = self._miss_fetch_seconds / self._miss_fetches if self._miss_fetches else 0.0
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "size_bytes": self._size_bytes,
+                "avg_miss_fetch_seconds": round(avg_fetch, 4),
+                "estimated_seconds_saved": round(avg_fetch * self._hits, 2),
+            }
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        content, _ = self._entries.pop(key)
+        self._size_bytes -= len(content.encode('utf-8'))
+
+
+artifact_cache = SessionArtifactCache(
+    max_entries=ARTIFACT_CACHE_MAX_ENTRIES,
+    max_bytes=ARTIFACT_CACHE_MAX_BYTES,
+    ttl_seconds=ARTIFACT_CACHE_TTL_SECONDS,
+)
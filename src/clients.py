@@ -0,0 +1,215 @@
+"""
+Shared clients for every outbound call: Supabase, artifact downloads, the LLM provider, Gemini and Modal
+
+Each client is created once per process on first use and keeps its connections alive, so stages
+reuse warm TLS connections instead of opening new ones. HTTP clients get default timeouts and a
+bounded connection pool per host. Forked workers drop the clients inherited from their parent.
+"""
+import asyncio
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.config import (
+    DEEPINFRA_API_KEY,
+    GEMINI_API_KEY,
+    GEMINI_TIMEOUT_SECONDS,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_POOL_HOSTS,
+    HTTP_POOL_PER_HOST,
+    HTTP_TIMEOUT_SECONDS,
+    LLM_TIMEOUT_SECONDS,
+    MODAL_APP_NAME,
+    SUPABASE_KEY,
+    SUPABASE_TIMEOUT_SECONDS,
+    SUPABASE_URL,
+)
+
+logger = logging.getLogger('image-to-manim')
+
+_lock = threading.Lock()
+_clients: Dict[str, Any] = {}
+# Event-loop bound clients, keyed by name; each remembers the loop it was created in
+_async_clients: Dict[str, Any] = {}
+
+
+class _TimeoutSession(requests.Session):
+    """requests.Session applying a default timeout to calls that do not pass one"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.default_timeout)
+        return super().request(method, url, **kwargs)
+
+
+def _get_or_create(name: str, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def get_supabase():
+    """Return the Supabase client of this process, creating it on first use"""
+    def create():
+        # Imported here: the Supabase SDK is slow to import and only needed once a request arrives
+        from supabase import ClientOptions, create_client
+        return create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(
+            postgrest_client_timeout=SUPABASE_TIMEOUT_SECONDS,
+            storage_client_timeout=SUPABASE_TIMEOUT_SECONDS,
+        ))
+    return _get_or_create("supabase", create)
+
+
+def http_session() -> requests.Session:
+    """
+    Return the pooled session for blocking HTTP downloads
+
+    Connections are kept alive per host; at most HTTP_POOL_PER_HOST are open to one host, and
+    further callers wait for a free connection instead of opening more.
+    """
+    def create():
+        session = _TimeoutSession((HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_TIMEOUT_SECONDS))
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, pool_block=True)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+    return _get_or_create("http", create)
+
+
+def _httpx_limits():
+    import httpx
+    return httpx.Limits(max_connections=HTTP_POOL_HOSTS * HTTP_POOL_PER_HOST, max_keepalive_connections=HTTP_POOL_PER_HOST)
+
+
+def _loop_bound(name: str, factory):
+    """Return a client bound to the running event loop, replacing one left over from another loop"""
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(name)
+    if entry is None or entry[0] is not loop:
+        entry = _async_clients[name] = (loop, factory())
+    return entry[1]
+
+
+def async_http_client():
+    """Return the pooled httpx.AsyncClient for artifact downloads on the running event loop"""
+    import httpx
+    return _loop_bound("http", lambda: httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+        limits=_httpx_limits(),
+    ))
+
+
+async def get_async_supabase():
+    """Return the async Supabase client of the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get("supabase")
+    if entry is None or entry[0] is not loop:
+        from supabase import AsyncClientOptions, acreate_client
+        client = await acreate_client(SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(
+            postgrest_client_timeout=SUPABASE_TIMEOUT_SECONDS,
+            storage_client_timeout=SUPABASE_TIMEOUT_SECONDS,
+        ))
+        entry = _async_clients["supabase"] = (loop, client)
+    return entry[1]
+
+
+def _litellm():
+    """Import litellm and point it at the shared connection pools; litellm builds its provider clients on them"""
+    def create():
+        # Imported on first use: litellm takes seconds to import
+        import httpx
+        import litellm
+        litellm.client_session = httpx.Client(
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            limits=_httpx_limits(),
+        )
+        return litellm
+    return _get_or_create("litellm", create)
+
+
+def llm(is_async: bool = False):
+    """
+    Return litellm configured with the shared pools
+
+    The async pool belongs to the running event loop, so it is attached on the first async call
+    made from each loop.
+    """
+    litellm = _litellm()
+    if is_async:
+        import httpx
+        litellm.aclient_session = _loop_bound("llm", lambda: httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            limits=_httpx_limits(),
+        ))
+    return litellm
+
+
+def llm_options() -> Dict[str, Any]:
+    """Credentials and default timeout passed with every completion request (the LLM gateway narrows the timeout per call)"""
+    return {"api_key": DEEPINFRA_API_KEY, "timeout": LLM_TIMEOUT_SECONDS}
+
+
+def gemini_client():
+    """Return the Gemini client used for video review"""
+    def create():
+        from google import genai
+        from google.genai import types
+        return genai.Client(
+            api_key=GEMINI_API_KEY,
+            http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT_SECONDS * 1000)),
+        )
+    return _get_or_create("gemini", create)
+
+
+def modal_renderer():
+    """
+    Return a handle to the deployed Modal renderer
+
+    Looking the class up once avoids starting an ephemeral Modal app for every render. If the
+    app has not been deployed, fall back to running it ephemerally for each call.
+    """
+    def create():
+        import modal
+        try:
+            renderer_cls = modal.Cls.from_name(MODAL_APP_NAME, "ManimRenderer")
+            renderer_cls.hydrate()
+            return renderer_cls()
+        except Exception as e:
+            logger.warning(f"Deployed Modal app '{MODAL_APP_NAME}' not available, rendering ephemerally: {str(e)}")
+            return None
+    return _get_or_create("modal", create)
+
+
+async def close_async_clients() -> None:
+    """Close the event-loop bound connection pools; called when the ASGI server shuts down"""
+    entries = list(_async_clients.items())
+    _async_clients.clear()
+    for name, (_, client) in entries:
+        try:
+            if name == "supabase":
+                continue
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Failed to close {name} client: {str(e)}")
+
+
+def _reset_after_fork() -> None:
+    """Drop clients inherited from the parent; their connections and locks are not safe to share"""
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+    _async_clients.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
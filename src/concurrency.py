@@ -0,0 +1,243 @@
+"""
+Admission control for pipeline stages: per-stage concurrency limits shared by every request,
+job and batch in the process, bounded wait queues and Retry-After estimates when a stage is saturated
+"""
+import asyncio
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, Union
+
+from src.config import STAGE_CONCURRENCY, STAGE_MAX_WAIT_SECONDS, STAGE_QUEUE_DEPTH
+from src.metrics import observe_wait, stage_timer
+from src.tracing import span
+
+# Pipeline stages that call an external service and can be capped independently
+STAGES = ("regions", "analysis", "script", "visuals", "codegen", "render", "review")
+
+# Weight of the latest call in the moving average of stage durations
+DURATION_SMOOTHING = 0.2
+
+
+class Overloaded(Exception):
+    """Raised when work is refused because a stage or the job queue is saturated"""
+
+    def __init__(self, message: str, retry_after: int, status_code: int = 429):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+def parse_stage_limits(spec: str, default: int = 8) -> Dict[str, int]:
+    """
+    Parse a "stage=limit,stage=limit" string into per-stage limits
+
+    Args:
+        spec: Comma separated assignments, e.g. "analysis=8,render=4"
+        default: Limit of every stage that is not listed
+
+    Returns:
+        dict: Limit for every stage
+    """
+    limits = {stage: default for stage in STAGES}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        stage, _, value = item.partition("=")
+        if stage.strip() not in limits:
+            raise ValueError(f"Unknown stage in stage limits: {stage.strip()}")
+        limits[stage.strip()] = max(0, int(value))
+    return limits
+
+
+class StageGate:
+    """
+    Admits at most `limit` concurrent calls to one stage and lets at most `max_queue` more wait.
+
+    Callers beyond the queue are refused immediately with 429; callers that wait longer than
+    max_wait_seconds give up with 503. Both carry a Retry-After computed from the moving average
+    of the stage's call duration and the amount of work ahead of a new caller.
+    """
+
+    def __init__(self, stage: str, limit: int, max_queue: int, max_wait_seconds: float):
+        self.stage = stage
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._avg_duration = None
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+
+    def retry_after(self) -> int:
+        """Estimate in whole seconds how long until a new caller would get a slot"""
+        with self._condition:
+            return self._retry_after()
+
+    def _retry_after(self) -> int:
+        average = self._avg_duration if self._avg_duration is not None else 10.0
+        return max(1, math.ceil(average * (self._waiting + 1) / self.limit))
+
+    def _refuse(self) -> Overloaded:
+        self._rejected += 1
+        return Overloaded(f"The {self.stage} stage is at capacity", self._retry_after(), 429)
+
+    def check(self) -> None:
+        """Raise Overloaded if a new caller would be refused, without taking a slot"""
+        with self._condition:
+            if self._in_flight >= self.limit and self._waiting >= self.max_queue:
+                raise self._refuse()
+
+    def acquire(self) -> None:
+        """Take a slot, waiting in the bounded queue if every slot is busy"""
+        start = time.time()
+        with self._condition:
+            if self._in_flight >= self.limit:
+                if self._waiting >= self.max_queue:
+                    raise self._refuse()
+                self._waiting += 1
+                try:
+                    deadline = start + self.max_wait_seconds
+                    while self._in_flight >= self.limit:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._timed_out += 1
+                            raise Overloaded(
+                                f"Timed out waiting for the {self.stage} stage", self._retry_after(), 503
+                            )
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._admit(start)
+
+    async def acquire_async(self) -> None:
+        """
+        Take a slot from a coroutine, waiting on the event loop instead of blocking a thread
+
+        Waiters re-check for a free slot with a short, growing back-off; they share the same
+        queue bound, timeout and statistics as threads calling acquire().
+        """
+        start = time.time()
+        with self._condition:
+            if self._in_flight < self.limit:
+                self._admit(start)
+                return
+            if self._waiting >= self.max_queue:
+                raise self._refuse()
+            self._waiting += 1
+
+        delay = 0.01
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.25)
+                with self._condition:
+                    if self._in_flight < self.limit:
+                        self._admit(start)
+                        return
+                    if time.time() - start >= self.max_wait_seconds:
+                        self._timed_out += 1
+                        raise Overloaded(
+                            f"Timed out waiting for the {self.stage} stage", self._retry_after(), 503
+                        )
+        finally:
+            with self._condition:
+                self._waiting -= 1
+
+    def _admit(self, start: float) -> None:
+        self._in_flight += 1
+        self._admitted += 1
+        waited = time.time() - start
+        self._total_wait += waited
+        self._max_wait_seen = max(self._max_wait_seen, waited)
+
+    def release(self, duration: float) -> None:
+        """Free a slot and fold the call's duration into the moving average"""
+        with self._condition:
+            self._in_flight -= 1
+            if self._avg_duration is None:
+                self._avg_duration = duration
+            else:
+                self._avg_duration += DURATION_SMOOTHING * (duration - self._avg_duration)
+            self._condition.notify()
+
+    def stats(self) -> Dict[str, Union[int, float, None]]:
+        """Return limits, current occupancy, queue depth and wait times"""
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "avg_wait_seconds": round(self._total_wait / self._admitted, 3) if self._admitted else 0.0,
+                "max_wait_seconds": round(self._max_wait_seen, 3),
+                "avg_duration_seconds": round(self._avg_duration, 3) if self._avg_duration is not None else None,
+                "retry_after": self._retry_after(),
+            }
+
+
+stage_limits = parse_stage_limits(STAGE_CONCURRENCY)
+stage_queue_limits = parse_stage_limits(STAGE_QUEUE_DEPTH, default=16)
+stage_gates = {
+    stage: StageGate(stage, stage_limits[stage], stage_queue_limits[stage], STAGE_MAX_WAIT_SECONDS)
+    for stage in STAGES
+}
+
+
+@contextmanager
+def stage_slot(stage: str) -> Iterator[None]:
+    """
+    Hold one of the stage's concurrency slots for the duration of the block
+
+    The block runs in a "stage.<name>" span; the wait for the slot and the time spent holding
+    it are exported as stage metrics.
+
+    Raises:
+        Overloaded: If the stage's wait queue is full or the wait exceeds STAGE_MAX_WAIT_SECONDS
+    """
+    gate = stage_gates[stage]
+    with span(f"stage.{stage}") as stage_span:
+        wait_start = time.time()
+        gate.acquire()
+        start = time.time()
+        observe_wait(stage, start - wait_start)
+        stage_span.set_attribute("wait_seconds", round(start - wait_start, 3))
+        try:
+            with stage_timer(stage):
+                yield
+        finally:
+            gate.release(time.time() - start)
+
+
+@asynccontextmanager
+async def async_stage_slot(stage: str) -> AsyncIterator[None]:
+    """Async counterpart of stage_slot, sharing the same per-stage limits"""
+    gate = stage_gates[stage]
+    with span(f"stage.{stage}") as stage_span:
+        wait_start = time.time()
+        await gate.acquire_async()
+        start = time.time()
+        observe_wait(stage, start - wait_start)
+        stage_span.set_attribute("wait_seconds", round(start - wait_start, 3))
+        try:
+            with stage_timer(stage):
+                yield
+        finally:
+            gate.release(time.time() - start)
+
+
+def check_admission(stage: str) -> None:
+    """Refuse new work up front when its first stage is already saturated"""
+    stage_gates[stage].check()
+
+
+def admission_stats() -> Dict[str, Dict[str, Union[int, float, None]]]:
+    """Return the admission statistics of every stage"""
+    return {stage: gate.stats() for stage, gate in stage_gates.items()}
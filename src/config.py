@@ -1,8 +1,11 @@
 """
 Configuration and initialization for the application
+
+Settings are read from the environment on import. Prompt resources are read on first use, and
+clients live in src.clients, so importing this module stays cheap.
 """
+import functools
 import os
-from supabase import create_client, Client
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -14,18 +17,137 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# Load prompt templates
-def load_prompt_templates():
-    """Load prompt templates from resources directory"""
-    with open("resources/manim_code_guide.txt", "r") as f:
-        manim_code_guide = f.read()
-    with open("resources/video-quality-standards.md", "r") as f:
-        video_quality_standards = f.read()
-    
-    return manim_code_guide, video_quality_standards
-
-# Initialize on import
-MANIM_CODE_GUIDE, VIDEO_QUALITY_STANDARDS = load_prompt_templates()
+# Background job settings
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "32"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "256"))
+
+# Server-Sent Events settings
+SSE_HISTORY_SIZE = int(os.getenv("SSE_HISTORY_SIZE", "200"))
+SSE_MAX_SESSIONS = int(os.getenv("SSE_MAX_SESSIONS", "1000"))
+SSE_KEEPALIVE_SECONDS = int(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+# Session artifact cache settings
+ARTIFACT_CACHE_MAX_ENTRIES = int(os.getenv("ARTIFACT_CACHE_MAX_ENTRIES", "512"))
+ARTIFACT_CACHE_MAX_BYTES = int(os.getenv("ARTIFACT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ARTIFACT_CACHE_TTL_SECONDS = int(os.getenv("ARTIFACT_CACHE_TTL_SECONDS", "3600"))
+
+# Image ingestion limits and the size of the variant sent to the vision model
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+VISION_MAX_EDGE = int(os.getenv("VISION_MAX_EDGE", "1568"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+
+# Stage memoization settings; bump MEMO_NAMESPACE when prompts change to invalidate old entries
+MEMO_BACKEND = os.getenv("MEMO_BACKEND", "sqlite")
+MEMO_PATH = os.getenv("MEMO_PATH", ".cache/memo.sqlite3" if MEMO_BACKEND == "sqlite" else ".cache/memo")
+MEMO_MAX_BYTES = int(os.getenv("MEMO_MAX_BYTES", str(256 * 1024 * 1024)))
+MEMO_NAMESPACE = os.getenv("MEMO_NAMESPACE", "v1")
+
+# LLM response cache: "cache" (answer repeated requests from the store), "record" (always call the provider and
+# store responses), "replay" (answer only from the store, for offline runs) or "off"
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "cache")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite3")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# How long cached responses are served, and per-stage overrides as "stage=seconds" pairs (0 stops caching a stage)
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_STAGE_TTLS = os.getenv("LLM_CACHE_STAGE_TTLS", "")
+
+# Per-stage concurrency caps as "stage=limit" pairs, e.g. "analysis=16,render=4" (unlisted stages default to 8)
+STAGE_CONCURRENCY = os.getenv("STAGE_CONCURRENCY", "")
+# Callers allowed to wait for a busy stage, in the same format (unlisted stages default to 16), and how long they wait
+STAGE_QUEUE_DEPTH = os.getenv("STAGE_QUEUE_DEPTH", "")
+STAGE_MAX_WAIT_SECONDS = float(os.getenv("STAGE_MAX_WAIT_SECONDS", "60"))
+
+# Batch ingestion limits
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "50"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Write-behind journal for project rows: how often pending writes are flushed, how many sessions
+# trigger an early flush, attempts before a write is dropped, and sessions whose status history stays in memory
+JOURNAL_FLUSH_INTERVAL_SECONDS = float(os.getenv("JOURNAL_FLUSH_INTERVAL_SECONDS", "0.5"))
+JOURNAL_MAX_BATCH = int(os.getenv("JOURNAL_MAX_BATCH", "100"))
+JOURNAL_MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", "5"))
+JOURNAL_HISTORY_SESSIONS = int(os.getenv("JOURNAL_HISTORY_SESSIONS", "1000"))
+
+# Artifact storage: "supabase" (bucket) or "local" (files under STORAGE_LOCAL_ROOT, served at STORAGE_PUBLIC_URL)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
+STORAGE_LOCAL_ROOT = os.getenv("STORAGE_LOCAL_ROOT", ".cache/storage")
+STORAGE_PUBLIC_URL = os.getenv("STORAGE_PUBLIC_URL", "http://localhost:5000/files")
+
+# Outbound connections: default HTTP timeouts, keep-alive pool size per host and number of hosts pooled
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "30"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "10"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "32"))
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "16"))
+# Timeouts of the Supabase API, LLM completions (long generations stream for minutes) and Gemini review calls
+SUPABASE_TIMEOUT_SECONDS = float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "30"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "600"))
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "90"))
+# Name of the deployed Modal app holding ManimRenderer
+MODAL_APP_NAME = os.getenv("MODAL_APP_NAME", "manim-renderer")
+# Speculative code generation: programs generated and rendered concurrently per video, the first to render wins
+# (1 keeps the serial generate, render and fix loop), and the sampling temperatures given to the candidates in turn
+CODEGEN_CANDIDATES = int(os.getenv("CODEGEN_CANDIDATES", "1"))
+CODEGEN_CANDIDATE_TEMPERATURES = os.getenv("CODEGEN_CANDIDATE_TEMPERATURES", "0.2,0.5,0.8")
+
+# Check generated code against the manim API (resources/manim_symbols.json) before rendering it; "false" renders unchecked
+PREFLIGHT_ENABLED = os.getenv("PREFLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Error-signature rules tried before the LLM fixer ("false" sends every failure to the LLM), extra "Old=New" name
+# renames for them, and the SQLite log of the failures fixed and how ("" keeps no log)
+FIX_RULES_ENABLED = os.getenv("FIX_RULES_ENABLED", "true").lower() in ("1", "true", "yes")
+FIX_RULE_RENAMES = os.getenv("FIX_RULE_RENAMES", "")
+FIX_LOG_PATH = os.getenv("FIX_LOG_PATH", ".cache/fix_log.sqlite3")
+
+# LLM gateway: default model and per-stage overrides as "stage=model" pairs
+LLM_MODEL = os.getenv("LLM_MODEL", "deepinfra/meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8")
+LLM_STAGE_MODELS = os.getenv("LLM_STAGE_MODELS", "review=gemini-2.0-flash")
+# Time allowed for one LLM call including retries, retries per call and their jittered backoff bounds
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "900"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "1"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "30"))
+# Requests per minute allowed per provider as "provider=rpm" pairs (unlisted providers are not limited), and the burst size
+LLM_RATE_LIMITS = os.getenv("LLM_RATE_LIMITS", "deepinfra=600")
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "20"))
+# Consecutive failed calls that open a provider's circuit, and how long it stays open before a trial call
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+# How the Manim code guide goes into codegen and fix prompts: "retrieval" (the sections most relevant to the
+# call, up to MANIM_GUIDE_TOKEN_BUDGET estimated tokens) or "full" (the whole guide, about 12.5k tokens)
+MANIM_GUIDE_MODE = os.getenv("MANIM_GUIDE_MODE", "retrieval")
+MANIM_GUIDE_TOKEN_BUDGET = int(os.getenv("MANIM_GUIDE_TOKEN_BUDGET", "3000"))
+
+# LLM prices in USD per million tokens as "model=prompt:completion" pairs; models not listed use litellm's price map
+LLM_PRICES = os.getenv(
+    "LLM_PRICES",
+    "deepinfra/meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8=0.17:0.60,gemini-2.0-flash=0.10:0.40",
+)
+# Sessions whose LLM usage totals are kept in memory
+USAGE_MAX_SESSIONS = int(os.getenv("USAGE_MAX_SESSIONS", "1000"))
+
+# Trace export: "none", "file" (Zipkin JSON lines in TRACE_FILE) or "zipkin" (POSTed to TRACE_COLLECTOR_URL)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", ".cache/traces.jsonl")
+TRACE_COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL", "http://localhost:9411/api/v2/spans")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "image-to-manim")
+TRACE_FLUSH_INTERVAL_SECONDS = float(os.getenv("TRACE_FLUSH_INTERVAL_SECONDS", "2"))
+
+# Prompt resources live next to the package, independent of the working directory
+RESOURCES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "resources")
+
+@functools.lru_cache(maxsize=None)
+def load_resource(name):
+    """Read a prompt resource from the resources directory once per process"""
+    with open(os.path.join(RESOURCES_DIR, name), "r") as f:
+        return f.read()
+
+def get_manim_code_guide():
+    """Return the Manim coding guide included in code generation prompts"""
+    return load_resource("manim_code_guide.txt")
+
+def get_video_quality_standards():
+    """Return the quality standards the video review is scored against"""
+    return load_resource("video-quality-standards.md")
@@ -0,0 +1,148 @@
+"""
+In-process event bus feeding the per-session Server-Sent Events streams
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional
+
+from src.config import SSE_HISTORY_SIZE, SSE_KEEPALIVE_SECONDS, SSE_MAX_SESSIONS
+
+
+class EventBus:
+    """
+    Fans out pipeline events to every subscriber of a session.
+
+    Each session keeps a bounded history so that clients connecting late, or reconnecting
+    with a Last-Event-ID header, receive the events they missed. Histories of the least
+    recently active sessions are dropped once max_sessions is exceeded.
+    """
+
+    def __init__(self, history_size: int, max_sessions: int):
+        self._history_size = history_size
+        self._max_sessions = max_sessions
+        self._history: "OrderedDict[str, Deque[Dict[str, Any]]]" = OrderedDict()
+        self._counters: Dict[str, int] = {}
+        self._subscribers: Dict[str, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, session_id: Optional[str], event: str, data: Dict[str, Any]) -> None:
+        """
+        Record an event for a session and deliver it to all connected subscribers
+
+        Args:
+            session_id: Session the event belongs to; events without a session are dropped
+            event: Event type (e.g. "stage", "render_attempt", "artifact")
+            data: JSON-serialisable event payload
+        """
+        if not session_id:
+            return
+        with self._lock:
+            event_id = self._counters.get(session_id, 0) + 1
+            self._counters[session_id] = event_id
+            message = {
+                "id": event_id,
+                "event": event,
+                "data": dict(data, session_id=session_id, timestamp=time.time()),
+            }
+            self._history.setdefault(session_id, deque(maxlen=self._history_size)).append(message)
+            self._history.move_to_end(session_id)
+            while len(self._history) > self._max_sessions:
+                expired_id, _ = self._history.popitem(last=False)
+                self._counters.pop(expired_id, None)
+            subscribers = list(self._subscribers.get(session_id, []))
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def stream(self, session_id: str, last_event_id: Optional[int] = None) -> Iterator[str]:
+        """
+        Yield Server-Sent Events for a session until the client disconnects
+
+        Args:
+            session_id: Session to follow
+            last_event_id: Id of the last event the client received; older events are not replayed
+
+        Returns:
+            Iterator[str]: Formatted SSE messages, with keep-alive comments while idle
+        """
+        subscriber: queue.Queue = queue.Queue()
+        backlog = self._subscribe(session_id, subscriber, last_event_id)
+        try:
+            for message in backlog:
+                yield format_sse(message)
+            while True:
+                try:
+                    message = subscriber.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Comment lines keep proxies from closing idle connections
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(message)
+        finally:
+            self._unsubscribe(session_id, subscriber)
+
+    async def astream(self, session_id: str, last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+        """Async counterpart of stream() for the ASGI server; waits on the event loop, not a thread"""
+        subscriber = _LoopQueue(asyncio.get_running_loop())
+        backlog = self._subscribe(session_id, subscriber, last_event_id)
+        try:
+            for message in backlog:
+                yield format_sse(message)
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(message)
+        finally:
+            self._unsubscribe(session_id, subscriber)
+
+    def _subscribe(self, session_id: str, subscriber: Any, last_event_id: Optional[int]) -> List[Dict[str, Any]]:
+        """Register a subscriber and return the history it has not seen yet"""
+        with self._lock:
+            backlog = [
+                message for message in self._history.get(session_id, [])
+                if last_event_id is None or message["id"] > last_event_id
+            ]
+            self._subscribers.setdefault(session_id, []).append(subscriber)
+        return backlog
+
+    def _unsubscribe(self, session_id: str, subscriber: Any) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(session_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self._subscribers.pop(session_id, None)
+
+
+class _LoopQueue:
+    """Subscriber whose put() may be called from any thread and delivers onto an event loop"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, message: Dict[str, Any]) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+        except RuntimeError:
+            # The loop has shut down; the subscriber is about to be removed
+            pass
+
+
+def format_sse(message: Dict[str, Any]) -> str:
+    """Serialise an event record into the text/event-stream wire format"""
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+
+
+event_bus = EventBus(history_size=SSE_HISTORY_SIZE, max_sessions=SSE_MAX_SESSIONS)
+
+
+def publish(session_id: Optional[str], event: str, **data) -> None:
+    """Publish an event for a session on the shared event bus"""
+    event_bus.publish(session_id, event, data)
@@ -0,0 +1,408 @@
+"""
+LLM gateway: every model call made by the generation stages goes through here
+
+It picks the model of each stage, gives every call a deadline covering its retries, retries
+transient provider errors with jittered exponential backoff, spaces requests out with a
+per-provider token bucket, and fails fast through a per-provider circuit breaker while a
+provider keeps failing. Calls run either blocking or on an asyncio event loop.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar, Union
+
+from src.clients import llm, llm_options
+from src.concurrency import Overloaded
+from src.config import (
+    LLM_BREAKER_FAILURES,
+    LLM_BREAKER_RESET_SECONDS,
+    LLM_DEADLINE_SECONDS,
+    LLM_MAX_RETRIES,
+    LLM_MODEL,
+    LLM_RATE_BURST,
+    LLM_RATE_LIMITS,
+    LLM_RETRY_BASE_SECONDS,
+    LLM_RETRY_MAX_SECONDS,
+    LLM_STAGE_MODELS,
+    LLM_TIMEOUT_SECONDS,
+)
+from src.llm_cache import CachedResponse, llm_cache
+from src.metrics import LLM_REJECTED, LLM_RETRIES, current_stage
+from src.tracing import Span, span
+from src.usage import record_llm_call
+
+logger = logging.getLogger('image-to-manim')
+
+T = TypeVar("T")
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limiting and server-side failures
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# Exception class names of transient failures that carry no status code (timeouts, dropped connections)
+RETRYABLE_ERROR_NAMES = ("Timeout", "Connection", "RateLimit", "ServiceUnavailable", "InternalServer", "ServerError")
+
+
+class LLMUnavailable(Overloaded):
+    """Raised without calling the provider: its circuit is open, or its rate limit cannot be met before the deadline"""
+
+    def __init__(self, message: str, retry_after: int, reason: str):
+        super().__init__(message, retry_after, 503)
+        self.reason = reason
+
+
+def parse_pairs(spec: str) -> Dict[str, str]:
+    """Parse a "key=value,key=value" setting"""
+    pairs = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        key, _, value = item.partition("=")
+        pairs[key.strip()] = value.strip()
+    return pairs
+
+
+stage_models = parse_pairs(LLM_STAGE_MODELS)
+
+
+def model_for(stage: str) -> str:
+    """Return the model serving a stage: its LLM_STAGE_MODELS override, else LLM_MODEL"""
+    return stage_models.get(stage, LLM_MODEL)
+
+
+def provider_of(model: str) -> str:
+    """Return the provider a model is billed and rate limited by, e.g. "deepinfra" or "gemini" """
+    return model.split("/", 1)[0] if "/" in model else model.split("-", 1)[0]
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average, with bursts of up to `capacity`.
+
+    Callers reserve a token and wait until it is due, so waiting callers are served in order
+    and never spin.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> float:
+        """
+        Take a token and return how long to wait before using it
+
+        Raises:
+            LLMUnavailable: If the token would not be due within max_wait; nothing is taken
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                raise LLMUnavailable("LLM rate limit cannot be met before the call's deadline", int(wait) + 1, "rate_limited")
+            self._tokens -= 1
+            return wait
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            elapsed = time.monotonic() - self._updated
+            return {
+                "requests_per_minute": round(self.rate * 60, 1),
+                "burst": self.capacity,
+                "tokens": round(min(self.capacity, self._tokens + elapsed * self.rate), 2),
+            }
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after `failure_threshold` consecutive transient failures.
+
+    While open every call fails immediately. After `reset_seconds` one trial call is let
+    through; its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._opened = 0
+
+    def before_call(self) -> None:
+        """
+        Admit a call
+
+        Raises:
+            LLMUnavailable: If the circuit is open, or half-open with its trial call in flight
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_seconds - time.time()
+            if remaining > 0 or self._trial_in_flight:
+                raise LLMUnavailable("LLM provider is failing; not calling it for now", max(1, int(remaining) + 1), "circuit_open")
+            self._trial_in_flight = True
+
+    def cancel(self) -> None:
+        """Give back an admitted call that was not made, so a trial slot is not held forever"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            trial, self._trial_in_flight = self._trial_in_flight, False
+            if trial or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.time()
+                self._opened += 1
+
+    def stats(self) -> Dict[str, Union[str, int]]:
+        with self._lock:
+            if self._opened_at is None:
+                state = "closed"
+            elif time.time() < self._opened_at + self.reset_seconds:
+                state = "open"
+            else:
+                state = "half_open"
+            return {"state": state, "consecutive_failures": self._failures, "times_opened": self._opened}
+
+
+rate_limits = {provider: float(rpm) for provider, rpm in parse_pairs(LLM_RATE_LIMITS).items()}
+_buckets: Dict[str, TokenBucket] = {
+    provider: TokenBucket(rpm / 60, LLM_RATE_BURST) for provider, rpm in rate_limits.items() if rpm > 0
+}
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def _breaker(provider: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+        return breaker
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a failed call may succeed when retried"""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    return any(name in type(error).__name__ for name in RETRYABLE_ERROR_NAMES)
+
+
+def _admit(provider: str, deadline: float) -> float:
+    """Check the provider's circuit and take a rate limit token; returns the time to wait before calling"""
+    breaker = _breaker(provider)
+    bucket = _buckets.get(provider)
+    try:
+        breaker.before_call()
+        try:
+            return bucket.reserve(deadline - time.time()) if bucket else 0.0
+        except LLMUnavailable:
+            breaker.cancel()
+            raise
+    except LLMUnavailable as e:
+        LLM_REJECTED.labels(provider, e.reason).inc()
+        raise
+
+
+def _retry_delay(provider: str, error: Exception, attempt: int, deadline: float, streamed: bool) -> float:
+    """
+    Record a failed attempt and return the backoff before the next one
+
+    Raises:
+        Exception: The error itself when it is not retried (not transient, output already
+                   streamed to the caller, retries used up or no time left before the deadline)
+    """
+    breaker = _breaker(provider)
+    if not is_transient(error):
+        # The provider answered; the request itself was at fault
+        breaker.record_success()
+        raise error
+    breaker.record_failure()
+    delay = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+    if streamed or attempt >= LLM_MAX_RETRIES or time.time() + delay >= deadline:
+        raise error
+    LLM_RETRIES.labels(provider, type(error).__name__).inc()
+    logger.warning(f"LLM call to {provider} failed ({type(error).__name__}: {str(error)[:200]}); "
+                   f"retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+    return delay
+
+
+def call_with_policy(model: str, call: Callable[[float], T], streamed: Callable[[], bool] = lambda: False) -> T:
+    """
+    Run a provider call under the gateway's deadline, rate limit, retries and circuit breaker
+
+    Args:
+        model: Model being called; its provider selects the rate limit and circuit
+        call: Performs one attempt, given the timeout in seconds it must respect
+        streamed: Tells whether output already reached the caller, after which failures are not retried
+
+    Returns:
+        The result of the first successful attempt
+
+    Raises:
+        LLMUnavailable: If the circuit is open or the rate limit cannot be met in time
+        Exception: The last error of the provider call
+    """
+    provider = provider_of(model)
+    deadline = time.time() + LLM_DEADLINE_SECONDS
+    attempt = 0
+    while True:
+        time.sleep(_admit(provider, deadline))
+        try:
+            result = call(min(LLM_TIMEOUT_SECONDS, max(1.0, deadline - time.time())))
+        except Exception as e:
+            time.sleep(_retry_delay(provider, e, attempt, deadline, streamed()))
+            attempt += 1
+            continue
+        _breaker(provider).record_success()
+        return result
+
+
+async def acall_with_policy(
+    model: str, call: Callable[[float], Awaitable[T]], streamed: Callable[[], bool] = lambda: False
+) -> T:
+    """Async counterpart of call_with_policy; waits without blocking the event loop"""
+    provider = provider_of(model)
+    deadline = time.time() + LLM_DEADLINE_SECONDS
+    attempt = 0
+    while True:
+        await asyncio.sleep(_admit(provider, deadline))
+        try:
+            result = await call(min(LLM_TIMEOUT_SECONDS, max(1.0, deadline - time.time())))
+        except Exception as e:
+            await asyncio.sleep(_retry_delay(provider, e, attempt, deadline, streamed()))
+            attempt += 1
+            continue
+        _breaker(provider).record_success()
+        return result
+
+
+def gateway_stats() -> Dict[str, Any]:
+    """Return the circuit state and rate limit of every provider called so far"""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {
+        "models": {"default": LLM_MODEL, **stage_models},
+        "circuits": {provider: breaker.stats() for provider, breaker in breakers.items()},
+        "rate_limits": {provider: bucket.stats() for provider, bucket in _buckets.items()},
+    }
+
+
+def _stream_options(on_token: Optional[Callable[[str], None]]) -> Dict[str, Any]:
+    """Streaming flags for a request; streamed responses are asked to end with a usage chunk"""
+    if on_token is None:
+        return {"stream": False}
+    return {"stream": True, "stream_options": {"include_usage": True}}
+
+
+def _llm_span(request: Dict[str, Any], on_token: Optional[Callable[[str], None]]) -> Span:
+    return span("llm.completion", model=request.get("model"), stage=current_stage(), stream=on_token is not None)
+
+
+def _record_usage(request: Dict[str, Any], start: float, usage: Any, llm_span: Span) -> Tuple[Optional[int], Optional[int]]:
+    """Account for the latency, tokens and cost of a finished call (usage may be missing on some providers)"""
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    cost = record_llm_call(request.get("model", "unknown"), time.time() - start, prompt_tokens, completion_tokens)
+    llm_span.set_attribute("prompt_tokens", prompt_tokens)
+    llm_span.set_attribute("completion_tokens", completion_tokens)
+    llm_span.set_attribute("cost_usd", cost)
+    return prompt_tokens, completion_tokens
+
+
+def _cache_hit(cached: CachedResponse, on_token: Optional[Callable[[str], None]], llm_span: Span) -> str:
+    """Answer from the response cache: the text is forwarded whole, and no tokens are spent or counted"""
+    llm_span.set_attribute("cache", "hit")
+    if on_token is not None:
+        on_token(cached.text)
+    return cached.text
+
+
+def complete(request: Dict[str, Any], on_token: Optional[Callable[[str], None]] = None, use_cache: bool = True) -> str:
+    """
+    Run a completion request and return the generated text
+
+    Args:
+        request: Keyword arguments for litellm (model, messages, temperature, ...)
+        on_token: Optional callback receiving text chunks as they stream from the model
+        use_cache: Answer byte-identical requests from the LLM response cache and store new responses
+
+    Returns:
+        str: The full generated text
+    """
+    chunks = []
+
+    def attempt(timeout: float) -> Any:
+        response = llm().completion(**dict(llm_options(), timeout=timeout), **request, **_stream_options(on_token))
+        if on_token is None:
+            return getattr(response, "usage", None), response.choices[0].message.content
+
+        # Forward chunks as they arrive and assemble the full text
+        usage = None
+        for chunk in response:
+            usage = getattr(chunk, "usage", None) or usage
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                chunks.append(delta)
+                on_token(delta)
+        return usage, "".join(chunks)
+
+    with _llm_span(request, on_token) as llm_span:
+        stage = current_stage()
+        cached = llm_cache.get(request, stage) if use_cache else None
+        if cached is not None:
+            return _cache_hit(cached, on_token, llm_span)
+        start = time.time()
+        usage, text = call_with_policy(request["model"], attempt, streamed=lambda: bool(chunks))
+        response = CachedResponse(text, *_record_usage(request, start, usage, llm_span))
+        if use_cache:
+            llm_cache.put(request, stage, response)
+        return text
+
+
+async def acomplete(
+    request: Dict[str, Any], on_token: Optional[Callable[[str], None]] = None, use_cache: bool = True
+) -> str:
+    """Async counterpart of complete(), awaiting the model without holding a thread"""
+    chunks = []
+
+    async def attempt(timeout: float) -> Any:
+        response = await llm(is_async=True).acompletion(
+            **dict(llm_options(), timeout=timeout), **request, **_stream_options(on_token)
+        )
+        if on_token is None:
+            return getattr(response, "usage", None), response.choices[0].message.content
+
+        usage = None
+        async for chunk in response:
+            usage = getattr(chunk, "usage", None) or usage
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                chunks.append(delta)
+                on_token(delta)
+        return usage, "".join(chunks)
+
+    with _llm_span(request, on_token) as llm_span:
+        stage = current_stage()
+        cached = await asyncio.to_thread(llm_cache.get, request, stage) if use_cache else None
+        if cached is not None:
+            return _cache_hit(cached, on_token, llm_span)
+        start = time.time()
+        usage, text = await acall_with_policy(request["model"], attempt, streamed=lambda: bool(chunks))
+        response = CachedResponse(text, *_record_usage(request, start, usage, llm_span))
+        if use_cache:
+            await asyncio.to_thread(llm_cache.put, request, stage, response)
+        return text
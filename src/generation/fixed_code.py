@@ -1,32 +1,34 @@
-import os
 import re
-import litellm
+from typing import Any, Dict, Optional
 
-from src.config import (
-    DEEPINFRA_API_KEY,
-    MANIM_CODE_GUIDE
-)
+from src.config import FIX_RULES_ENABLED
+from src.generation.completion import LLMUnavailable, complete, model_for
+from src.generation.guide import manim_code_guide
+from src.generation.rule_fixes import apply_rule_fixes, count_fix
+from src.llm_cache import llm_cache
+from src.render.preflight import format_issues, validate_manim_code
+from src.tracing import current_span
 
-def fix_manim_code(previous_code: str, error_message: str, session_id: str) -> str:
+def fix_request(previous_code: str, error_message: str, guide_mode: Optional[str] = None) -> Dict[str, Any]:
     """
-    Regenerate Manim code based on previous code and error message
+    Build the completion request that fixes Manim code after a failed render
     
     Args:
         previous_code: Previous Manim code that failed
         error_message: Error message from the failed render
-        session_id: Session identifier for tracking
+        guide_mode: "retrieval" or "full" inclusion of the Manim code guide; defaults to MANIM_GUIDE_MODE
         
     Returns:
-        str: Fixed Manim code
+        dict: Keyword arguments for the completion call
     """
-    os.environ["DEEPINFRA_API_KEY"] = DEEPINFRA_API_KEY
+    # The guide sections that match the error (names, classes, LaTeX) are what the fix needs
+    MANIM_CODE_GUIDE = manim_code_guide(error_message[-5000:], guide_mode)
     
-    try:
-        response = litellm.completion(
-            model="deepinfra/meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8",
-            messages=[{
-                "role": "system",
-                "content": f"""
+    return dict(
+        model=model_for("fix"),
+        messages=[{
+            "role": "system",
+            "content": f"""
 <context>
 You are a Manim debugging specialist. Your expertise lies in identifying and fixing rendering errors in mathematical animations while preserving their educational value. You have access to the original code that failed and its error message.
 
@@ -72,21 +74,53 @@ IMPORTANT:
 {MANIM_CODE_GUIDE}
 </manim_code_guide_reference>
 """
-            }, {
-                "role": "user",
-                "content": f"""
+        }, {
+            "role": "user",
+            "content": f"""
                     ## FAILED MANIM CODE:
                     ```python
                     {previous_code}
                     ```
                     """
-            }],
-            temperature=0.2,
-            max_tokens=8192,
-        )
+        }],
+        temperature=0.2,
+        max_tokens=8192,
+    )
+
+def fix_manim_code(previous_code: str, error_message: str, session_id: str) -> str:
+    """
+    Regenerate Manim code based on previous code and error message
+    
+    Error signatures with a known fix are rewritten by rules first; the LLM is only called when
+    no rule applies, or for the problems left after the rules ran.
+    
+    Args:
+        previous_code: Previous Manim code that failed
+        error_message: Error message from the failed render
+        session_id: Session identifier for tracking
         
-        # Extract the content from the response
-        fixed_code = response.choices[0].message.content
+    Returns:
+        str: Fixed Manim code
+    """
+    rule_fix = apply_rule_fixes(previous_code, error_message) if FIX_RULES_ENABLED else None
+    if rule_fix:
+        remaining = validate_manim_code(rule_fix.code)
+        span = current_span()
+        if span is not None:
+            span.set_attribute("fix_rules", ",".join(rule_fix.rules))
+        if not remaining:
+            print(f"Fixed Manim code with rules: {', '.join(rule_fix.rules)}")
+            count_fix(error_message, "+".join(rule_fix.rules))
+            return rule_fix.code
+        print(f"Rules {', '.join(rule_fix.rules)} left {len(remaining)} problem(s) for the LLM fixer")
+        previous_code = rule_fix.code
+        fixed_error = format_issues(remaining)
+    else:
+        fixed_error = error_message
+
+    try:
+        request = fix_request(previous_code, fixed_error)
+        fixed_code = complete(request)
         
         # Extract code if it's wrapped in markdown code blocks
         if "```python" in fixed_code and "```" in fixed_code:
@@ -97,11 +131,15 @@ IMPORTANT:
         # Add comment with session id and retry information
         fixed_code = f"# Regenerated Manim code for session: {session_id}\n# Fixed version after rendering error\n\n{fixed_code}"
         
+        # If this code fails to render too, its cached response is dropped so the next attempt is not a replay
+        llm_cache.remember(fixed_code, request)
+        count_fix(error_message, "llm")
         print(f"Successfully regenerated Manim code based on error")
         return fixed_code
         
+    except LLMUnavailable:
+        raise
+        
     except Exception as e:
         print(f"Error regenerating Manim code: {str(e)}")
-        # If regeneration fails, return the original code
-        print("Returning original code due to regeneration failure")
-        return previous_code
+        raise Exception(f"Failed to regenerate Manim code: {str(e)}")
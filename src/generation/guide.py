@@ -0,0 +1,199 @@
+"""
+Retrieval over the Manim code guide, so codegen and fix prompts carry only the relevant sections
+
+The guide is split into its `##`/`###` sections and indexed with BM25 once per process. Each
+call ranks the sections against its query (the visual elements, or the render error) and takes
+the best ones that fit the token budget, in guide order.
+"""
+import functools
+import logging
+import math
+import re
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+
+from src.config import MANIM_GUIDE_MODE, MANIM_GUIDE_TOKEN_BUDGET, get_manim_code_guide
+from src.tracing import current_span
+
+logger = logging.getLogger('image-to-manim')
+
+_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+# Parts of identifiers: "MathTex" -> "Math", "Tex"; "set_color" is split on the underscore first
+_WORD_PART = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+_HEADING = re.compile(r"^(#{2,3})\s+(.+?)\s*$")
+
+STOPWORDS = frozenset("""
+a an and are as at be by can for from has have how if in into is it its of on or that the their
+then there these this to was were will with you your use used using self def return import none
+""".split())
+
+# Section titles count this many times, so a section named after a query term ranks above passing mentions
+TITLE_WEIGHT = 3
+# Sections that only list the others
+SKIPPED_SECTIONS = ("Table of Contents",)
+
+
+class GuideSection(NamedTuple):
+    """One `##` or `###` section of the guide; `###` sections remember their `##` parent"""
+    parent: Optional[str]
+    heading: str
+    text: str
+    tokens: int
+
+
+def approx_tokens(text: str) -> int:
+    """Estimate the token count of English text and code (about four characters per token)"""
+    return (len(text) + 3) // 4
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase search terms of a text: words and identifiers, plus the parts of compound identifiers"""
+    terms = []
+    for word in _WORD.findall(text):
+        lower = word.lower()
+        if len(lower) > 1 and lower not in STOPWORDS:
+            terms.append(lower)
+        parts = [part.lower() for chunk in word.split("_") for part in _WORD_PART.findall(chunk)]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1 and part not in STOPWORDS)
+    return terms
+
+
+def split_sections(guide: str) -> List[GuideSection]:
+    """Split the guide at its `##` and `###` headings; `#` comments inside code blocks are not headings"""
+    sections = []
+    top_level, parent, heading, lines = None, None, None, []
+    in_code = False
+
+    def close() -> None:
+        body = "\n".join(lines).strip()
+        if heading and body and heading not in SKIPPED_SECTIONS:
+            text = f"{'###' if parent else '##'} {heading}\n{body}"
+            sections.append(GuideSection(parent, heading, text, approx_tokens(text)))
+
+    for line in guide.splitlines():
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+        match = None if in_code else _HEADING.match(line)
+        if not match:
+            lines.append(line)
+            continue
+        close()
+        level, title = match.groups()
+        if level == "##":
+            parent, heading = None, title
+            top_level = title
+        else:
+            parent, heading = top_level, title
+        lines = []
+    close()
+    return sections
+
+
+class BM25Index:
+    """Okapi BM25 ranking over a fixed list of tokenized documents"""
+
+    def __init__(self, documents: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(document) for document in documents]
+        self.lengths = [len(document) for document in documents]
+        self.average_length = sum(self.lengths) / len(documents) if documents else 0.0
+        document_freqs = Counter(term for freqs in self.term_freqs for term in freqs)
+        count = len(documents)
+        self.idf: Dict[str, float] = {
+            term: math.log(1 + (count - freq + 0.5) / (freq + 0.5)) for term, freq in document_freqs.items()
+        }
+
+    def scores(self, query: List[str]) -> List[float]:
+        """Score every document against the query terms; repeated query terms count once"""
+        terms = [term for term in set(query) if term in self.idf]
+        scores = []
+        for freqs, length in zip(self.term_freqs, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self.average_length)
+            score = 0.0
+            for term in terms:
+                freq = freqs.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            scores.append(score)
+        return scores
+
+
+class GuideIndex:
+    """The guide's sections with a BM25 index over their titles and text"""
+
+    def __init__(self, guide: str):
+        self.sections = split_sections(guide)
+        self.index = BM25Index([
+            tokenize(section.heading) * TITLE_WEIGHT + tokenize(section.text) for section in self.sections
+        ])
+
+    def search(self, query: str, budget: int) -> List[GuideSection]:
+        """
+        Select the sections most relevant to a query
+
+        Args:
+            query: Text the sections should help with
+            budget: Most estimated tokens the selected sections may take together
+
+        Returns:
+            list: Matching sections in guide order; the best ones that fit, skipping any that would overflow
+        """
+        scores = self.index.scores(tokenize(query))
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        chosen, used = [], 0
+        for i in ranked:
+            if used + self.sections[i].tokens <= budget:
+                chosen.append(i)
+                used += self.sections[i].tokens
+        return [self.sections[i] for i in sorted(chosen)]
+
+
+def format_sections(sections: List[GuideSection]) -> str:
+    """Join sections into guide text, keeping the `##` heading above each group of `###` sections"""
+    parts, last_parent = [], None
+    for section in sections:
+        if section.parent and section.parent != last_parent:
+            parts.append(f"## {section.parent}")
+        last_parent = section.parent or section.heading
+        parts.append(section.text)
+    return "\n\n".join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def guide_index() -> GuideIndex:
+    """Build the guide index once per process"""
+    return GuideIndex(get_manim_code_guide())
+
+
+def manim_code_guide(query: str, mode: Optional[str] = None, budget: Optional[int] = None) -> str:
+    """
+    Return the guide text to include in a prompt
+
+    Args:
+        query: What the call is about: visual element specifications or a render error
+        mode: "retrieval" or "full"; defaults to MANIM_GUIDE_MODE
+        budget: Estimated token budget of retrieved sections; defaults to MANIM_GUIDE_TOKEN_BUDGET
+
+    Returns:
+        str: The whole guide, or the sections relevant to the query
+    """
+    mode = mode or MANIM_GUIDE_MODE
+    if mode == "full":
+        guide = get_manim_code_guide()
+        sections = None
+    else:
+        sections = guide_index().search(query, budget or MANIM_GUIDE_TOKEN_BUDGET)
+        guide = format_sections(sections)
+    span = current_span()
+    if span is not None:
+        span.set_attribute("guide_mode", mode)
+        span.set_attribute("guide_tokens", approx_tokens(guide))
+        if sections is not None:
+            span.set_attribute("guide_sections", len(sections))
+    return guide
+
+
+if MANIM_GUIDE_MODE not in ("retrieval", "full"):
+    logger.warning(f"Unknown MANIM_GUIDE_MODE '{MANIM_GUIDE_MODE}', retrieving guide sections")
@@ -1,26 +1,27 @@
-import os
 import re
-import litellm
-from typing import Optional
+from typing import Any, Dict, Optional
 
-from src.config import (
-    DEEPINFRA_API_KEY,
-    MANIM_CODE_GUIDE,
-)
+from src.generation.completion import LLMUnavailable, complete, model_for
+from src.generation.guide import manim_code_guide
+from src.llm_cache import llm_cache
 
-def generate_manim_code(visual_elements: str, improvements: Optional[str] = None, session_id: str = None) -> str:
+def codegen_request(
+    visual_elements: str, improvements: Optional[str] = None, guide_mode: Optional[str] = None, temperature: float = 0.2
+) -> Dict[str, Any]:
     """
-    Generate Manim code from visual element specifications with strict adherence to timing, positioning and element management
+    Build the completion request that turns visual element specifications into Manim code
     
     Args:
         visual_elements: Visual element specifications to implement
         improvements: Optional feedback for improvements
-        session_id: Session identifier for tracking
+        guide_mode: "retrieval" or "full" inclusion of the Manim code guide; defaults to MANIM_GUIDE_MODE
+        temperature: Sampling temperature; low by default for reliable output
         
     Returns:
-        str: Generated Manim code
+        dict: Keyword arguments for the completion call
     """
-    os.environ["DEEPINFRA_API_KEY"] = DEEPINFRA_API_KEY
+    # Only the guide sections relevant to these visuals (and the feedback) go into the prompt
+    MANIM_CODE_GUIDE = manim_code_guide(f"{visual_elements}\n{improvements or ''}", guide_mode)
     
     # Prepare improvements section if improvements are provided
     improvements_section = f"""
@@ -87,12 +88,11 @@ def generate_manim_code(visual_elements: str, improvements: Optional[str] = None
     </verification_steps>
     """ if improvements else ""
     
-    try:
-        response = litellm.completion(
-            model="deepinfra/meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8",
-            messages=[{
-                "role": "system",
-                "content": f"""
+    return dict(
+        model=model_for("codegen"),
+        messages=[{
+            "role": "system",
+            "content": f"""
                 <context>
                 You are an expert Manim developer specializing in educational animations. Your task is to generate complete, production-ready Manim code from visual elements specifications.
                 </context>
@@ -338,7 +338,7 @@ def generate_manim_code(visual_elements: str, improvements: Optional[str] = None
                 
                 # Pattern 2: Relative positioning
                 obj2.next_to(obj1, RIGHT)
-                obj3.beside(obj2, DOWN)
+                obj3.next_to(obj2, DOWN)
                 ```
 
                 3. Cleanup Patterns:
@@ -423,20 +423,42 @@ def generate_manim_code(visual_elements: str, improvements: Optional[str] = None
                 </content>
                 </manim_code_guide>
                 """
-            },
-            {
-                "role": "user",
-                "content": "## VISUAL ELEMENTS: \n" + visual_elements
-            }],
-            temperature=0.2,  # Lower temperature for more reliable output
-            max_tokens=8192,
-        )
+        },
+        {
+            "role": "user",
+            "content": "## VISUAL ELEMENTS: \n" + visual_elements
+        }],
+        temperature=temperature,
+        max_tokens=8192,
+    )
+
+def generate_manim_code(
+    visual_elements: str,
+    improvements: Optional[str] = None,
+    session_id: str = None,
+    temperature: float = 0.2,
+    use_cache: bool = True,
+) -> str:
+    """
+    Generate Manim code from visual element specifications with strict adherence to timing, positioning and element management
+    
+    Args:
+        visual_elements: Visual element specifications to implement
+        improvements: Optional feedback for improvements
+        session_id: Session identifier for tracking
+        temperature: Sampling temperature (speculative candidates use several)
+        use_cache: Whether an identical earlier request may be answered from the LLM response cache
         
+    Returns:
+        str: Generated Manim code
+    """
+    try:
+        request = codegen_request(visual_elements, improvements, temperature=temperature)
+        manim_code = complete(request, use_cache=use_cache)
         
-        manim_code = response.choices[0].message.content
         # Extract content after </think>
         if "</think>" in manim_code:
-            manim_code = response.choices[0].message.content.split("</think>")[1].strip()
+            manim_code = manim_code.split("</think>")[1].strip()
         
         # Extract code if it's wrapped in markdown code blocks
         if "```python" in manim_code and "```" in manim_code:
@@ -449,9 +471,14 @@ def generate_manim_code(visual_elements: str, improvements: Optional[str] = None
         
         # Add comment with session id
         manim_code = f"# Generated Manim code for session: {session_id}\n\n{manim_code}"
+        # If this code fails to render, its cached response is dropped so a retry gets new code
+        llm_cache.remember(manim_code, request)
             
         return manim_code
         
+    except LLMUnavailable:
+        raise
+        
     except Exception as e:
         print(f"Error generating Manim code: {str(e)}")
         raise Exception(f"Failed to generate Manim code: {str(e)}")
@@ -1,44 +1,30 @@
-import os
-import re
 import base64
 from io import BytesIO
-import litellm
-from PIL import Image
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
-from src.config import (
-    DEEPINFRA_API_KEY
-)
+from src.generation.completion import LLMUnavailable, acomplete, complete, model_for
 
-def generate_problem_analysis(image: Image.Image) -> str:
+if TYPE_CHECKING:
+    from PIL import Image
+
+def analysis_request(image_data: bytes, mime_type: str = "image/jpeg") -> Dict[str, Any]:
     """
-    Generate problem analysis from image
+    Build the completion request that analyzes the problem shown in an image
     
     Args:
-        image: PIL Image object containing the math problem
+        image_data: Encoded image bytes
+        mime_type: MIME type of image_data
         
     Returns:
-        str: Structured analysis of the mathematical problem
+        dict: Keyword arguments for the completion call
     """
-    # Convert image to base64 preserving its format
-    buffered = BytesIO()
-    img_format = image.format if image.format else "JPEG"
-    image.save(buffered, format=img_format)
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    img_str = base64.b64encode(image_data).decode()
     
-    # Determine the MIME type for the base64 string
-    mime_type = f"image/{img_format.lower()}"
-    if mime_type == "image/jpg":
-        mime_type = "image/jpeg"
-    
-    os.environ["DEEPINFRA_API_KEY"] = DEEPINFRA_API_KEY
-    
-    try:
-        response = litellm.completion(
-            model = "deepinfra/meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8",
-            messages=[{
-                "role": "system",
-                "content": f"""
+    return dict(
+        model = model_for("analysis"),
+        messages=[{
+            "role": "system",
+            "content": f"""
                     <context>
                     You are a world-class mathematical educator with expertise in analysing math problems. Your analysis will be used to generate educational content that makes complex mathematical concepts accessible while maintaining rigorous accuracy.
 
@@ -152,26 +138,66 @@ def generate_problem_analysis(image: Image.Image) -> str:
                        - Solutions must match exactly what's shown in the image
                     </constraints>
                     """
-                    ,
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:{mime_type};base64," + img_str,
-                    },
-                }
-                ]
-            }],
-            temperature=0.4,
-            max_tokens=8192,
-        )
+                ,
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{mime_type};base64," + img_str,
+                },
+            }
+            ]
+        }],
+        temperature=0.4,
+        max_tokens=8192,
+    )
+
+def generate_problem_analysis(
+    image: Optional["Image.Image"] = None, image_data: Optional[bytes] = None, mime_type: str = "image/jpeg"
+) -> str:
+    """
+    Generate problem analysis from image
+    
+    Args:
+        image: PIL Image object containing the math problem
+        image_data: Already-encoded image bytes, sent as-is instead of re-encoding `image`
+        mime_type: MIME type of image_data
+        
+    Returns:
+        str: Structured analysis of the mathematical problem
+    """
+    if image_data is None:
+        # Convert image to base64 preserving its format
+        buffered = BytesIO()
+        img_format = image.format if image.format else "JPEG"
+        image.save(buffered, format=img_format)
+        image_data = buffered.getvalue()
+        
+        # Determine the MIME type for the base64 string
+        mime_type = f"image/{img_format.lower()}"
+        if mime_type == "image/jpg":
+            mime_type = "image/jpeg"
+    
+    try:
+        return complete(analysis_request(image_data, mime_type))
+        
+    except LLMUnavailable:
+        raise
+        
+    except Exception as e:
+        print(f"Error generating problem analysis: {str(e)}")
+        raise Exception(f"Failed to generate problem analysis: {str(e)}")
+
+async def agenerate_problem_analysis(image_data: bytes, mime_type: str = "image/jpeg") -> str:
+    """Async counterpart of generate_problem_analysis for already-encoded images, for the ASGI server"""
+    try:
+        return await acomplete(analysis_request(image_data, mime_type))
         
-        # Extract the content from the response
-        analysis = response.choices[0].message.content
-        return analysis
+    except LLMUnavailable:
+        raise
         
     except Exception as e:
         print(f"Error generating problem analysis: {str(e)}")
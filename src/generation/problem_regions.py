@@ -0,0 +1,123 @@
+import re
+import json
+import base64
+from typing import Any, Dict, List, Union
+
+from src.generation.completion import LLMUnavailable, acomplete, complete, model_for
+
+def parse_problem_regions(response_text: str) -> List[Dict[str, Union[str, List[float]]]]:
+    """
+    Extract problem regions from the model's JSON answer
+
+    Args:
+        response_text: Model output holding a JSON object, optionally inside a code fence
+
+    Returns:
+        list: Regions as {"label": str, "box": [left, top, right, bottom]} with coordinates in 0-1,
+              sorted in reading order; boxes that are malformed or too small are dropped
+    """
+    match = re.search(r"\{.*\}", response_text, re.DOTALL)
+    if not match:
+        raise ValueError("No JSON object found in problem region response")
+    data = json.loads(match.group(0))
+
+    regions = []
+    for index, region in enumerate(data.get("problems", [])):
+        try:
+            left, top, right, bottom = (min(max(float(v), 0.0), 1.0) for v in region["box"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        # Ignore degenerate boxes, e.g. a stray problem number detected on its own
+        if right - left < 0.05 or bottom - top < 0.03:
+            continue
+        regions.append({"label": str(region.get("label") or index + 1), "box": [left, top, right, bottom]})
+
+    return sorted(regions, key=lambda r: (round(r["box"][1], 2), r["box"][0]))
+
+def regions_request(image_data: bytes, mime_type: str = "image/jpeg") -> Dict[str, Any]:
+    """
+    Build the completion request that locates the separate problems on a worksheet image
+
+    Args:
+        image_data: Encoded image bytes of the worksheet
+        mime_type: MIME type of image_data
+
+    Returns:
+        dict: Keyword arguments for the completion call
+    """
+    img_str = base64.b64encode(image_data).decode()
+
+    return dict(
+        model = model_for("regions"),
+        messages=[{
+            "role": "system",
+            "content": """
+                    <task>
+                    You are given a photo or scan of a math worksheet. Identify every separate problem on it
+                    and return the bounding box of each one.
+                    </task>
+
+                    <format>
+                    Respond with JSON only, in exactly this shape:
+                    {"problems": [{"label": "1", "box": [left, top, right, bottom]}]}
+
+                    - label: the problem number or letter as printed, or its position if unnumbered
+                    - box: fractions of the image width and height between 0 and 1
+                    </format>
+
+                    <constraints>
+                    - Each box must contain the whole problem: its statement, figures, tables and answer choices
+                    - Sub-parts (a, b, c) of one numbered problem belong to the same box
+                    - Exclude page headers, names, dates, instructions that apply to every problem and page numbers
+                    - Leave a small margin around each problem; boxes must not overlap
+                    - If the image holds a single problem, return one box covering it
+                    </constraints>
+                    """,
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{mime_type};base64," + img_str,
+                },
+            }
+            ]
+        }],
+        temperature=0.0,
+        max_tokens=2048,
+    )
+
+def detect_problem_regions(image_data: bytes, mime_type: str = "image/jpeg") -> str:
+    """
+    Locate the separate problems on a worksheet image
+
+    Args:
+        image_data: Encoded image bytes of the worksheet
+        mime_type: MIME type of image_data
+
+    Returns:
+        str: JSON answer of the model, to be read with parse_problem_regions
+    """
+    try:
+        return complete(regions_request(image_data, mime_type))
+
+    except LLMUnavailable:
+        raise
+
+    except Exception as e:
+        print(f"Error detecting problem regions: {str(e)}")
+        raise Exception(f"Failed to detect problem regions: {str(e)}")
+
+async def adetect_problem_regions(image_data: bytes, mime_type: str = "image/jpeg") -> str:
+    """Async counterpart of detect_problem_regions, for the ASGI server"""
+    try:
+        return await acomplete(regions_request(image_data, mime_type))
+
+    except LLMUnavailable:
+        raise
+
+    except Exception as e:
+        print(f"Error detecting problem regions: {str(e)}")
+        raise Exception(f"Failed to detect problem regions: {str(e)}")
@@ -6,16 +6,22 @@ import requests
 import time
 from io import BytesIO
 from typing import Dict, List, Union, Optional
-from google import genai
-from google.genai import types
-from src.config import GEMINI_API_KEY, VIDEO_QUALITY_STANDARDS
+from src.clients import gemini_client, http_session
+from src.config import get_video_quality_standards
+from src.generation.completion import call_with_policy, model_for
+from src.metrics import count_storage_bytes
+from src.tracing import span
+from src.usage import record_llm_call
 
-def review_video(video_url: str) -> Dict[str, Union[int, Dict[str, List[str]], str, bool, float]]:
+def review_video(
+    video_url: str, video_data: Optional[bytes] = None
+) -> Dict[str, Union[int, Dict[str, List[str]], str, bool, float]]:
     """
     Review the video and provide structured feedback with scoring
     
     Args:
         video_url: URL to the video file to be reviewed
+        video_data: Video bytes already at hand (e.g. from local storage), used instead of downloading video_url
         
     Returns:
         Dict containing:
@@ -27,49 +33,58 @@ def review_video(video_url: str) -> Dict[str, Union[int, Dict[str, List[str]], s
     """
     MAX_VIDEO_SIZE = 20 * 1024 * 1024  # 20MB limit for Gemini
     DOWNLOAD_TIMEOUT = 60  # 60 seconds timeout for download
-    API_TIMEOUT = 90  # 90 seconds timeout for API call
     
     try:
         print(f"Starting video review for: {video_url}")
         start_time = time.time()
         
-        # Download the video file with size limit and timeout
-        try:
-            response = requests.get(
-                video_url, 
-                stream=True, 
-                timeout=DOWNLOAD_TIMEOUT,
-                headers={'User-Agent': 'ManimReviewAgent/1.0'}
-            )
-            response.raise_for_status()  # Raise exception for 4XX/5XX status codes
+        if video_data is not None:
+            if len(video_data) > MAX_VIDEO_SIZE:
+                raise ValueError(f"Video size ({len(video_data)/1024/1024:.2f}MB) exceeds maximum allowed size (20MB)")
+            if len(video_data) == 0:
+                raise ValueError("Stored video is empty")
+            video_bytes = bytes(video_data)
+        else:
+            # Download the video file with size limit and timeout
+            try:
+                response = http_session().get(
+                    video_url, 
+                    stream=True, 
+                    timeout=DOWNLOAD_TIMEOUT,
+                    headers={'User-Agent': 'ManimReviewAgent/1.0'}
+                )
+                response.raise_for_status()  # Raise exception for 4XX/5XX status codes
             
-            content_length = int(response.headers.get('content-length', 0))
-            if content_length > MAX_VIDEO_SIZE:
-                raise ValueError(f"Video size ({content_length/1024/1024:.2f}MB) exceeds maximum allowed size (20MB)")
+                content_length = int(response.headers.get('content-length', 0))
+                if content_length > MAX_VIDEO_SIZE:
+                    raise ValueError(f"Video size ({content_length/1024/1024:.2f}MB) exceeds maximum allowed size (20MB)")
             
-            video_content = BytesIO()
-            downloaded_size = 0
+                video_content = BytesIO()
+                downloaded_size = 0
             
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    downloaded_size += len(chunk)
-                    if downloaded_size > MAX_VIDEO_SIZE:
-                        raise ValueError(f"Video download size exceeded maximum allowed size (20MB)")
-                    video_content.write(chunk)
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk:
+                        downloaded_size += len(chunk)
+                        if downloaded_size > MAX_VIDEO_SIZE:
+                            raise ValueError(f"Video download size exceeded maximum allowed size (20MB)")
+                        video_content.write(chunk)
             
-            if downloaded_size == 0:
-                raise ValueError("Downloaded video is empty")
+                if downloaded_size == 0:
+                    raise ValueError("Downloaded video is empty")
                 
-            video_content.seek(0)  # Reset buffer position to the start
-            video_bytes = video_content.read()  # Read entire content into memory
+                video_content.seek(0)  # Reset buffer position to the start
+                video_bytes = video_content.read()  # Read entire content into memory
+                count_storage_bytes("in", downloaded_size)
             
-        except requests.exceptions.RequestException as e:
-            raise ValueError(f"Error downloading video: {str(e)}")
+            except requests.exceptions.RequestException as e:
+                raise ValueError(f"Error downloading video: {str(e)}")
         
-        print(f"Video download completed ({downloaded_size/1024/1024:.2f}MB in {time.time()-start_time:.2f}s)")
+            print(f"Video download completed ({downloaded_size/1024/1024:.2f}MB in {time.time()-start_time:.2f}s)")
         
-        # Initialize the Gemini API client
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        # Shared Gemini client (its timeout is GEMINI_TIMEOUT_SECONDS); the SDK is imported on first use
+        from google.genai import types
+        client = gemini_client()
+        VIDEO_QUALITY_STANDARDS = get_video_quality_standards()
         
         # Optimized review prompt with clear structure and evaluation criteria
         review_prompt = f"""
@@ -224,22 +239,35 @@ def review_video(video_url: str) -> Dict[str, Union[int, Dict[str, List[str]], s
         
         # Make the API call to review the video with timeout handling
         try:
-            response = client.models.generate_content(
-                model='models/gemini-2.0-flash',
-                contents=types.Content(
-                    parts=[
-                        types.Part(
-                            inline_data=types.Blob(
-                                data=video_bytes,
-                                mime_type='video/mp4'
-                            )
-                        ),
-                        types.Part(text=review_prompt)
-                    ]
-                )
+            model = model_for("review")
+            contents = types.Content(
+                parts=[
+                    types.Part(
+                        inline_data=types.Blob(
+                            data=video_bytes,
+                            mime_type='video/mp4'
+                        )
+                    ),
+                    types.Part(text=review_prompt)
+                ]
             )
+            with span("llm.review", model=model, video_bytes=len(video_bytes)) as review_span:
+                response = call_with_policy(model, lambda timeout: client.models.generate_content(
+                    model=f'models/{model}',
+                    contents=contents,
+                    config=types.GenerateContentConfig(http_options=types.HttpOptions(timeout=int(timeout * 1000)))
+                ))
             
-            review_text = response.text
+                review_text = response.text
+                usage = getattr(response, "usage_metadata", None)
+                record_llm_call(
+                    model,
+                    time.time() - api_start_time,
+                    getattr(usage, "prompt_token_count", None),
+                    getattr(usage, "candidates_token_count", None),
+                )
+                review_span.set_attribute("prompt_tokens", getattr(usage, "prompt_token_count", None))
+                review_span.set_attribute("completion_tokens", getattr(usage, "candidates_token_count", None))
             print("\nVideo review completed successfully")
             
         except Exception as api_error:
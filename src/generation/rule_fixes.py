@@ -0,0 +1,414 @@
+"""
+Deterministic fixes for recurring render and check failures, tried before the LLM fixer
+
+Each rule pairs an error signature (a regex over the error text) with a rewrite of the code.
+Rewrites find their targets with `ast` and edit only those spans of the source, so comments and
+formatting survive. Every fix is written to a log of error signatures; the signatures that
+keep reaching the LLM are the ones to add rules for.
+"""
+import ast
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Union
+
+from src.config import FIX_LOG_PATH, FIX_RULE_RENAMES
+from src.metrics import CODE_FIXES, error_class
+
+logger = logging.getLogger('image-to-manim')
+
+# Names from manimgl and older Manim versions, and what manim 0.19 calls them
+RENAMED_NAMES = {
+    "ShowCreation": "Create",
+    "TextMobject": "Tex",
+    "TexText": "Tex",
+    "OldTexText": "Tex",
+    "TexMobject": "MathTex",
+    "OldTex": "MathTex",
+    "ParametricSurface": "Surface",
+    "CircleIndicate": "Circumscribe",
+    "WiggleOutThenIn": "Wiggle",
+    "SmallDot": "Dot",
+    "FRAME_WIDTH": "config.frame_width",
+    "FRAME_HEIGHT": "config.frame_height",
+    "FRAME_X_RADIUS": "config.frame_x_radius",
+    "FRAME_Y_RADIUS": "config.frame_y_radius",
+}
+RENAMED_METHODS = {
+    "beside": "next_to",
+    "get_graph": "plot",
+}
+# Modules generated code uses under a conventional name without importing them
+MODULE_IMPORTS = {
+    "np": "import numpy as np",
+    "math": "import math",
+    "random": "import random",
+}
+TEX_CLASSES = frozenset({"MathTex", "Tex", "SingleStringMathTex", "Title", "BulletedList"})
+# Characters a LaTeX command turns into when its backslash is read as a Python escape ("\frac" -> form feed + "rac")
+TEX_ESCAPES = {"\a": "\\a", "\b": "\\b", "\f": "\\f", "\r": "\\r", "\t": "\\t", "\v": "\\v"}
+
+_ERROR_LINE = re.compile(r"^\s*(?:[\w.]+\.)?(\w+(?:Error|Exception)): (.+)$", re.MULTILINE)
+
+
+class FixRule(NamedTuple):
+    """An error signature and the rewrite that fixes code failing with it"""
+    name: str
+    signature: "re.Pattern[str]"
+    # (code, tree, match) -> fixed code, or None when the rule does not apply to this code
+    rewrite: Callable[[str, ast.Module, "re.Match[str]"], Optional[str]]
+
+
+class RuleFix(NamedTuple):
+    """Code rewritten by rules, and the names of the rules that changed it"""
+    code: str
+    rules: List[str]
+
+
+class SourceEdits:
+    """Replacements of source spans given as ast positions (1-based lines, UTF-8 byte columns)"""
+
+    def __init__(self, code: str):
+        self._data = code.encode("utf-8")
+        self._starts = [0]
+        for line in self._data.split(b"\n")[:-1]:
+            self._starts.append(self._starts[-1] + len(line) + 1)
+        self._edits = []
+
+    def offset(self, line: int, col: int) -> int:
+        return self._starts[line - 1] + col
+
+    def replace(self, start: int, end: int, text: str) -> None:
+        self._edits.append((start, end, text.encode("utf-8")))
+
+    def replace_node(self, node: ast.AST, text: str) -> None:
+        self.replace(self.offset(node.lineno, node.col_offset), self.offset(node.end_lineno, node.end_col_offset), text)
+
+    def segment(self, start: int, end: int) -> str:
+        return self._data[start:end].decode("utf-8")
+
+    def apply(self) -> Optional[str]:
+        """The edited source, or None if there were no edits; overlapping edits after the first are dropped"""
+        if not self._edits:
+            return None
+        data, last_start = self._data, len(self._data) + 1
+        for start, end, text in sorted(set(self._edits), reverse=True):
+            if end <= last_start:
+                data = data[:start] + text + data[end:]
+                last_start = start
+        return data.decode("utf-8")
+
+
+def _insert_import(code: str, statement: str) -> Optional[str]:
+    if re.search(rf"^{re.escape(statement)}\s*$", code, re.MULTILINE):
+        return None
+    return f"{statement}\n{code}"
+
+
+def _rename_name(code: str, tree: ast.Module, match: "re.Match[str]") -> Optional[str]:
+    """ShowCreation(...) -> Create(...), FRAME_WIDTH -> config.frame_width"""
+    replacement = {**RENAMED_NAMES, **_parse_renames(FIX_RULE_RENAMES)}.get(match.group("name"))
+    if replacement is None:
+        return None
+    edits = SourceEdits(code)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == match.group("name"):
+            edits.replace_node(node, replacement)
+        elif isinstance(node, ast.alias) and node.name == match.group("name") and "." not in replacement:
+            edits.replace_node(node, replacement if node.asname is None else f"{replacement} as {node.asname}")
+    return edits.apply()
+
+
+def _add_manim_import(code: str, tree: ast.Module, match: "re.Match[str]") -> Optional[str]:
+    """A manim name used without importing manim"""
+    return _insert_import(code, "from manim import *")
+
+
+def _add_module_import(code: str, tree: ast.Module, match: "re.Match[str]") -> Optional[str]:
+    """np.sin(...) without `import numpy as np`"""
+    statement = MODULE_IMPORTS.get(match.group("name"))
+    return _insert_import(code, statement) if statement else None
+
+
+def _rename_method(code: str, tree: ast.Module, match: "re.Match[str]") -> Optional[str]:
+    """obj.beside(other, DOWN) -> obj.next_to(other, DOWN); axes.get_graph(f) -> axes.plot(f)"""
+    method = match.group("method") or match.group("called")
+    replacement = RENAMED_METHODS.get(method)
+    if replacement is None:
+        return None
+    edits = SourceEdits(code)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr == method:
+            end = edits.offset(node.end_lineno, node.end_col_offset)
+            edits.replace(end - len(method.encode("utf-8")), end, replacement)
+    return edits.apply()
+
+
+def _call_name(node: ast.Call) -> Optional[str]:
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+
+def _fix_keyword(code: str, tree: ast.Module, match: "re.Match[str]") -> Optional[str]:
+    """Circle(stroke_widht=4) -> Circle(stroke_width=4); a keyword with no close match is dropped"""
+    callee, keyword, suggestion = match.group("callee", "keyword", "suggestion")
+    edits = SourceEdits(code)
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or _call_name(node) != callee:
+            continue
+        for argument in node.keywords:
+            if argument.arg != keyword:
+                continue
+            start = edits.offset(argument.lineno, argument.col_offset)
+            end = edits.offset(argument.end_lineno, argument.end_col_offset)
+            if suggestion:
+                edits.replace(start, start + len(keyword.encode("utf-8")), suggestion)
+                continue
+            # Take the comma after the argument with it, or else the one before
+            following = re.match(r"\s*,\s*", edits.segment(end, edits.offset(node.end_lineno, node.end_col_offset)))
+            if following:
+                edits.replace(start, end + len(following.group(0).encode("utf-8")), "")
+            else:
+                preceding = re.search(r",\s*$", edits.segment(edits.offset(node.lineno, node.col_offset), start))
+                edits.replace(start - len(preceding.group(0).encode("utf-8")) if preceding else start, end, "")
+    return edits.apply()
+
+
+def _raw_tex(code: str, tree: ast.Module, match: "re.Match[str]") -> Optional[str]:
+    """MathTex("\\frac{1}{2}") written with one backslash -> MathTex(r"\\frac{1}{2}")"""
+    edits = SourceEdits(code)
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or _call_name(node) not in TEX_CLASSES:
+            continue
+        for argument in node.args:
+            if not isinstance(argument, ast.Constant) or not isinstance(argument.value, str):
+                continue
+            value = argument.value
+            restored = re.sub(r"\n(?=[A-Za-z])", r"\\n", "".join(TEX_ESCAPES.get(char, char) for char in value))
+            if restored == value or "\n" in restored or restored.endswith("\\"):
+                continue
+            quote = '"' if '"' not in restored else "'"
+            if quote in restored:
+                continue
+            edits.replace_node(argument, f"r{quote}{restored}{quote}")
+    return edits.apply()
+
+
+def _rename_scene(code: str, tree: ast.Module, match: "re.Match[str]") -> Optional[str]:
+    """A scene the renderer cannot find (class Solution(MovingCameraScene)) is renamed to the one it renders"""
+    scenes = [name.strip() for name in match.group("scenes").split(",")]
+    if len(scenes) != 1 or re.search(r"\bEducationalScene\b", code):
+        return None
+    edits = SourceEdits(code)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef) and node.name == scenes[0]:
+            start = edits.offset(node.lineno, node.col_offset)
+            name = re.search(rf"class\s+{scenes[0]}\b", edits.segment(start, start + 200 + len(scenes[0])))
+            if name:
+                end = start + name.end()
+                edits.replace(end - len(scenes[0].encode("utf-8")), end, "EducationalScene")
+        elif isinstance(node, ast.Name) and node.id == scenes[0]:
+            edits.replace_node(node, "EducationalScene")
+    return edits.apply()
+
+
+RULES: List[FixRule] = [
+    FixRule("renamed_name", re.compile(r"NameError: name '(?P<name>\w+)' is not defined"), _rename_name),
+    FixRule("renamed_name", re.compile(r"ImportError: cannot import name '(?P<name>\w+)' from 'manim'"), _rename_name),
+    FixRule("manim_import", re.compile(r"NameError: name '\w+' is not defined; it is part of manim"), _add_manim_import),
+    FixRule("module_import", re.compile(r"NameError: name '(?P<name>\w+)' is not defined"), _add_module_import),
+    FixRule(
+        "renamed_method",
+        re.compile(r"has no attribute '(?P<method>\w+)'|\.(?P<called>get_graph)\("),
+        _rename_method,
+    ),
+    FixRule(
+        "unexpected_keyword",
+        re.compile(
+            r"(?P<callee>\w+)\(\) got an unexpected keyword argument '(?P<keyword>\w+)'"
+            r"(?:\. Did you mean: '(?P<suggestion>\w+)'\?)?"
+        ),
+        _fix_keyword,
+    ),
+    FixRule(
+        "raw_tex",
+        re.compile(r"latex error|LaTeX Error|Undefined control sequence|Missing \$ inserted", re.IGNORECASE),
+        _raw_tex,
+    ),
+    FixRule("scene_name", re.compile(r"SceneError: the renderer renders .*?declare the main scene \((?P<scenes>[^)]*)\)"), _rename_scene),
+]
+
+
+def _parse_renames(spec: str) -> Dict[str, str]:
+    """Parse a "Old=New,..." setting"""
+    renames = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        old, _, new = item.partition("=")
+        renames[old.strip()] = new.strip()
+    return renames
+
+
+def apply_rule_fixes(code: str, error_message: str) -> Optional[RuleFix]:
+    """
+    Rewrite code with every rule whose signature matches the error
+
+    Args:
+        code: Code that failed to render or to pass the pre-render check
+        error_message: The error it failed with
+
+    Returns:
+        RuleFix: The rewritten code and the rules that changed it; None if no rule applied
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    applied: List[str] = []
+    for rule in RULES:
+        for match in rule.signature.finditer(error_message):
+            try:
+                fixed = rule.rewrite(code, tree, match)
+                if fixed is None or fixed == code:
+                    continue
+                tree = ast.parse(fixed)
+            except Exception as e:
+                logger.warning(f"Fix rule {rule.name} failed: {str(e)}")
+                continue
+            code = fixed
+            if rule.name not in applied:
+                applied.append(rule.name)
+    return RuleFix(code, applied) if applied else None
+
+
+def error_signatures(error_message: str) -> List[str]:
+    """
+    Reduce an error to the signatures it is logged under: each distinct "SomeError: message" line,
+    with line numbers, paths, addresses and numbers replaced so recurrences share a signature
+    """
+    lines = [f"{kind}: {message}" for kind, message in _ERROR_LINE.findall(error_message or "")]
+    if not lines:
+        last = next((line.strip() for line in reversed((error_message or "").splitlines()) if line.strip()), "")
+        lines = [f"{error_class(error_message)}: {last}"]
+    signatures = []
+    for line in lines:
+        line = re.sub(r" \(line \d+\)$", "", line)
+        line = re.sub(r"(?:/[\w.-]+)+", "<path>", line)
+        line = re.sub(r"0x[0-9a-fA-F]+", "<address>", line)
+        line = re.sub(r"(?<![\w'])\d+(?:\.\d+)?", "N", line)[:200]
+        if line not in signatures:
+            signatures.append(line)
+    return signatures[:10]
+
+
+class FixLog:
+    """
+    The error signatures fixes were made for, in a SQLite file, with counts of how each was fixed
+
+    Signatures often seen but never fixed by a rule are the candidates for new rules. The file
+    and its table are created on first use.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._fixers: Dict[str, int] = {}
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self._created = False
+
+    def _after_fork(self) -> None:
+        self._init_state()
+
+    def _create(self) -> None:
+        with self._create_lock:
+            if self._created:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            with sqlite3.connect(self._path, timeout=10) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS fix_signatures ("
+                    " signature TEXT PRIMARY KEY, error_class TEXT, seen INTEGER, rule_fixed INTEGER,"
+                    " last_fixer TEXT, first_seen REAL, last_seen REAL)"
+                )
+            self._created = True
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._created:
+            self._create()
+        return sqlite3.connect(self._path, timeout=10)
+
+    def record(self, error_message: str, fixer: str) -> None:
+        """Count a fix made by `fixer` (the rules applied, or "llm"); failures are logged, never raised"""
+        with self._lock:
+            self._fixers[fixer] = self._fixers.get(fixer, 0) + 1
+        if not self._path:
+            return
+        now = time.time()
+        rule_fixed = 0 if fixer == "llm" else 1
+        try:
+            with self._lock, self._connect() as conn:
+                for signature in error_signatures(error_message):
+                    conn.execute(
+                        "INSERT INTO fix_signatures"
+                        " (signature, error_class, seen, rule_fixed, last_fixer, first_seen, last_seen)"
+                        " VALUES (?, ?, 1, ?, ?, ?, ?)"
+                        " ON CONFLICT (signature) DO UPDATE SET seen = seen + 1,"
+                        " rule_fixed = rule_fixed + excluded.rule_fixed, last_fixer = excluded.last_fixer,"
+                        " last_seen = excluded.last_seen",
+                        (signature, signature.split(":")[0], rule_fixed, fixer, now, now),
+                    )
+        except Exception as e:
+            logger.warning(f"Fix log update failed: {str(e)}")
+
+    def stats(self, top: int = 20) -> Dict[str, Union[int, float, Dict, List]]:
+        with self._lock:
+            fixers = dict(self._fixers)
+        fixes = sum(fixers.values())
+        rule_fixes = fixes - fixers.get("llm", 0)
+        stats = {
+            "fixes": fixes,
+            "rule_fixes": rule_fixes,
+            "llm_fixes": fixers.get("llm", 0),
+            "rule_hit_rate": round(rule_fixes / fixes, 3) if fixes else 0.0,
+            "by_fixer": fixers,
+            "rules": sorted({rule.name for rule in RULES}),
+        }
+        if self._path:
+            try:
+                with self._connect() as conn:
+                    signatures, seen, fixed = conn.execute(
+                        "SELECT COUNT(*), COALESCE(SUM(seen), 0), COALESCE(SUM(rule_fixed), 0) FROM fix_signatures"
+                    ).fetchone()
+                    unmatched = conn.execute(
+                        "SELECT signature, seen FROM fix_signatures WHERE rule_fixed = 0 ORDER BY seen DESC LIMIT ?",
+                        (top,),
+                    ).fetchall()
+                stats["log"] = {
+                    "signatures": signatures,
+                    "seen": seen,
+                    "rule_fixed": fixed,
+                    "rule_hit_rate": round(fixed / seen, 3) if seen else 0.0,
+                    # The most frequent failures no rule fixed: what to write rules for next
+                    "unmatched": [{"signature": signature, "seen": count} for signature, count in unmatched],
+                }
+            except Exception as e:
+                logger.warning(f"Fix log stats failed: {str(e)}")
+        return stats
+
+
+fix_log = FixLog(FIX_LOG_PATH)
+os.register_at_fork(after_in_child=fix_log._after_fork)
+
+
+def count_fix(error_message: str, fixer: str) -> None:
+    """Record a fix in the metrics and the fix log"""
+    CODE_FIXES.labels(fixer).inc()
+    fix_log.record(error_message, fixer)
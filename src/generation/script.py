@@ -1,27 +1,22 @@
-from src.config import (
-    DEEPINFRA_API_KEY
-)
-import os
-import litellm
+from typing import Any, Callable, Dict, Optional
 
-def generate_script(problem_analysis: str) -> str:
+from src.generation.completion import LLMUnavailable, acomplete, complete, model_for
+
+def script_request(problem_analysis: str) -> Dict[str, Any]:
     """
-    Generate script from problem analysis
+    Build the completion request that writes a script for a problem analysis
     
     Args:
         problem_analysis: Structured analysis of the mathematical problem
         
     Returns:
-        str: Educational script for the animation
+        dict: Keyword arguments for the completion call
     """
-    os.environ["DEEPINFRA_API_KEY"] = DEEPINFRA_API_KEY
-    
-    try:
-        response = litellm.completion(
-            model = "deepinfra/meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8",
-            messages=[{
-                "role": "system",
-                "content": f"""
+    return dict(
+        model = model_for("script"),
+        messages=[{
+            "role": "system",
+            "content": f"""
                 <context>
                 You are creating educational video scripts that explain mathematical concepts through engaging animations. These videos aim to build deep understanding through visual explanations, following the style of channels like 3Blue1Brown. The target audience includes high school and college students studying mathematics.
                 </context>
@@ -174,18 +169,43 @@ def generate_script(problem_analysis: str) -> str:
 
                 Return ONLY the script content, following the specified format. Do not include any meta-commentary or additional formatting.
                 """
-            },
-            {
-                "role": "user",
-                "content": f"PROBLEM ANALYSIS: \n{problem_analysis}"
-            }],
-            temperature=0.4,
-            max_tokens=8192,
-        )
+        },
+        {
+            "role": "user",
+            "content": f"PROBLEM ANALYSIS: \n{problem_analysis}"
+        }],
+        temperature=0.4,
+        max_tokens=8192,
+    )
+
+def generate_script(problem_analysis: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Generate script from problem analysis
+    
+    Args:
+        problem_analysis: Structured analysis of the mathematical problem
+        on_token: Optional callback receiving text chunks as they stream from the model
+        
+    Returns:
+        str: Educational script for the animation
+    """
+    try:
+        return complete(script_request(problem_analysis), on_token)
+        
+    except LLMUnavailable:
+        raise
+        
+    except Exception as e:
+        print(f"Error generating script: {str(e)}")
+        raise Exception(f"Failed to generate script: {str(e)}")
+
+async def agenerate_script(problem_analysis: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+    """Async counterpart of generate_script, for the ASGI server"""
+    try:
+        return await acomplete(script_request(problem_analysis), on_token)
         
-        # Extract the content from the response
-        script = response.choices[0].message.content
-        return script
+    except LLMUnavailable:
+        raise
         
     except Exception as e:
         print(f"Error generating script: {str(e)}")
@@ -1,32 +1,25 @@
 """
 Functions for generating visual element specifications from educational scripts
 """
-import os
-import litellm
-from typing import Dict, List, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 
-from src.config import (
-    DEEPINFRA_API_KEY
-)
+from src.generation.completion import LLMUnavailable, acomplete, complete, model_for
 
-def generate_visual_elements(script: str) -> Dict[str, List[Dict[str, Union[str, float, Dict]]]]:
+def visuals_request(script: str) -> Dict[str, Any]:
     """
-    Generate visual element specifications from an educational script
+    Build the completion request that turns a script into visual element specifications
     
     Args:
         script: Educational script to generate visuals for
         
     Returns:
-        str: Visual element specifications from the script
+        dict: Keyword arguments for the completion call
     """
-    os.environ["DEEPINFRA_API_KEY"] = DEEPINFRA_API_KEY
-    
-    try:
-        response = litellm.completion(
-            model="deepinfra/meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8",
-            messages=[{
-                "role": "system",
-                "content": """
+    return dict(
+        model=model_for("visuals"),
+        messages=[{
+            "role": "system",
+            "content": """
 <context>
 Effective mathematical animation requires careful storyboarding to ensure clear concept communication and optimal learning outcomes. Visual choices directly impact student understanding and retention. A well-planned storyboard prevents cognitive overload and maintains focus on key concepts.
 
@@ -240,19 +233,45 @@ Educational Focus:
 </error_handling>
 
 Remember: Your storyboard should give a clear preview of how the final animation will look and flow, helping identify potential visual issues before animation begins. Prioritize educational clarity over visual complexity."""
-            }, {
-                "role": "user",
-                "content": f"""SCRIPT: 
+        }, {
+            "role": "user",
+            "content": f"""SCRIPT: 
                 {script}"""
-            }],
-            temperature=0.2,
-            max_tokens=8192,
-        )
-        
-        # Extract the content from the response
-        visual_elements = response.choices[0].message.content
+        }],
+        temperature=0.2,
+        max_tokens=8192,
+    )
+
+def generate_visual_elements(
+    script: str, on_token: Optional[Callable[[str], None]] = None
+) -> Dict[str, List[Dict[str, Union[str, float, Dict]]]]:
+    """
+    Generate visual element specifications from an educational script
+    
+    Args:
+        script: Educational script to generate visuals for
+        on_token: Optional callback receiving text chunks as they stream from the model
         
-        return visual_elements
+    Returns:
+        str: Visual element specifications from the script
+    """
+    try:
+        return complete(visuals_request(script), on_token)
+            
+    except LLMUnavailable:
+        raise
+            
+    except Exception as e:
+        print(f"Error generating visual elements: {str(e)}")
+        raise Exception(f"Failed to generate visual elements: {str(e)}")
+
+async def agenerate_visual_elements(script: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+    """Async counterpart of generate_visual_elements, for the ASGI server"""
+    try:
+        return await acomplete(visuals_request(script), on_token)
+            
+    except LLMUnavailable:
+        raise
             
     except Exception as e:
         print(f"Error generating visual elements: {str(e)}")
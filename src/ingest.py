@@ -0,0 +1,155 @@
+"""
+Ingestion of uploaded problem images: validation, bounded decoding and the vision-model variant
+"""
+import base64
+from io import BytesIO
+from typing import List, NamedTuple
+
+from src.config import MAX_IMAGE_PIXELS, MAX_UPLOAD_BYTES, VISION_JPEG_QUALITY, VISION_MAX_EDGE
+
+# Formats accepted for upload, with the extension and MIME type the original is stored under
+SUPPORTED_FORMATS = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "GIF": ("gif", "image/gif"),
+    "BMP": ("bmp", "image/bmp"),
+    "TIFF": ("tiff", "image/tiff"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+
+def _pil():
+    """Import PIL on first use so processes that never decode an image don't pay for it"""
+    from PIL import Image, ImageOps
+
+    # Let PIL refuse decompression bombs with the same limit we enforce on the header
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    return Image, ImageOps
+
+
+class ImageRejected(Exception):
+    """Raised when an upload is too large, not an image, or in an unsupported format"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class IngestedImage(NamedTuple):
+    """An accepted upload: the untouched original plus one downscaled JPEG for the vision call"""
+    original: bytes
+    file_ext: str
+    content_type: str
+    width: int
+    height: int
+    vision_data: bytes
+    vision_mime_type: str
+
+    def vision_data_url(self) -> str:
+        """Return the vision variant as a base64 data URL"""
+        return f"data:{self.vision_mime_type};base64," + base64.b64encode(self.vision_data).decode()
+
+
+def ingest_image(image_data: bytes) -> IngestedImage:
+    """
+    Validate an upload and produce the single variant sent to the vision model
+
+    The original bytes are kept as uploaded for storage. Decoding reads the header first so
+    oversized images are rejected before any pixels are decoded; JPEGs are then decoded with
+    draft mode at a reduced scale close to the vision target size.
+
+    Args:
+        image_data: Raw bytes of the uploaded file
+
+    Returns:
+        IngestedImage: Original bytes with storage metadata and the vision-ready JPEG
+
+    Raises:
+        ImageRejected: If the upload is empty, too large, undecodable or unsupported
+    """
+    if not image_data:
+        raise ImageRejected("Uploaded image is empty")
+    if len(image_data) > MAX_UPLOAD_BYTES:
+        raise ImageRejected(
+            f"Image exceeds maximum allowed size ({MAX_UPLOAD_BYTES / 1024 / 1024:.0f}MB)",
+            status_code=413,
+        )
+
+    Image, ImageOps = _pil()
+    try:
+        # Image.open only parses the header; pixels are decoded on load()
+        img = Image.open(BytesIO(image_data))
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(str(e), status_code=413)
+    except Exception:
+        raise ImageRejected("Uploaded file is not a readable image")
+
+    if img.format not in SUPPORTED_FORMATS:
+        raise ImageRejected(f"Unsupported image format: {img.format}")
+
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageRejected(
+            f"Image resolution ({width}x{height}) exceeds maximum of {MAX_IMAGE_PIXELS} pixels",
+            status_code=413,
+        )
+
+    file_ext, content_type = SUPPORTED_FORMATS[img.format]
+
+    try:
+        # For JPEG, draft mode makes the decoder downscale by 1/2, 1/4 or 1/8 while decoding
+        img.draft("RGB", (VISION_MAX_EDGE, VISION_MAX_EDGE))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        buffered = BytesIO()
+        img.save(buffered, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        raise ImageRejected(f"Failed to decode image: {str(e)}")
+
+    return IngestedImage(
+        original=image_data,
+        file_ext=file_ext,
+        content_type=content_type,
+        width=width,
+        height=height,
+        vision_data=buffered.getvalue(),
+        vision_mime_type="image/jpeg",
+    )
+
+
+def crop_regions(image: IngestedImage, boxes: List[List[float]], margin: float = 0.01) -> List[bytes]:
+    """
+    Cut regions out of the full-resolution original
+
+    Args:
+        image: Accepted upload to crop from
+        boxes: [left, top, right, bottom] boxes as fractions of the upright image size
+        margin: Extra border added around each box, as a fraction of the image size
+
+    Returns:
+        list: One encoded image per box (JPEG for photos, PNG otherwise), ready to be ingested as a separate upload
+    """
+    Image, ImageOps = _pil()
+    # Boxes are located on the vision variant, which was EXIF-rotated, so rotate the original the same way
+    img = ImageOps.exif_transpose(Image.open(BytesIO(image.original)))
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    # Keep photos as high-quality JPEG so crops of large photos stay under the upload limit
+    save_options = {"format": "JPEG", "quality": 95} if image.content_type == "image/jpeg" else {"format": "PNG", "optimize": True}
+
+    width, height = img.size
+    crops = []
+    for left, top, right, bottom in boxes:
+        region = img.crop((
+            int(max(left - margin, 0.0) * width),
+            int(max(top - margin, 0.0) * height),
+            int(min(right + margin, 1.0) * width),
+            int(min(bottom + margin, 1.0) * height),
+        ))
+        buffered = BytesIO()
+        region.save(buffered, **save_options)
+        crops.append(buffered.getvalue())
+    return crops
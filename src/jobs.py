@@ -0,0 +1,191 @@
+"""
+Background job execution for long-running pipeline stages
+"""
+import contextvars
+import logging
+import math
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from src.concurrency import DURATION_SMOOTHING, Overloaded
+from src.config import JOB_QUEUE_LIMIT, JOB_TTL_SECONDS, JOB_WORKERS
+from src.events import publish
+from src.tracing import span
+
+logger = logging.getLogger('image-to-manim')
+
+
+class JobManager:
+    """
+    Runs pipeline stages on a worker pool and tracks their stage, progress and result.
+
+    Jobs are kept in memory, so status lookups must hit the process that accepted the job.
+    Finished jobs are discarded JOB_TTL_SECONDS after completion. At most queue_limit jobs may
+    wait for a worker; beyond that submissions are refused with a Retry-After estimate.
+    """
+
+    def __init__(self, max_workers: int, ttl_seconds: int, queue_limit: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        self._max_workers = max_workers
+        self._ttl_seconds = ttl_seconds
+        self._queue_limit = queue_limit
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._avg_duration = None
+
+    def _retry_after(self) -> int:
+        average = self._avg_duration if self._avg_duration is not None else 60.0
+        return max(1, math.ceil(average * (self._queued + 1) / self._max_workers))
+
+    def ensure_capacity(self, count: int = 1) -> None:
+        """
+        Check that count more jobs fit in the queue
+
+        Raises:
+            Overloaded: If the queue cannot take them
+        """
+        with self._lock:
+            if self._queued + count > self._queue_limit:
+                raise Overloaded("Too many jobs are queued", self._retry_after(), 429)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return worker pool size, queue depth and the average job duration"""
+        with self._lock:
+            return {
+                "workers": self._max_workers,
+                "running": self._running,
+                "queue_depth": self._queued,
+                "queue_limit": self._queue_limit,
+                "avg_duration_seconds": round(self._avg_duration, 3) if self._avg_duration is not None else None,
+                "retry_after": self._retry_after(),
+            }
+
+    def submit(self, kind: str, func: Callable, **kwargs) -> str:
+        """
+        Queue a stage function for background execution
+
+        Args:
+            kind: Name of the job type (e.g. "generate-video")
+            func: Stage function returning (response, status_code); it receives a `progress` callback
+            **kwargs: Keyword arguments forwarded to func; a `session_id` is also recorded on the job
+
+        Returns:
+            str: Identifier of the queued job
+
+        Raises:
+            Overloaded: If the job queue is full
+        """
+        self._prune()
+        job_id = str(uuid.uuid4())
+        session_id = kwargs.get("session_id")
+        with self._lock:
+            if self._queued >= self._queue_limit:
+                raise Overloaded("Too many jobs are queued", self._retry_after(), 429)
+            self._queued += 1
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "type": kind,
+                "session_id": session_id,
+                "status": "queued",
+                "stage": "queued",
+                "progress": 0.0,
+                "result": None,
+                "error": None,
+                "http_status": None,
+                "retry_after": None,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+            }
+        # The job runs in the submitter's context, so its spans join the submitting request's trace
+        future = self._executor.submit(contextvars.copy_context().run, self._run, job_id, func, kwargs)
+        with self._lock:
+            self._futures[job_id] = future
+        logger.info(f"Queued {kind} job {job_id} for session: {session_id}")
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return a snapshot of the job record, or None if it is unknown or expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def future(self, job_id: str) -> Optional[Future]:
+        """Return a future that completes when the job finishes, or None if it is unknown or expired"""
+        with self._lock:
+            return self._futures.get(job_id)
+
+    def _update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _run(self, job_id: str, func: Callable, kwargs: Dict[str, Any]) -> None:
+        started_at = time.time()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        self._update(job_id, status="running", stage="started", started_at=started_at)
+
+        def progress(stage: str, fraction: float) -> None:
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job:
+                    # Progress never moves backwards, even when a retry restarts a stage
+                    job["stage"] = stage
+                    job["progress"] = round(max(job["progress"], min(fraction, 1.0)), 3)
+
+        session_id = kwargs.get("session_id")
+        kind = self.get(job_id)["type"]
+        publish(session_id, "job", job_id=job_id, status="running")
+        try:
+            with span(f"job.{kind}", job_id=job_id, session_id=session_id) as job_span:
+                result, status_code = func(progress=progress, **kwargs)
+                job_span.set_attribute("http_status", status_code)
+            if status_code >= 400:
+                self._update(job_id, status="failed", result=result, error=result.get("error"),
+                             http_status=status_code)
+            else:
+                self._update(job_id, status="succeeded", stage="complete", progress=1.0, result=result,
+                             http_status=status_code)
+        except Overloaded as e:
+            logger.warning(f"Job {job_id} refused by admission control: {str(e)}")
+            self._update(job_id, status="failed", error=str(e), http_status=e.status_code,
+                         retry_after=e.retry_after)
+        except Exception as e:
+            logger.error(f"Error in job {job_id}: {str(e)}\n{traceback.format_exc()}")
+            self._update(job_id, status="failed", error=str(e), http_status=500)
+        finally:
+            finished_at = time.time()
+            with self._lock:
+                self._running -= 1
+                duration = finished_at - started_at
+                if self._avg_duration is None:
+                    self._avg_duration = duration
+                else:
+                    self._avg_duration += DURATION_SMOOTHING * (duration - self._avg_duration)
+            self._update(job_id, finished_at=finished_at)
+            job = self.get(job_id)
+            publish(session_id, "job", job_id=job_id, status=job["status"], error=job["error"])
+
+    def _prune(self) -> None:
+        """Drop finished jobs whose retention period has elapsed"""
+        cutoff = time.time() - self._ttl_seconds
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["finished_at"] and job["finished_at"] < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+                self._futures.pop(job_id, None)
+
+
+job_manager = JobManager(max_workers=JOB_WORKERS, ttl_seconds=JOB_TTL_SECONDS, queue_limit=JOB_QUEUE_LIMIT)
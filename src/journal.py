@@ -0,0 +1,290 @@
+"""
+Write-behind journal for manim_projects rows: status updates are coalesced per session and
+written in batches by a background thread, with a timestamped history of status transitions
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
+
+from src.clients import get_supabase
+from src.config import (
+    JOURNAL_FLUSH_INTERVAL_SECONDS,
+    JOURNAL_HISTORY_SESSIONS,
+    JOURNAL_MAX_ATTEMPTS,
+    JOURNAL_MAX_BATCH,
+)
+
+logger = logging.getLogger('image-to-manim')
+
+PROJECTS_TABLE = "manim_projects"
+# Append-only table of status transitions: (project_id, status, created_at)
+HISTORY_TABLE = "manim_project_events"
+
+
+class _Entry:
+    """Pending writes of one session: an optional row insert and the merged fields of later updates"""
+
+    def __init__(self):
+        self.insert: Optional[Dict[str, Any]] = None
+        self.fields: Dict[str, Any] = {}
+        self.attempts = 0
+
+    def row(self) -> Dict[str, Any]:
+        return {**(self.insert or {}), **self.fields}
+
+
+class StatusJournal:
+    """
+    Collects writes to project rows and applies them off the request path.
+
+    Updates to the same session are merged until the next flush, so one round trip carries
+    several status and URL changes. A single flusher applies them in the order they were
+    recorded: an insert always lands before the updates that follow it, and writes recorded
+    during a flush go out in the next one. Readers in this process see pending writes through
+    overlay(). Every status change is also appended to HISTORY_TABLE with its timestamp.
+    """
+
+    def __init__(self, flush_interval: float, max_batch: int, max_attempts: int, history_sessions: int):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.history_sessions = history_sessions
+        self._init_state()
+        self._recorded = 0
+        self._coalesced = 0
+        self._writes = 0
+        self._flushes = 0
+        self._failures = 0
+        self._dropped = 0
+        self._flush_seconds = 0.0
+
+    def _init_state(self) -> None:
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._in_flight: Dict[str, _Entry] = {}
+        self._events: List[Dict[str, Any]] = []
+        self._history: "OrderedDict[str, List[Dict[str, Union[str, float]]]]" = OrderedDict()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _after_fork(self) -> None:
+        # The flusher thread does not survive a fork; writes recorded by the parent stay with the parent
+        self._init_state()
+
+    def _ensure_flusher(self) -> None:
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._flush_loop, name="status-journal", daemon=True)
+            self._thread.start()
+
+    def insert(self, row: Dict[str, Any]) -> None:
+        """Record a new project row; it is written before any update recorded after it"""
+        session_id = row["id"]
+        with self._lock:
+            entry = self._pending.setdefault(session_id, _Entry())
+            entry.insert = {**row, **entry.fields}
+            entry.fields = {}
+            self._record(session_id, row)
+
+    def update(self, session_id: str, fields: Dict[str, Any]) -> None:
+        """Record changed fields of a project row"""
+        with self._lock:
+            entry = self._pending.get(session_id)
+            if entry is None:
+                entry = self._pending[session_id] = _Entry()
+            else:
+                self._coalesced += 1
+            entry.fields.update(fields)
+            self._record(session_id, fields)
+
+    def _record(self, session_id: str, fields: Dict[str, Any]) -> None:
+        self._recorded += 1
+        status = fields.get("status")
+        if status:
+            now = time.time()
+            self._events.append({
+                "project_id": session_id,
+                "status": status,
+                "created_at": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+            })
+            history = self._history.pop(session_id, [])
+            history.append({"status": status, "at": now})
+            self._history[session_id] = history
+            while len(self._history) > self.history_sessions:
+                self._history.popitem(last=False)
+        self._ensure_flusher()
+        if len(self._pending) >= self.max_batch:
+            self._lock.notify()
+
+    def overlay(self, session_id: str, row: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Apply writes that have not reached the database yet to a row read from it"""
+        with self._lock:
+            entries = [entry for entry in (self._in_flight.get(session_id), self._pending.get(session_id)) if entry]
+        if not entries:
+            return row
+        merged = dict(row) if row else None
+        for entry in entries:
+            if merged is None and entry.insert is None:
+                continue
+            merged = {**(merged or {}), **entry.row()}
+        return merged
+
+    def history(self, session_id: str) -> Optional[List[Dict[str, Union[str, float]]]]:
+        """Return the status transitions recorded by this process for a session, oldest first"""
+        with self._lock:
+            history = self._history.get(session_id)
+            return list(history) if history is not None else None
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._lock:
+                if not self._closed and len(self._pending) < self.max_batch:
+                    self._lock.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush_once()
+
+    def flush_once(self) -> None:
+        """Write everything pending in one batch; failed writes are kept for the next flush"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending and not self._events:
+                    return
+                batch, self._pending = self._pending, OrderedDict()
+                events, self._events = self._events, []
+                self._in_flight = dict(batch)
+
+            start = time.time()
+            failed = self._write_rows(batch)
+            self._write_events(events)
+
+            with self._lock:
+                self._in_flight = {}
+                # Failed writes are older than anything recorded meanwhile, so newer fields are laid over them
+                for session_id, entry in reversed(list(failed.items())):
+                    newer = self._pending.pop(session_id, None)
+                    if newer is not None:
+                        if newer.insert is not None:
+                            entry.insert = newer.insert
+                            entry.fields = {}
+                        entry.fields.update(newer.fields)
+                    self._pending[session_id] = entry
+                    self._pending.move_to_end(session_id, last=False)
+                self._flushes += 1
+                self._flush_seconds += time.time() - start
+
+    def _write_rows(self, batch: "OrderedDict[str, _Entry]") -> "OrderedDict[str, _Entry]":
+        table = lambda: get_supabase().table(PROJECTS_TABLE)
+        failed: "OrderedDict[str, _Entry]" = OrderedDict()
+
+        # New rows first, one request per distinct set of columns
+        inserts: Dict[frozenset, List[str]] = {}
+        for session_id, entry in batch.items():
+            if entry.insert is not None:
+                inserts.setdefault(frozenset(entry.row()), []).append(session_id)
+        for session_ids in inserts.values():
+            try:
+                self._writes += 1
+                table().insert([batch[session_id].row() for session_id in session_ids]).execute()
+            except Exception as e:
+                logger.error(f"Journal insert of {len(session_ids)} project rows failed: {str(e)}")
+                for session_id in session_ids:
+                    failed[session_id] = batch[session_id]
+
+        for session_id, entry in batch.items():
+            if entry.insert is not None or not entry.fields:
+                continue
+            try:
+                self._writes += 1
+                table().update(entry.fields).eq("id", session_id).execute()
+            except Exception as e:
+                logger.error(f"Journal update of project {session_id} failed: {str(e)}")
+                failed[session_id] = entry
+
+        for session_id, entry in list(failed.items()):
+            entry.attempts += 1
+            self._failures += 1
+            if entry.attempts >= self.max_attempts:
+                logger.error(f"Dropping journaled writes for project {session_id} after {entry.attempts} attempts")
+                self._dropped += 1
+                del failed[session_id]
+        return failed
+
+    def _write_events(self, events: List[Dict[str, Any]]) -> None:
+        if not events:
+            return
+        try:
+            self._writes += 1
+            get_supabase().table(HISTORY_TABLE).insert(events).execute()
+        except Exception as e:
+            # The history is for analysis only; it is not worth holding back row updates for
+            logger.warning(f"Failed to write {len(events)} status transitions: {str(e)}")
+
+    def flush(self) -> None:
+        """Block until every write recorded so far has been attempted"""
+        for _ in range(self.max_attempts):
+            self.flush_once()
+            with self._lock:
+                if not self._pending:
+                    return
+            time.sleep(min(self.flush_interval, 1.0))
+
+    def close(self) -> None:
+        """Stop the flusher and write what is left; called when the process exits"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self.flush()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Return write counts, coalescing and the current backlog"""
+        with self._lock:
+            return {
+                "recorded": self._recorded,
+                "coalesced": self._coalesced,
+                "writes": self._writes,
+                "flushes": self._flushes,
+                "failures": self._failures,
+                "dropped": self._dropped,
+                "pending": len(self._pending),
+                "avg_flush_seconds": round(self._flush_seconds / self._flushes, 4) if self._flushes else 0.0,
+            }
+
+
+def load_history(session_id: str) -> List[Dict[str, Union[str, float]]]:
+    """
+    Return the status transitions of a session with the time spent in each status
+
+    Args:
+        session_id: Project whose history to return
+
+    Returns:
+        list: Transitions as {"status", "at", "seconds"}, oldest first; "seconds" is the time until
+              the next transition (None for the current status)
+    """
+    history = status_journal.history(session_id)
+    if history is None:
+        response = (
+            get_supabase().table(HISTORY_TABLE).select("status, created_at")
+            .eq("project_id", session_id).order("created_at").execute()
+        )
+        history = [
+            {"status": row["status"], "at": datetime.fromisoformat(row["created_at"].replace("Z", "+00:00")).timestamp()}
+            for row in response.data or []
+        ]
+    return [
+        {**transition, "seconds": round(history[index + 1]["at"] - transition["at"], 3) if index + 1 < len(history) else None}
+        for index, transition in enumerate(history)
+    ]
+
+
+status_journal = StatusJournal(
+    JOURNAL_FLUSH_INTERVAL_SECONDS, JOURNAL_MAX_BATCH, JOURNAL_MAX_ATTEMPTS, JOURNAL_HISTORY_SESSIONS
+)
+os.register_at_fork(after_in_child=status_journal._after_fork)
+atexit.register(status_journal.close)
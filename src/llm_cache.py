@@ -0,0 +1,256 @@
+"""
+Persistent cache of LLM responses, keyed on everything that determines what the model is asked
+
+Improve runs and fix retries often resend byte-identical requests (same model, messages and
+sampling parameters); those are answered from a SQLite file instead of the provider. The same
+store records responses and replays them, so the pipeline's LLM calls can run offline.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Union
+
+from src.config import (
+    LLM_CACHE_MAX_BYTES,
+    LLM_CACHE_MODE,
+    LLM_CACHE_PATH,
+    LLM_CACHE_STAGE_TTLS,
+    LLM_CACHE_TTL_SECONDS,
+)
+from src.metrics import LLM_CACHE_REQUESTS
+
+logger = logging.getLogger('image-to-manim')
+
+# Request fields that change how a response is delivered, not what it says
+TRANSPORT_FIELDS = frozenset({"stream", "stream_options", "timeout", "api_key", "api_base", "metadata"})
+
+# Outputs remembered per process for forget(): enough for every program still being rendered
+ORIGINS_LIMIT = 1024
+
+# Set while a stage regenerates on request: its calls skip cached responses and store fresh ones
+_bypass: ContextVar[bool] = ContextVar("llm_cache_bypass", default=False)
+
+
+class LLMReplayMiss(Exception):
+    """Raised in replay mode for a request that was never recorded"""
+
+
+class CachedResponse(NamedTuple):
+    """A stored completion: its text and the usage the provider reported when it was recorded"""
+    text: str
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """Hash the canonical JSON of a request's model, messages and sampling parameters"""
+    canonical = json.dumps(
+        {key: value for key, value in request.items() if key not in TRANSPORT_FIELDS},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def bypass_llm_cache(bypass: bool = True) -> Iterator[None]:
+    """Skip cached responses for LLM calls made inside the block (fresh responses are still stored)"""
+    token = _bypass.set(bypass)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def parse_ttls(spec: str) -> Dict[str, int]:
+    """Parse a "stage=seconds,..." setting"""
+    ttls = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        stage, _, seconds = item.partition("=")
+        ttls[stage.strip()] = int(seconds)
+    return ttls
+
+
+class LLMResponseCache:
+    """
+    LLM responses in a single SQLite file.
+
+    Entries expire after their stage's TTL and are evicted least-recently-used first once their
+    total size exceeds max_bytes. In "record" mode every call goes to the provider and its
+    response is stored without expiry; in "replay" mode the provider is never called and
+    entries are served regardless of age.
+
+    Outputs derived from a response (generated code) can be remembered with the request they
+    came from; if such code fails to render, forget() deletes the response so a retry samples
+    a new one instead of replaying the failure.
+
+    The file and its table are created on first use, not when the cache is built.
+    """
+
+    def __init__(self, mode: str, path: str, max_bytes: int, ttl_seconds: int, stage_ttls: Dict[str, int]):
+        self.mode = mode
+        self._path = path
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._stage_ttls = stage_ttls
+        self._counts = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0, "forgotten": 0}
+        # Hashes of remembered outputs, mapped to the keys of the requests they came from
+        self._origins: "OrderedDict[str, str]" = OrderedDict()
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self._created = False
+
+    def _after_fork(self) -> None:
+        self._init_state()
+
+    def _create(self) -> None:
+        with self._create_lock:
+            if self._created:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            with sqlite3.connect(self._path, timeout=10) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_responses ("
+                    " key TEXT PRIMARY KEY, stage TEXT, model TEXT, value TEXT, size INTEGER,"
+                    " created_at REAL, expires_at REAL, last_access REAL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS llm_responses_last_access ON llm_responses (last_access)")
+            self._created = True
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._created:
+            self._create()
+        return sqlite3.connect(self._path, timeout=10)
+
+    def _count(self, stage: str, result: str, field: str) -> None:
+        LLM_CACHE_REQUESTS.labels(stage, result).inc()
+        with self._lock:
+            self._counts[field] += 1
+
+    def _ttl(self, stage: str) -> int:
+        return self._stage_ttls.get(stage, self._ttl_seconds)
+
+    def get(self, request: Dict[str, Any], stage: str) -> Optional[CachedResponse]:
+        """
+        Return the stored response to a request, or None when the provider should be called
+
+        Raises:
+            LLMReplayMiss: In replay mode, if the request was never recorded
+        """
+        if self.mode in ("off", "record"):
+            return None
+        if self.mode == "cache" and (_bypass.get() or self._ttl(stage) <= 0):
+            self._count(stage, "bypass", "bypassed")
+            return None
+        key = request_key(request)
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT value, expires_at FROM llm_responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and (self.mode == "replay" or row[1] is None or row[1] > now):
+                    conn.execute("UPDATE llm_responses SET last_access = ? WHERE key = ?", (now, key))
+                    self._count(stage, "hit", "hits")
+                    return CachedResponse(**json.loads(row[0]))
+        except Exception as e:
+            logger.warning(f"LLM cache lookup failed for {stage}: {str(e)}")
+        self._count(stage, "miss", "misses")
+        if self.mode == "replay":
+            raise LLMReplayMiss(f"No recorded LLM response for this {stage} request ({key[:12]}) in replay mode")
+        return None
+
+    def put(self, request: Dict[str, Any], stage: str, response: CachedResponse) -> None:
+        """Store a fresh response; failures are logged, never raised"""
+        if self.mode in ("off", "replay"):
+            return
+        ttl = self._ttl(stage)
+        if self.mode == "cache" and ttl <= 0:
+            return
+        value = json.dumps(response._asdict())
+        size = len(value.encode('utf-8'))
+        now = time.time()
+        expires_at = None if self.mode == "record" else now + ttl
+        try:
+            with self._lock, self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_responses"
+                    " (key, stage, model, value, size, created_at, expires_at, last_access)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (request_key(request), stage, request.get("model"), value, size, now, expires_at, now),
+                )
+                conn.execute("DELETE FROM llm_responses WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_responses").fetchone()[0]
+                while total > self._max_bytes:
+                    oldest = conn.execute(
+                        "SELECT key, size FROM llm_responses ORDER BY last_access ASC LIMIT 1"
+                    ).fetchone()
+                    if oldest is None:
+                        break
+                    conn.execute("DELETE FROM llm_responses WHERE key = ?", (oldest[0],))
+                    total -= oldest[1]
+                self._counts["stored"] += 1
+        except Exception as e:
+            logger.warning(f"LLM cache store failed for {stage}: {str(e)}")
+
+    def remember(self, output: str, request: Dict[str, Any]) -> None:
+        """Note the request an output was derived from, so forget(output) can drop its response"""
+        if self.mode != "cache":
+            return
+        digest = hashlib.sha256(output.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._origins[digest] = request_key(request)
+            self._origins.move_to_end(digest)
+            while len(self._origins) > ORIGINS_LIMIT:
+                self._origins.popitem(last=False)
+
+    def forget(self, output: str) -> None:
+        """
+        Delete the cached response a remembered output was derived from, e.g. code that failed
+        its pre-render check or render; outputs never remembered are ignored
+        """
+        digest = hashlib.sha256(output.encode('utf-8')).hexdigest()
+        with self._lock:
+            key = self._origins.pop(digest, None)
+        if key is None:
+            return
+        try:
+            with self._connect() as conn:
+                forgotten = conn.execute("DELETE FROM llm_responses WHERE key = ?", (key,)).rowcount
+            with self._lock:
+                self._counts["forgotten"] += forgotten
+        except Exception as e:
+            logger.warning(f"LLM cache eviction failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Union[str, int, float]]:
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = counts["hits"] + counts["misses"]
+        stats = {"mode": self.mode, **counts, "hit_rate": round(counts["hits"] / lookups, 3) if lookups else 0.0}
+        if self.mode != "off":
+            try:
+                with self._connect() as conn:
+                    entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses").fetchone()
+                stats.update(entries=entries, bytes=size)
+            except Exception as e:
+                logger.warning(f"LLM cache stats failed: {str(e)}")
+        return stats
+
+
+def create_cache(mode: str) -> LLMResponseCache:
+    """Build the response cache selected by LLM_CACHE_MODE ("cache", "record", "replay" or "off")"""
+    if mode not in ("cache", "record", "replay", "off"):
+        logger.warning(f"Unknown LLM_CACHE_MODE '{mode}', LLM response caching disabled")
+        mode = "off"
+    return LLMResponseCache(mode, LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES, LLM_CACHE_TTL_SECONDS, parse_ttls(LLM_CACHE_STAGE_TTLS))
+
+
+llm_cache = create_cache(LLM_CACHE_MODE)
+os.register_at_fork(after_in_child=llm_cache._after_fork)
@@ -0,0 +1,246 @@
+"""
+Content-addressed memoization of generation stages (image -> analysis, analysis -> script, script -> visuals)
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Optional, Union
+
+from src.config import MEMO_BACKEND, MEMO_MAX_BYTES, MEMO_NAMESPACE, MEMO_PATH
+
+logger = logging.getLogger('image-to-manim')
+
+
+class MemoBackend:
+    """Interface for memo stores: values are text, keys are hex digests"""
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, stage: str, value: str) -> None:
+        raise NotImplementedError
+
+    def _after_fork(self) -> None:
+        """Drop state a forked worker must not share with its parent"""
+
+
+class SQLiteMemoBackend(MemoBackend):
+    """
+    Memo store in a single SQLite file.
+
+    Entries are evicted least-recently-used first once their total size exceeds max_bytes.
+    The file and its table are created on first use.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self._created = False
+
+    def _after_fork(self) -> None:
+        self._init_state()
+
+    def _create(self) -> None:
+        with self._create_lock:
+            if self._created:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            with sqlite3.connect(self._path, timeout=10) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS memo ("
+                    " key TEXT PRIMARY KEY, stage TEXT, value TEXT, size INTEGER,"
+                    " created_at REAL, last_access REAL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS memo_last_access ON memo (last_access)")
+            self._created = True
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._created:
+            self._create()
+        return sqlite3.connect(self._path, timeout=10)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value FROM memo WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE memo SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def set(self, key: str, stage: str, value: str) -> None:
+        size = len(value.encode('utf-8'))
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO memo (key, stage, value, size, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, stage, value, size, now, now),
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM memo").fetchone()[0]
+            while total > self._max_bytes:
+                oldest = conn.execute(
+                    "SELECT key, size FROM memo ORDER BY last_access ASC LIMIT 1"
+                ).fetchone()
+                if oldest is None:
+                    break
+                conn.execute("DELETE FROM memo WHERE key = ?", (oldest[0],))
+                total -= oldest[1]
+
+
+class DiskMemoBackend(MemoBackend):
+    """
+    Memo store with one file per entry under a directory.
+
+    File modification times track recency; the least recently used files are removed once the
+    directory exceeds max_bytes. The directory is created by the first store.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._lock = threading.Lock()
+
+    def _after_fork(self) -> None:
+        self._init_state()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.txt")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._file(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = f.read()
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, stage: str, value: str) -> None:
+        path = self._file(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        os.makedirs(self._directory, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith(".txt"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self._directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def create_backend(kind: str) -> Optional[MemoBackend]:
+    """Build the memo backend selected by MEMO_BACKEND ("sqlite", "disk" or "none")"""
+    if kind == "sqlite":
+        return SQLiteMemoBackend(MEMO_PATH, MEMO_MAX_BYTES)
+    if kind == "disk":
+        return DiskMemoBackend(MEMO_PATH, MEMO_MAX_BYTES)
+    if kind != "none":
+        logger.warning(f"Unknown MEMO_BACKEND '{kind}', stage memoization disabled")
+    return None
+
+
+memo_backend = create_backend(MEMO_BACKEND)
+if memo_backend is not None:
+    os.register_at_fork(after_in_child=memo_backend._after_fork)
+
+
+def memo_key(stage: str, stage_input: Union[bytes, str]) -> str:
+    """Hash a stage name and its input into a content address"""
+    if isinstance(stage_input, str):
+        stage_input = stage_input.encode('utf-8')
+    digest = hashlib.sha256()
+    digest.update(f"{MEMO_NAMESPACE}:{stage}:".encode('utf-8'))
+    digest.update(stage_input)
+    return digest.hexdigest()
+
+
+def memoize(stage: str, stage_input: Union[bytes, str], compute: Callable[[], str], bypass: bool = False) -> str:
+    """
+    Return the stored output for a stage input, computing and storing it on a miss
+
+    Args:
+        stage: Stage name (e.g. "analysis"); part of the key
+        stage_input: Bytes or text the stage output is derived from
+        compute: Function producing the output on a miss
+        bypass: Skip the lookup and recompute, still storing the fresh result
+
+    Returns:
+        str: The stage output
+    """
+    if memo_backend is None:
+        return compute()
+
+    key = memo_key(stage, stage_input)
+    if not bypass:
+        try:
+            cached = memo_backend.get(key)
+        except Exception as e:
+            logger.warning(f"Memo lookup failed for {stage}: {str(e)}")
+            cached = None
+        if cached is not None:
+            logger.info(f"Memo hit for {stage} ({key[:12]})")
+            return cached
+
+    result = compute()
+    try:
+        memo_backend.set(key, stage, result)
+    except Exception as e:
+        logger.warning(f"Memo store failed for {stage}: {str(e)}")
+    return result
+
+
+async def amemoize(
+    stage: str, stage_input: Union[bytes, str], compute: Callable[[], Awaitable[str]], bypass: bool = False
+) -> str:
+    """Async counterpart of memoize; backend reads and writes run off the event loop"""
+    if memo_backend is None:
+        return await compute()
+
+    key = memo_key(stage, stage_input)
+    if not bypass:
+        try:
+            cached = await asyncio.to_thread(memo_backend.get, key)
+        except Exception as e:
+            logger.warning(f"Memo lookup failed for {stage}: {str(e)}")
+            cached = None
+        if cached is not None:
+            logger.info(f"Memo hit for {stage} ({key[:12]})")
+            return cached
+
+    result = await compute()
+    try:
+        await asyncio.to_thread(memo_backend.set, key, stage, result)
+    except Exception as e:
+        logger.warning(f"Memo store failed for {stage}: {str(e)}")
+    return result
@@ -0,0 +1,153 @@
+"""
+Prometheus metrics: per-stage latency histograms, LLM token counts, render outcomes and storage traffic
+"""
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# Stages run from a second to several minutes; renders and fix loops sit at the top of the range
+STAGE_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 450, 600, 900)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "manim_stage_duration_seconds",
+    "Time spent executing a pipeline stage, excluding time queued for a slot",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+STAGE_WAIT_SECONDS = Histogram(
+    "manim_stage_wait_seconds",
+    "Time spent waiting for a stage concurrency slot",
+    ["stage"],
+    buckets=WAIT_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "manim_llm_tokens_total",
+    "Tokens sent to and generated by the LLM provider",
+    ["stage", "model", "kind"],
+)
+LLM_COST = Counter(
+    "manim_llm_cost_usd_total",
+    "Estimated cost of LLM calls in USD",
+    ["stage", "model"],
+)
+LLM_RETRIES = Counter(
+    "manim_llm_retries_total",
+    "LLM calls retried after a transient provider error",
+    ["provider", "error"],
+)
+LLM_REJECTED = Counter(
+    "manim_llm_rejected_total",
+    "LLM calls failed fast by the gateway without reaching the provider",
+    ["provider", "reason"],
+)
+LLM_CACHE_REQUESTS = Counter(
+    "manim_llm_cache_requests_total",
+    "LLM requests looked up in the response cache, by result (hit, miss or bypass)",
+    ["stage", "result"],
+)
+LLM_CALL_SECONDS = Histogram(
+    "manim_llm_call_duration_seconds",
+    "Latency of individual LLM completion calls",
+    ["stage", "model"],
+    buckets=STAGE_BUCKETS,
+)
+RENDER_RETRIES = Counter(
+    "manim_render_retries_total",
+    "Renders retried with regenerated code after a failed attempt",
+)
+PREFLIGHT_CHECKS = Counter(
+    "manim_preflight_checks_total",
+    "Generated programs checked before rendering, by result: passed, or the first problem found (e.g. NameError)",
+    ["result"],
+)
+CODE_FIXES = Counter(
+    "manim_code_fixes_total",
+    "Code fixed after a failed render or check, by fixer: the rules that fixed it, or llm",
+    ["fixer"],
+)
+SPECULATIVE_CANDIDATES = Counter(
+    "manim_speculative_candidates_total",
+    "Speculative code candidates by outcome (won, render_failed, invalid, error, superseded, cancelled)",
+    ["outcome"],
+)
+RENDER_FAILURES = Counter(
+    "manim_render_failures_total",
+    "Failed render attempts by the exception class found in the error output",
+    ["error_class"],
+)
+STORAGE_BYTES = Counter(
+    "manim_storage_bytes_total",
+    "Artifact bytes written to (out) and read from (in) storage",
+    ["direction"],
+)
+
+# Stage of the code running in this thread or task, so LLM calls are attributed to it
+_current_stage: ContextVar[str] = ContextVar("current_stage", default="unknown")
+
+
+def current_stage() -> str:
+    """Return the pipeline stage the caller is running in ("unknown" outside any stage)"""
+    return _current_stage.get()
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """Time a block as one execution of `stage` and attribute LLM calls made inside it to the stage"""
+    token = _current_stage.set(stage)
+    start = time.time()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.time() - start)
+        _current_stage.reset(token)
+
+
+def observe_wait(stage: str, seconds: float) -> None:
+    """Record how long a caller waited for a slot of `stage`"""
+    STAGE_WAIT_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_llm_call(
+    model: str, seconds: float, prompt_tokens: Optional[int], completion_tokens: Optional[int], cost: Optional[float] = None
+) -> None:
+    """Record the latency, token usage and cost of one completion call in the current stage"""
+    stage = current_stage()
+    LLM_CALL_SECONDS.labels(stage, model).observe(seconds)
+    if prompt_tokens:
+        LLM_TOKENS.labels(stage, model, "prompt").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(stage, model, "completion").inc(completion_tokens)
+    if cost:
+        LLM_COST.labels(stage, model).inc(cost)
+
+
+def count_storage_bytes(direction: str, size: int) -> None:
+    """Add to the storage traffic counter; direction is "in" or "out" """
+    STORAGE_BYTES.labels(direction).inc(size)
+
+
+def error_class(error_message: Optional[str]) -> str:
+    """
+    Reduce a render error to the exception class it reports, e.g. "NameError" or "LaTeXError"
+
+    Manim prints a traceback whose last "SomethingError: ..." line names the failure; errors raised
+    before the subprocess ran (e.g. Modal timeouts) are classified from their message.
+    """
+    if not error_message:
+        return "unknown"
+    matches = re.findall(r"^\s*(?:[\w.]+\.)?(\w+(?:Error|Exception|Exit|Interrupt))\b", error_message, re.MULTILINE)
+    if matches:
+        return matches[-1]
+    if "timeout" in error_message.lower() or "timed out" in error_message.lower():
+        return "Timeout"
+    return "other"
+
+
+def render_latest() -> Tuple[bytes, str]:
+    """Return the current metrics in the Prometheus text format, with its content type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
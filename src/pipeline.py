@@ -0,0 +1,887 @@
+"""
+Pipeline stages shared by the HTTP endpoints and the background job workers
+"""
+import contextvars
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from src.cache import artifact_cache
+from src.concurrency import stage_slot
+from src.clients import get_supabase, http_session
+from src.config import CODEGEN_CANDIDATES
+from src.events import publish
+from src.journal import status_journal
+from src.llm_cache import bypass_llm_cache
+from src.memo import memo_key, memoize
+from src.metrics import count_storage_bytes
+from src.singleflight import SingleFlight
+from src.generation.manim_code import generate_manim_code
+from src.generation.problem_analysis import generate_problem_analysis
+from src.generation.problem_regions import detect_problem_regions, parse_problem_regions
+from src.generation.review import review_video
+from src.generation.script import generate_script
+from src.generation.visuals import generate_visual_elements
+from src.ingest import IngestedImage, crop_regions
+from src.render.render import queue_manim_rendering, render_candidates
+from src.storage import get_public_url, read_from_url, update_code_in_storage, upload_to_storage
+from src.usage import tracks_usage, usage_ledger
+
+logger = logging.getLogger('image-to-manim')
+
+# Callback used to report progress: progress(stage, fraction_complete)
+ProgressCallback = Callable[[str, float], None]
+
+# Callback receiving generated text chunks as they stream from the model
+TokenCallback = Callable[[str], None]
+
+StageResult = Tuple[Dict[str, Union[str, int, Dict]], int]
+
+# Minimum time between "llm_progress" events for one streaming call
+LLM_PROGRESS_INTERVAL_SECONDS = 0.5
+
+# A single thread so deferred writes reach Supabase in the order they were issued
+_persistence_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+
+# Identical concurrent stage inputs (e.g. a class uploading the same photo) share one LLM call
+stage_flights = SingleFlight()
+
+
+class Persistence:
+    """
+    Runs storage uploads and database writes either inline or deferred.
+
+    Deferred writes execute in order on a background thread so the caller can move on to the
+    next stage with the artifact still in memory; wait() blocks until they have all landed.
+    """
+
+    def __init__(self, deferred: bool = False):
+        self.deferred = deferred
+        self._pending: List[Future] = []
+
+    def run(self, func: Callable, *args, **kwargs) -> None:
+        """Execute a write now, or queue it when persistence is deferred"""
+        if not self.deferred:
+            func(*args, **kwargs)
+            return
+        self._pending.append(_persistence_executor.submit(contextvars.copy_context().run, func, *args, **kwargs))
+
+    def wait(self) -> None:
+        """Block until all queued writes finish, raising the first failure"""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+
+def _report(progress: Optional[ProgressCallback], stage: str, fraction: float) -> None:
+    """Forward a progress update to the callback, if one was given"""
+    if progress:
+        progress(stage, fraction)
+
+
+def _with_events(session_id: str, progress: Optional[ProgressCallback]) -> ProgressCallback:
+    """Wrap a progress callback so every update is also published as a session "stage" event"""
+    def report(stage: str, fraction: float) -> None:
+        publish(session_id, "stage", stage=stage, progress=round(fraction, 3))
+        if progress:
+            progress(stage, fraction)
+    return report
+
+
+def _scaled(progress: ProgressCallback, start: float, end: float) -> ProgressCallback:
+    """Map a sub-stage's 0..1 progress onto the [start, end] slice of an enclosing stage"""
+    def report(stage: str, fraction: float) -> None:
+        progress(stage, start + (end - start) * fraction)
+    return report
+
+
+def _update_project(session_id: str, fields: Dict[str, str]) -> None:
+    # Written behind by the status journal, coalesced with the session's other pending updates
+    status_journal.update(session_id, fields)
+
+
+def _fetch_project(session_id: str) -> Optional[Dict]:
+    logger.info(f"Fetching project data for session: {session_id}")
+    response = get_supabase().table("manim_projects").select("*").eq("id", session_id).execute()
+    # Include writes still waiting in the journal
+    project_data = status_journal.overlay(session_id, response.data[0] if response.data else None)
+    if project_data:
+        # Usage of this session's earlier stages, possibly recorded by another process
+        usage_ledger.seed(session_id, project_data.get("llm_usage"))
+    return project_data
+
+
+def load_artifact(session_id: str, kind: str, url: str) -> Tuple[Optional[str], Optional[StageResult]]:
+    """
+    Return a text artifact from the session cache, downloading it from storage on a miss
+
+    Args:
+        session_id: Session the artifact belongs to
+        kind: Artifact kind, as used in its log messages (e.g. "script", "visual elements")
+        url: Public storage URL to download from on a cache miss
+
+    Returns:
+        tuple: The artifact text, or an error result if the download failed
+    """
+    cached = artifact_cache.get(session_id, kind)
+    if cached is not None:
+        logger.info(f"Using cached {kind} for session: {session_id}")
+        return cached, None
+
+    try:
+        # Local storage maps the file instead of fetching it over HTTP
+        stored = read_from_url(url)
+        if stored is not None:
+            logger.info(f"Reading {kind} from local storage: {url}")
+            text = str(stored, 'utf-8')
+            artifact_cache.put(session_id, kind, text)
+            return text, None
+
+        logger.info(f"Retrieving {kind} from URL: {url}")
+        # Download the artifact content from the URL
+        fetch_start = time.time()
+        response = http_session().get(url)
+        artifact_cache.record_miss_fetch(time.time() - fetch_start)
+        count_storage_bytes("in", len(response.content))
+        if response.status_code == 200:
+            logger.info(f"Successfully retrieved {kind} content")
+            artifact_cache.put(session_id, kind, response.text)
+            return response.text, None
+        logger.error(f"Failed to retrieve {kind}. Status code: {response.status_code}")
+        return None, ({"error": f"Failed to retrieve {kind}. Status code: {response.status_code}"}, 500)
+    except Exception as e:
+        logger.error(f"Exception while retrieving {kind}: {str(e)}")
+        return None, ({"error": f"Failed to retrieve {kind}: {str(e)}"}, 500)
+
+
+def _run_stage(stage: str, stage_input: Union[bytes, str], compute: Callable[[], str], bypass_cache: bool) -> str:
+    """Run a generation stage once per distinct input: memoized, and coalesced while in flight"""
+    key = f"{memo_key(stage, stage_input)}:{'fresh' if bypass_cache else 'memo'}"
+
+    def compute_in_slot() -> str:
+        with stage_slot(stage), bypass_llm_cache(bypass_cache):
+            return compute()
+
+    return stage_flights.do(key, lambda: memoize(stage, stage_input, compute_in_slot, bypass=bypass_cache))
+
+
+def analyze_problem(image: IngestedImage, bypass_cache: bool = False) -> str:
+    """Analyze the problem image, reusing the analysis of byte-identical uploads"""
+    return _run_stage(
+        "analysis",
+        image.original,
+        lambda: generate_problem_analysis(image_data=image.vision_data, mime_type=image.vision_mime_type),
+        bypass_cache,
+    )
+
+
+def find_problem_regions(image: IngestedImage, bypass_cache: bool = False) -> List[Dict]:
+    """Locate the separate problems on a worksheet image, reusing results for byte-identical uploads"""
+    return parse_problem_regions(_run_stage(
+        "regions",
+        image.original,
+        lambda: detect_problem_regions(image.vision_data, mime_type=image.vision_mime_type),
+        bypass_cache,
+    ))
+
+
+def _run_streaming_stage(
+    stage: str,
+    stage_input: str,
+    generate: Callable[[Optional[TokenCallback]], str],
+    bypass_cache: bool,
+    on_token: Optional[TokenCallback],
+) -> str:
+    """
+    Run a text generation stage, streaming its tokens to on_token when one is given.
+
+    Memo hits and coalesced calls never reach the model, so the full text is forwarded
+    to on_token as a single chunk instead.
+    """
+    streamed = []
+
+    def forward(text: str) -> None:
+        streamed.append(True)
+        on_token(text)
+
+    result = _run_stage(stage, stage_input, lambda: generate(forward if on_token else None), bypass_cache)
+    if on_token and not streamed:
+        on_token(result)
+    return result
+
+
+def write_script(problem_analysis: str, bypass_cache: bool = False, on_token: Optional[TokenCallback] = None) -> str:
+    """Generate the script, reusing the script of an identical analysis"""
+    return _run_streaming_stage(
+        "script",
+        problem_analysis,
+        lambda forward: generate_script(problem_analysis=problem_analysis, on_token=forward),
+        bypass_cache,
+        on_token,
+    )
+
+
+def write_visuals(script: str, bypass_cache: bool = False, on_token: Optional[TokenCallback] = None) -> str:
+    """Generate the visual elements, reusing the visuals of an identical script"""
+    return _run_streaming_stage(
+        "visuals",
+        script,
+        lambda forward: generate_visual_elements(script=script, on_token=forward),
+        bypass_cache,
+        on_token,
+    )
+
+
+def token_events(session_id: str, stage: str, on_token: Optional[TokenCallback] = None) -> TokenCallback:
+    """Wrap a token callback so streaming progress is published as throttled "llm_progress" events"""
+    state = {"chunks": 0, "chars": 0, "last_publish": 0.0}
+
+    def report(text: str) -> None:
+        state["chunks"] += 1
+        state["chars"] += len(text)
+        now = time.time()
+        if now - state["last_publish"] >= LLM_PROGRESS_INTERVAL_SECONDS:
+            state["last_publish"] = now
+            publish(session_id, "llm_progress", stage=stage, chunks=state["chunks"], characters=state["chars"])
+        if on_token:
+            on_token(text)
+    return report
+
+
+def store_image(session_id: str, image: IngestedImage, persistence: Persistence) -> str:
+    """Upload the original image bytes, exactly as received, and return their public URL"""
+    image_path = f"{session_id}/original.{image.file_ext}"
+    logger.info(f"Storing image at path: {image_path}")
+    persistence.run(upload_to_storage, image_path, image.original, image.content_type)
+    image_url = get_public_url(image_path)
+    logger.info(f"Image accessible at URL: {image_url}")
+    publish(session_id, "artifact", kind="image", url=image_url)
+    return image_url
+
+
+def create_project(
+    session_id: str,
+    problem_analysis: str,
+    image_url: str,
+    persistence: Persistence,
+    parent_id: Optional[str] = None,
+) -> None:
+    """Insert the project row holding the problem analysis, linked to its worksheet if it was split from one"""
+    project_data = {
+        "id": session_id,
+        "problem_analysis": problem_analysis,
+        "status": "image_processed",
+        "image_url": image_url,
+        "created_at": "now()"
+    }
+    if parent_id:
+        project_data["parent_id"] = parent_id
+    # The analysis ran before the row existed, so its usage is part of the insert
+    project_data.update(usage_ledger.fields(session_id))
+    logger.info(f"Inserting project data into database with ID: {session_id}")
+    persistence.run(status_journal.insert, project_data)
+    publish(session_id, "stage", stage="image_processed")
+
+
+def store_script(session_id: str, script: str, persistence: Persistence) -> str:
+    """Upload the script, mark the project as script_generated and return the script URL"""
+    artifact_cache.put(session_id, "script", script)
+    script_path = f"{session_id}/script.txt"
+    logger.info(f"Storing script at path: {script_path}")
+    persistence.run(upload_to_storage, script_path, script.encode('utf-8'))
+    script_url = get_public_url(script_path)
+    logger.info(f"Script accessible at URL: {script_url}")
+    publish(session_id, "artifact", kind="script", url=script_url)
+
+    logger.info(f"Updating project status to 'script_generated' for session: {session_id}")
+    persistence.run(_update_project, session_id, {
+        "status": "script_generated",
+        "script_url": script_url
+    })
+    publish(session_id, "stage", stage="script_generated")
+    return script_url
+
+
+def store_visuals(session_id: str, visual_elements: str, persistence: Persistence) -> str:
+    """Upload the visual elements, mark the project as visuals_generated and return their URL"""
+    artifact_cache.put(session_id, "visual elements", visual_elements)
+    visuals_path = f"{session_id}/visuals.txt"
+    logger.info(f"Storing visual elements at path: {visuals_path}")
+    persistence.run(upload_to_storage, visuals_path, visual_elements.encode('utf-8'))
+    visuals_url = get_public_url(visuals_path)
+    logger.info(f"Visual elements accessible at URL: {visuals_url}")
+    publish(session_id, "artifact", kind="visuals", url=visuals_url)
+
+    logger.info(f"Updating project status to 'visuals_generated' for session: {session_id}")
+    persistence.run(_update_project, session_id, {
+        "status": "visuals_generated",
+        "visuals_url": visuals_url
+    })
+    publish(session_id, "stage", stage="visuals_generated")
+    return visuals_url
+
+
+def _store_code(
+    session_id: str, code_path: str, manim_code: str, progress: ProgressCallback, persistence: Persistence,
+    fraction: float = 0.4,
+) -> str:
+    """Store generated Manim code and record its URL on the project; returns the URL"""
+    # Store Manim code in Supabase
+    _report(progress, "storing_code", fraction)
+    logger.info(f"Storing Manim code at path: {code_path}")
+    persistence.run(update_code_in_storage, code_path, manim_code)
+    code_url = get_public_url(code_path)
+    logger.info(f"Manim code accessible at URL: {code_url}")
+    publish(session_id, "artifact", kind="code", url=code_url)
+
+    # Update the project data
+    logger.info(f"Updating project with code URL for session: {session_id}")
+    persistence.run(_update_project, session_id, {
+        "code_url": code_url
+    })
+    return code_url
+
+
+def _generate_and_render(
+    session_id: str,
+    visual_elements: str,
+    visuals_url: str,
+    video_quality: str,
+    progress: ProgressCallback,
+    persistence: Persistence,
+) -> StageResult:
+    """Generate Manim code from visual elements, store it and render it on Modal"""
+    # Generate Manim code
+    _report(progress, "generating_code", 0.1)
+    code_path = f"{session_id}/scene.py"
+    if CODEGEN_CANDIDATES > 1:
+        # Earlier uploads and row writes must be issued before the render statuses are journaled
+        persistence.wait()
+        logger.info(f"Generating and rendering {CODEGEN_CANDIDATES} Manim code candidates with quality: {video_quality}")
+        render_result = render_candidates(
+            session_id,
+            lambda temperature, use_cache: generate_manim_code(
+                visual_elements=visual_elements, session_id=session_id, temperature=temperature, use_cache=use_cache
+            ),
+            video_quality,
+            code_path=code_path,
+            progress=progress,
+        )
+        # The code kept is the candidate that rendered (or was last fixed), so it is stored once the race is decided
+        code_url = _store_code(session_id, code_path, render_result["current_code"], progress, persistence, fraction=0.95)
+    else:
+        logger.info("Generating Manim code from visual elements")
+        with stage_slot("codegen"):
+            manim_code = generate_manim_code(visual_elements=visual_elements, session_id=session_id)
+        logger.info("Manim code generation completed")
+        code_url = _store_code(session_id, code_path, manim_code, progress, persistence)
+
+        # Earlier uploads and row writes must be issued before the render statuses are journaled
+        persistence.wait()
+
+        # Queue the Manim rendering job on Modal
+        _report(progress, "rendering", 0.5)
+        logger.info(f"Queuing Manim rendering job with quality: {video_quality}")
+
+        # Add video quality to the rendering parameters
+        with stage_slot("render"):
+            render_result = queue_manim_rendering(
+                session_id=session_id,
+                manim_code=manim_code,
+                code_path=code_path,
+                quality=video_quality,
+                progress=progress,
+            )
+
+    video_url = render_result.get("video_url")
+    error_message = render_result.get("error")
+
+    if video_url:
+        logger.info(f"Rendering completed successfully, video URL: {video_url}")
+        publish(session_id, "artifact", kind="video", url=video_url)
+        # Update the project status
+        logger.info(f"Updating project status to 'video_generated' for session: {session_id}")
+        persistence.run(_update_project, session_id, {
+            "status": "video_generated",
+            "video_url": video_url
+        })
+
+        response = {
+            "session_id": session_id,
+            "visuals_url": visuals_url,
+            "code_url": code_url,
+            "video_url": video_url,
+            "status": "video_generated",
+            "message": "Video generated successfully."
+        }
+    else:
+        # Rendering failed
+        logger.error(f"Video rendering failed: {error_message}")
+        response = {
+            "session_id": session_id,
+            "visuals_url": visuals_url,
+            "code_url": code_url,
+            "status": "code_generated",
+            "message": "Code generation complete, but video rendering failed.",
+            "error": error_message
+        }
+
+    return response, 200
+
+
+def _review_and_improve(
+    session_id: str,
+    video_url: str,
+    code_url: str,
+    visuals_url: str,
+    visual_elements: Optional[str],
+    video_quality: str,
+    progress: ProgressCallback,
+    persistence: Persistence,
+) -> StageResult:
+    """Review a rendered video and, if it scores too low, regenerate and re-render the code"""
+    # Review the video
+    _report(progress, "reviewing", 0.05)
+    logger.info(f"Reviewing video quality at URL: {video_url}")
+    with stage_slot("review"):
+        review_result = review_video(video_url=video_url, video_data=read_from_url(video_url))
+
+    score = review_result["score"]
+    review_text = review_result["review"]
+    needs_improvement = review_result["needs_improvement"]
+    logger.info(f"Video review completed. Score: {score}/100. Needs improvement: {needs_improvement}")
+    publish(session_id, "review", score=score, needs_improvement=needs_improvement)
+
+    # Update the database with review results
+    logger.info(f"Updating project status to 'review_complete' for session: {session_id}")
+    persistence.run(_update_project, session_id, {
+        "status": "review_complete",
+    })
+
+    # If the video needs improvement
+    if needs_improvement:
+        logger.info(f"Video quality score is low ({score}/100). Regenerating based on feedback")
+
+        if visual_elements is None:
+            _report(progress, "fetching_visuals", 0.3)
+            visual_elements, error_result = load_artifact(session_id, "visual elements", visuals_url)
+            if error_result:
+                return error_result
+
+        # Attempt to improve the video based on feedback
+        _report(progress, "generating_code", 0.35)
+        logger.info("Attempting to improve video based on feedback")
+        if CODEGEN_CANDIDATES > 1:
+            persistence.wait()
+            render_result = render_candidates(
+                session_id,
+                lambda temperature, use_cache: generate_manim_code(
+                    visual_elements=visual_elements,
+                    improvements=review_text,
+                    session_id=session_id,
+                    temperature=temperature,
+                    use_cache=use_cache,
+                ),
+                video_quality,
+                code_path=f"{session_id}/scene.py",
+                progress=progress,
+            )
+            # Store the code of the candidate that rendered
+            logger.info(f"Storing improved manim code")
+            persistence.run(update_code_in_storage, f"{session_id}/scene.py", render_result["current_code"])
+        else:
+            with stage_slot("codegen"):
+                improved_code = generate_manim_code(
+                    visual_elements=visual_elements,
+                    improvements=review_text,
+                    session_id=session_id,
+                )
+
+            # Store the improved code
+            _report(progress, "storing_code", 0.6)
+            logger.info(f"Storing improved manim code")
+            persistence.run(update_code_in_storage, f"{session_id}/scene.py", improved_code)
+            persistence.wait()
+
+            _report(progress, "rendering", 0.65)
+            logger.info(f"Queuing improved Manim rendering job with quality: {video_quality}")
+            # Call the function to queue the rendering job with quality parameter
+            with stage_slot("render"):
+                render_result = queue_manim_rendering(
+                    session_id=session_id,
+                    manim_code=improved_code,
+                    code_path=f"{session_id}/scene.py",
+                    quality=video_quality,
+                    progress=progress,
+                )
+
+        improved_video_url = render_result.get("video_url")
+
+        if improved_video_url:
+            # Update the database with the improved video
+            logger.info(f"Rendering of improved video completed successfully, URL: {improved_video_url}")
+            publish(session_id, "artifact", kind="video", url=improved_video_url)
+            logger.info(f"Updating project status to 'improved_render_complete' for session: {session_id}")
+            persistence.run(_update_project, session_id, {
+                "status": "improved_render_complete",
+                "video_url": improved_video_url,
+            })
+
+            response = {
+                "session_id": session_id,
+                "improved_video_url": improved_video_url,
+                "code_url": code_url,
+                "visuals_url": visuals_url,
+                "status": "improved_render_complete",
+                "review_score": score,
+                "review_text": review_text,
+                "message": f"Video has been improved based on feedback. Original score: {score}/100."
+            }
+        else:
+            # Improvement rendering failed
+            error = render_result.get("error", "Unknown error during rendering")
+            logger.error(f"Improved video rendering failed: {error}")
+            response = {
+                "session_id": session_id,
+                "code_url": code_url,
+                "visuals_url": visuals_url,
+                "status": "review_complete",
+                "review_score": score,
+                "review_text": review_text,
+                "message": f"Video was reviewed (score: {score}/100), but improvement rendering failed: {error}"
+            }
+    else:
+        # No improvement needed
+        logger.info(f"Video doesn't need improvement (score: {score}/100)")
+        response = {
+            "session_id": session_id,
+            "improved_video_url": video_url,
+            "code_url": code_url,
+            "visuals_url": visuals_url,
+            "status": "review_complete",
+            "review_score": score,
+            "review_text": review_text,
+            "message": f"Video was reviewed. Score: {score}/100. No improvement needed."
+        }
+
+    return response, 200
+
+
+@tracks_usage
+def run_script_generation(
+    session_id: str, bypass_cache: bool = False, on_token: Optional[TokenCallback] = None
+) -> StageResult:
+    """
+    Generate and store the script for a session from its problem analysis
+
+    Args:
+        session_id: Unique session identifier
+        bypass_cache: Regenerate instead of reusing a memoized script
+        on_token: Optional callback receiving script text chunks as they are generated
+
+    Returns:
+        tuple: Response payload and HTTP status code
+    """
+    project_data = _fetch_project(session_id)
+    if not project_data:
+        logger.error(f"No project found with session_id: {session_id}")
+        return {"error": f"No project found with session_id: {session_id}"}, 404
+
+    # Check if the project has been processed
+    if not project_data.get('problem_analysis'):
+        logger.error(f"Problem analysis not found for session: {session_id}")
+        return {"error": "Problem analysis has not been generated yet"}, 400
+
+    # Generate script
+    logger.info("Generating script from problem analysis")
+    publish(session_id, "stage", stage="generating_script")
+    script = write_script(
+        project_data['problem_analysis'],
+        bypass_cache=bypass_cache,
+        on_token=token_events(session_id, "script", on_token),
+    )
+    logger.info("Script generation completed")
+
+    # Store script in Supabase and update the project status
+    script_url = store_script(session_id, script, Persistence())
+
+    return {
+        "session_id": session_id,
+        "script_url": script_url,
+        "script_text": script,
+        "status": "script_generated",
+        "message": "Script generated successfully. Use the session_id to generate a video."
+    }, 200
+
+
+@tracks_usage
+def run_visuals_generation(
+    session_id: str, bypass_cache: bool = False, on_token: Optional[TokenCallback] = None
+) -> StageResult:
+    """
+    Generate and store the visual elements for a session from its script
+
+    Args:
+        session_id: Unique session identifier
+        bypass_cache: Regenerate instead of reusing memoized visual elements
+        on_token: Optional callback receiving visual elements text chunks as they are generated
+
+    Returns:
+        tuple: Response payload and HTTP status code
+    """
+    project_data = _fetch_project(session_id)
+    if not project_data:
+        logger.error(f"No project found with session_id: {session_id}")
+        return {"error": f"No project found with session_id: {session_id}"}, 404
+
+    # Check if we have a script
+    if not project_data.get('script_url'):
+        logger.error(f"Script URL not found for session: {session_id}")
+        return {"error": "Script has not been generated yet"}, 400
+
+    # Get the script from the session cache, or from the stored URL on a miss
+    script, error_result = load_artifact(session_id, "script", project_data.get('script_url'))
+    if error_result:
+        return error_result
+
+    # Generate visual elements
+    logger.info("Generating visual elements from script")
+    publish(session_id, "stage", stage="generating_visuals")
+    visual_elements = write_visuals(
+        script,
+        bypass_cache=bypass_cache,
+        on_token=token_events(session_id, "visuals", on_token),
+    )
+    logger.info("Visual elements generation completed")
+
+    # Store visual elements in Supabase and update the project status
+    visuals_url = store_visuals(session_id, visual_elements, Persistence())
+
+    return {
+        "session_id": session_id,
+        "visuals_url": visuals_url,
+        "visuals_text": visual_elements,
+        "status": "visuals_generated",
+        "message": "Visual elements generated successfully. Use the session_id to generate a video."
+    }, 200
+
+
+@tracks_usage
+def run_video_generation(
+    session_id: str, video_quality: str, bypass_cache: bool = False, progress: Optional[ProgressCallback] = None
+) -> StageResult:
+    """
+    Generate Manim code from the stored visual elements and render it into a video
+
+    Args:
+        session_id: Unique session identifier
+        video_quality: Video quality to render with (low, medium or high)
+        bypass_cache: Generate and fix code afresh instead of reusing cached LLM responses
+        progress: Optional callback receiving (stage, fraction_complete) updates
+
+    Returns:
+        tuple: Response payload and HTTP status code
+    """
+    progress = _with_events(session_id, progress)
+
+    # Get the project data from Supabase
+    _report(progress, "fetching_project", 0.0)
+    project_data = _fetch_project(session_id)
+    if not project_data:
+        logger.error(f"No project found with session_id: {session_id}")
+        return {"error": f"No project found with session_id: {session_id}"}, 404
+
+    # Check if we have visuals
+    if not project_data.get('visuals_url'):
+        logger.error(f"Visuals URL not found for session: {session_id}")
+        return {"error": "Visuals has not been generated yet"}, 400
+
+    # Get the visual elements from the stored URL
+    visuals_url = project_data.get('visuals_url')
+    _report(progress, "fetching_visuals", 0.05)
+    visual_elements, error_result = load_artifact(session_id, "visual elements", visuals_url)
+    if error_result:
+        return error_result
+
+    with bypass_llm_cache(bypass_cache):
+        result = _generate_and_render(
+            session_id, visual_elements, visuals_url, video_quality, progress, Persistence()
+        )
+    _report(progress, "complete", 1.0)
+    return result
+
+
+@tracks_usage
+def run_video_improvement(
+    session_id: str, video_quality: str, bypass_cache: bool = False, progress: Optional[ProgressCallback] = None
+) -> StageResult:
+    """
+    Review a generated video and re-render it from improved code when needed
+
+    Args:
+        session_id: Unique session identifier
+        video_quality: Video quality to render with (low, medium or high)
+        bypass_cache: Generate and fix the improved code afresh instead of reusing cached LLM responses
+        progress: Optional callback receiving (stage, fraction_complete) updates
+
+    Returns:
+        tuple: Response payload and HTTP status code
+    """
+    progress = _with_events(session_id, progress)
+
+    # Get the project data from Supabase
+    _report(progress, "fetching_project", 0.0)
+    project_data = _fetch_project(session_id)
+    if not project_data:
+        logger.error(f"No project found with session_id: {session_id}")
+        return {"error": f"No project found with session_id: {session_id}"}, 404
+
+    # Check if we have a video to improve
+    if not project_data.get('video_url'):
+        logger.error(f"Video URL not found for session: {session_id}")
+        return {"error": "Video has not been generated yet"}, 400
+
+    with bypass_llm_cache(bypass_cache):
+        result = _review_and_improve(
+            session_id,
+            video_url=project_data.get('video_url'),
+            code_url=project_data.get('code_url'),
+            visuals_url=project_data.get('visuals_url'),
+            visual_elements=None,
+            video_quality=video_quality,
+            progress=progress,
+            persistence=Persistence(),
+        )
+    _report(progress, "complete", 1.0)
+    return result
+
+
+@tracks_usage
+def run_full_pipeline(
+    session_id: str,
+    image: IngestedImage,
+    video_quality: str,
+    review: bool = False,
+    bypass_cache: bool = False,
+    progress: Optional[ProgressCallback] = None,
+    parent_id: Optional[str] = None,
+) -> StageResult:
+    """
+    Run analysis, script, visuals, code generation, rendering and optional review in one pass.
+
+    Artifacts are handed from stage to stage in memory; uploads and project row writes are
+    deferred to the persistence thread so they overlap with the next LLM call.
+
+    Args:
+        session_id: Unique session identifier for the new project
+        image: Validated upload with its vision-ready variant
+        video_quality: Video quality to render with (low, medium or high)
+        review: Whether to review the rendered video and improve it if needed
+        bypass_cache: Regenerate analysis, script, visuals and code instead of reusing memoized or cached results
+        progress: Optional callback receiving (stage, fraction_complete) updates
+        parent_id: Session id of the worksheet this problem was cropped from, if any
+
+    Returns:
+        tuple: Response payload and HTTP status code
+    """
+    progress = _with_events(session_id, progress)
+    persistence = Persistence(deferred=True)
+
+    try:
+        _report(progress, "analyzing_problem", 0.0)
+        image_url = store_image(session_id, image, persistence)
+        logger.info("Starting math problem analysis")
+        problem_analysis = analyze_problem(image, bypass_cache=bypass_cache)
+        logger.info("Math problem analysis completed")
+        create_project(session_id, problem_analysis, image_url, persistence, parent_id=parent_id)
+
+        _report(progress, "generating_script", 0.15)
+        logger.info("Generating script from problem analysis")
+        script = write_script(
+            problem_analysis, bypass_cache=bypass_cache, on_token=token_events(session_id, "script")
+        )
+        logger.info("Script generation completed")
+        script_url = store_script(session_id, script, persistence)
+
+        _report(progress, "generating_visuals", 0.25)
+        logger.info("Generating visual elements from script")
+        visual_elements = write_visuals(
+            script, bypass_cache=bypass_cache, on_token=token_events(session_id, "visuals")
+        )
+        logger.info("Visual elements generation completed")
+        visuals_url = store_visuals(session_id, visual_elements, persistence)
+
+        video_end = 0.8 if review else 1.0
+        # Regenerating also means fresh code, not the cached response to the same visuals
+        with bypass_llm_cache(bypass_cache):
+            response, status_code = _generate_and_render(
+                session_id, visual_elements, visuals_url, video_quality,
+                _scaled(progress, 0.35, video_end), persistence,
+            )
+
+        if review and response.get("video_url"):
+            review_response, status_code = _review_and_improve(
+                session_id,
+                video_url=response["video_url"],
+                code_url=response["code_url"],
+                visuals_url=visuals_url,
+                visual_elements=visual_elements,
+                video_quality=video_quality,
+                progress=_scaled(progress, video_end, 1.0),
+                persistence=persistence,
+            )
+            response = dict(response, **review_response)
+
+        response.update({
+            "image_url": image_url,
+            "script_url": script_url,
+            "problem_analysis": problem_analysis,
+        })
+        if parent_id:
+            response["parent_id"] = parent_id
+    finally:
+        # Make sure every artifact is stored before the result is reported
+        persistence.wait()
+
+    _report(progress, "complete", 1.0)
+    return response, status_code
+
+
+@tracks_usage
+def split_worksheet(
+    session_id: str, image: IngestedImage, bypass_cache: bool = False
+) -> Tuple[str, List[Dict], List[bytes]]:
+    """
+    Store a worksheet image under a parent session and cut it into one image per problem
+
+    Args:
+        session_id: Session identifier of the parent worksheet project
+        image: Validated upload of the whole worksheet
+        bypass_cache: Detect regions again instead of reusing a memoized result
+
+    Returns:
+        tuple: Image URL of the worksheet, the detected regions and one cropped image per region;
+               a worksheet with a single problem yields the whole image as its only crop
+    """
+    persistence = Persistence()
+    publish(session_id, "stage", stage="detecting_problems")
+    image_url = store_image(session_id, image, persistence)
+
+    regions = find_problem_regions(image, bypass_cache=bypass_cache)
+    logger.info(f"Detected {len(regions)} problem regions for session: {session_id}")
+    if len(regions) > 1:
+        crops = crop_regions(image, [region["box"] for region in regions])
+    else:
+        regions = [{"label": "1", "box": [0.0, 0.0, 1.0, 1.0]}]
+        crops = [image.original]
+
+    persistence.run(status_journal.insert, {
+        "id": session_id,
+        "status": "worksheet_split",
+        "image_url": image_url,
+        "created_at": "now()",
+        **usage_ledger.fields(session_id),
+    })
+    publish(session_id, "stage", stage="worksheet_split", problems=len(regions))
+    return image_url, regions, crops
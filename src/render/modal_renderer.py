@@ -1,6 +1,8 @@
+import contextlib
 import os
 import random
 import tempfile
+import time
 import re
 import subprocess
 from modal import Image, App, method, fastapi_endpoint, Secret
@@ -33,6 +35,45 @@ manim_image = (
 # Create an App with the image and secrets
 app = App("manim-renderer", image=manim_image, secrets=[Secret.from_name("supabase-secrets")])
 
+class SpanRecorder:
+    """
+    Records trace spans inside the container, in the Zipkin v2 format the caller exports
+
+    The container cannot import the app's tracing module, so it keeps its own spans and returns
+    them with the render result. Without a trace context nothing is recorded.
+    """
+
+    def __init__(self, traceparent=None):
+        parts = (traceparent or "").split("-")
+        self.trace_id, self.parent_id = (parts[1], parts[2]) if len(parts) == 4 else (None, None)
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, **tags):
+        if self.trace_id is None:
+            yield
+            return
+        span_id = f"{random.getrandbits(64):016x}"
+        parent_id, self.parent_id = self.parent_id, span_id
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            tags["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.parent_id = parent_id
+            self.spans.append({
+                "traceId": self.trace_id,
+                "id": span_id,
+                "parentId": parent_id,
+                "name": name,
+                "timestamp": int(start * 1_000_000),
+                "duration": max(1, int((time.time() - start) * 1_000_000)),
+                "localEndpoint": {"serviceName": "manim-renderer"},
+                "tags": {key: str(value) for key, value in tags.items()},
+            })
+
 # Modal class for rendering
 @app.cls(gpu="L40S:2", timeout=420)
 class ManimRenderer:
@@ -45,17 +86,37 @@ class ManimRenderer:
         self.supabase = create_client(supabase_url, supabase_key)
         
         
+    def _update_project(self, session_id, fields, record_status):
+        """Write render statuses to the project row, unless the caller records them itself"""
+        if record_status:
+            self.supabase.table("manim_projects").update(fields).eq("id", session_id).execute()
+        
     @method()
-    def render_video(self, session_id, manim_code, quality):
-        """Render a Manim video based on provided code"""
+    def render_video(self, session_id, manim_code, quality, upload=True, record_status=True, trace_context=None):
+        """
+        Render a Manim video based on provided code
+
+        With upload=False the video is returned as video_bytes instead of being uploaded to
+        Supabase storage, for callers that keep artifacts in another storage backend. With
+        record_status=False the project row is left untouched, for callers that journal the
+        render statuses together with their own writes. Given a W3C traceparent as trace_context,
+        the render is traced as a child of it and the spans are returned under "spans".
+        """
+        tracer = SpanRecorder(trace_context)
+        with tracer.span("modal.render", session_id=session_id, quality=quality):
+            result = self._render(session_id, manim_code, quality, upload, record_status, tracer)
+        if trace_context:
+            result["spans"] = tracer.spans
+        return result
+
+    def _render(self, session_id, manim_code, quality, upload, record_status, tracer):
         try:
             # Ensure supabase is initialized
-            self.__enter__()
+            with tracer.span("modal.setup"):
+                self.__enter__()
             
             # Mark project as rendering in Supabase
-            self.supabase.table("manim_projects").update(
-                {"status": "rendering"}
-            ).eq("id", session_id).execute()
+            self._update_project(session_id, {"status": "rendering"}, record_status)
             
             # Create a temporary directory for rendering
             with tempfile.TemporaryDirectory() as temp_dir:
@@ -80,13 +141,14 @@ class ManimRenderer:
                 ]
                 
                 # Execute the command
-                process = subprocess.run(cmd, capture_output=True, text=True)
+                with tracer.span("manim.subprocess", scene=scene_class, quality=quality):
+                    process = subprocess.run(cmd, capture_output=True, text=True)
                 
                 if process.returncode != 0:
                     # Update project status to failed
-                    self.supabase.table("manim_projects").update({
+                    self._update_project(session_id, {
                         "status": "render_failed",
-                    }).eq("id", session_id).execute()
+                    }, record_status)
                     
                     return {
                         "status": "error",
@@ -97,9 +159,9 @@ class ManimRenderer:
                 # Find the rendered video
                 videos_dir = os.path.join(temp_dir, "videos")
                 if not os.path.exists(videos_dir):
-                    self.supabase.table("manim_projects").update({
+                    self._update_project(session_id, {
                         "status": "render_failed",
-                    }).eq("id", session_id).execute()
+                    }, record_status)
                     
                     return {
                         "status": "error",
@@ -114,9 +176,9 @@ class ManimRenderer:
                             mp4_files.append(os.path.join(root, file))
                 
                 if not mp4_files:
-                    self.supabase.table("manim_projects").update({
+                    self._update_project(session_id, {
                         "status": "render_failed",
-                    }).eq("id", session_id).execute()
+                    }, record_status)
                     
                     return {
                         "status": "error",
@@ -125,6 +187,15 @@ class ManimRenderer:
                 
                 video_path = max(mp4_files, key=os.path.getsize)
                 
+                if not upload:
+                    with open(video_path, "rb") as video_file:
+                        return {
+                            "session_id": session_id,
+                            "status": "render_complete",
+                            "video_bytes": video_file.read(),
+                            "message": "Video rendering complete."
+                        }
+                
                 # Upload video to Supabase
                 with open(video_path, "rb") as video_file:
                     video_bytes = video_file.read()
@@ -133,28 +204,30 @@ class ManimRenderer:
                     storage_video_path = f"{session_id}/{random.randint(100000, 999999)}.mp4"
                     
                     # Upload
-                    self.supabase.storage.from_("manim-generator").upload(
-                        storage_video_path,
-                        video_bytes,
-                        {
-                            "content-type": "video/mp4",
-                            "upsert": "true"
-                        }
-                    )
+                    with tracer.span("supabase.upload", path=storage_video_path, bytes=len(video_bytes)):
+                        self.supabase.storage.from_("manim-generator").upload(
+                            storage_video_path,
+                            video_bytes,
+                            {
+                                "content-type": "video/mp4",
+                                "upsert": "true"
+                            }
+                        )
                     
                     # Get public URL
                     video_url = self.supabase.storage.from_("manim-generator").get_public_url(storage_video_path)
                     
                     # Update project status
-                    self.supabase.table("manim_projects").update({
+                    self._update_project(session_id, {
                         "status": "render_complete",
                         "video_url": video_url
-                    }).eq("id", session_id).execute()
+                    }, record_status)
                     
                     return {
                         "session_id": session_id,
                         "status": "render_complete",
                         "video_url": video_url,
+                        "video_size": len(video_bytes),
                         "message": "Video rendering complete."
                     }
         
@@ -165,9 +238,9 @@ class ManimRenderer:
             
             # Update project status to failed
             try:
-                self.supabase.table("manim_projects").update({
+                self._update_project(session_id, {
                     "status": "render_failed",
-                }).eq("id", session_id).execute()
+                }, record_status)
             except:
                 pass
             
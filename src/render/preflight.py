@@ -0,0 +1,290 @@
+"""
+Static checks of generated Manim code before it is sent to Modal
+
+Code that cannot parse, uses names manim does not have, passes keyword arguments a class does
+not accept, or defines no scene the renderer can find fails in the container after several
+seconds of startup. These checks find such code in milliseconds with `ast` and the manim symbol
+index (resources/manim_symbols.json, built by src.render.symbol_index), and the problems go
+straight to the code fixer instead of a render.
+"""
+import ast
+import builtins
+import difflib
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Union
+
+from src.config import PREFLIGHT_ENABLED, load_resource
+from src.events import publish
+from src.metrics import PREFLIGHT_CHECKS
+from src.tracing import span
+
+logger = logging.getLogger('image-to-manim')
+
+# The pattern ManimRenderer uses to pick the scene to render; without a match it renders EducationalScene
+RENDERED_SCENE = re.compile(r'class\s+(\w+)\s*\(\s*Scene\s*\)')
+DEFAULT_SCENE = "EducationalScene"
+MODULE_NAMES = frozenset({"__name__", "__file__", "__doc__", "__builtins__", "__spec__", "__loader__", "__package__"})
+
+
+class CodeIssue(NamedTuple):
+    """A problem found in generated code, named after the exception it would raise"""
+    kind: str
+    message: str
+    line: Optional[int]
+
+    def __str__(self) -> str:
+        return f"{self.kind}: {self.message}" + (f" (line {self.line})" if self.line else "")
+
+
+class SymbolIndex(NamedTuple):
+    """What `from manim import *` provides, as recorded by src.render.symbol_index"""
+    version: str
+    exports: Dict[str, str]
+    keywords: Dict[str, Set[str]]
+    scenes: Set[str]
+
+
+@functools.lru_cache(maxsize=None)
+def symbol_index() -> Optional[SymbolIndex]:
+    """Load the manim symbol index once per process; None if it is missing"""
+    try:
+        data = json.loads(load_resource("manim_symbols.json"))
+    except Exception as e:
+        logger.warning(f"Manim symbol index unavailable, generated code is not checked before rendering: {str(e)}")
+        return None
+    return SymbolIndex(
+        data["version"],
+        data["exports"],
+        {name: set(keywords) for name, keywords in data["keywords"].items()},
+        set(data["scenes"]),
+    )
+
+
+def _suggestion(name: str, candidates) -> str:
+    matches = difflib.get_close_matches(name, list(candidates), n=1, cutoff=0.8)
+    return f". Did you mean: '{matches[0]}'?" if matches else ""
+
+
+def _bindings(tree: ast.Module):
+    """
+    Names the code binds, the names bound only by importing them from manim, the aliases of the
+    manim module itself, and whether a star import from elsewhere leaves names unknown
+    """
+    bound: Set[str] = set()
+    from_manim: Set[str] = set()
+    manim_aliases: Set[str] = set()
+    manim_star = unknown_star = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            bound.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            bound.add(node.rest)
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name == "manim":
+                    manim_aliases.add(alias.asname or "manim")
+                bound.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                if alias.name == "*":
+                    if node.module == "manim" and not node.level:
+                        manim_star = True
+                    else:
+                        unknown_star = True
+                elif node.module == "manim" and not node.level:
+                    from_manim.add(alias.asname or alias.name)
+                else:
+                    bound.add(alias.asname or alias.name)
+    return bound, from_manim, manim_aliases, manim_star, unknown_star
+
+
+def validate_manim_code(code: str, index: Optional[SymbolIndex] = None) -> List[CodeIssue]:
+    """
+    Check generated Manim code without running it
+
+    Args:
+        code: The generated program
+        index: Symbol index to check names against; defaults to the one for the renderer's manim
+
+    Returns:
+        list: Problems found, in order of appearance; empty if the code looks renderable
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [CodeIssue("SyntaxError", e.msg, e.lineno)]
+    index = index or symbol_index()
+    if index is None:
+        return []
+
+    issues: List[CodeIssue] = []
+    bound, from_manim, manim_aliases, manim_star, unknown_star = _bindings(tree)
+    known = set(dir(builtins)) | MODULE_NAMES | bound | from_manim
+    if manim_star:
+        known |= set(index.exports)
+
+    def manim_name(func: ast.expr) -> Optional[str]:
+        """The manim export a call goes to, unless the code binds that name itself"""
+        if isinstance(func, ast.Name) and func.id not in bound and (func.id in from_manim or manim_star):
+            return func.id
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in manim_aliases:
+            return func.attr
+        return None
+
+    reported: Set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module == "manim" and not node.level:
+            for alias in node.names:
+                if alias.name != "*" and alias.name not in index.exports:
+                    issues.append(CodeIssue(
+                        "ImportError",
+                        f"cannot import name '{alias.name}' from 'manim' {index.version}"
+                        + _suggestion(alias.name, index.exports),
+                        node.lineno,
+                    ))
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            if not unknown_star and node.id not in known and node.id not in reported:
+                reported.add(node.id)
+                if node.id in index.exports:
+                    message = f"name '{node.id}' is not defined; it is part of manim, add `from manim import *`"
+                else:
+                    message = f"name '{node.id}' is not defined, in the code or in manim {index.version}" + _suggestion(node.id, known)
+                issues.append(CodeIssue("NameError", message, node.lineno))
+        elif (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in manim_aliases
+              and node.attr not in index.exports):
+            issues.append(CodeIssue(
+                "AttributeError",
+                f"module 'manim' has no attribute '{node.attr}'" + _suggestion(node.attr, index.exports),
+                node.lineno,
+            ))
+        elif isinstance(node, ast.Call):
+            name = manim_name(node.func)
+            accepted = index.keywords.get(name) if name else None
+            if accepted is None:
+                continue
+            for keyword in node.keywords:
+                if keyword.arg is not None and keyword.arg not in accepted:
+                    issues.append(CodeIssue(
+                        "TypeError",
+                        f"{name}() got an unexpected keyword argument '{keyword.arg}'" + _suggestion(keyword.arg, accepted),
+                        keyword.value.lineno,
+                    ))
+
+    issues.extend(_scene_issues(tree, code, index, bound))
+    return sorted(issues, key=lambda issue: issue.line or 0)
+
+
+def _scene_issues(tree: ast.Module, code: str, index: SymbolIndex, bound: Set[str]) -> List[CodeIssue]:
+    """Check that a Scene subclass exists and is the one the renderer will pick"""
+    classes = {node.name: node for node in ast.walk(tree) if isinstance(node, ast.ClassDef)}
+    scenes: Set[str] = set()
+    changed = True
+    while changed:
+        changed = False
+        for name, node in classes.items():
+            if name in scenes:
+                continue
+            for base in node.bases:
+                base_name = base.attr if isinstance(base, ast.Attribute) else getattr(base, "id", None)
+                if base_name in scenes or (base_name in index.scenes and base_name not in classes):
+                    scenes.add(name)
+                    changed = True
+                    break
+    if not scenes:
+        return [CodeIssue("SceneError", "no class deriving from Scene is defined, so there is nothing to render", None)]
+    match = RENDERED_SCENE.search(code)
+    rendered = match.group(1) if match else DEFAULT_SCENE
+    if rendered not in scenes:
+        return [CodeIssue(
+            "SceneError",
+            f"the renderer renders the first class declared as `class Name(Scene)`, or else {DEFAULT_SCENE}; "
+            f"declare the main scene ({', '.join(sorted(scenes))}) that way",
+            classes[rendered].lineno if rendered in classes else None,
+        )]
+    return []
+
+
+def format_issues(issues: List[CodeIssue]) -> str:
+    """Describe the problems for the code fixer, as a render error would"""
+    return "The generated code was not rendered because checking it found these errors:\n" + "\n".join(
+        str(issue) for issue in issues
+    )
+
+
+class PreflightStats:
+    """Counts of checked programs, the problems found and the renders they saved"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checks = 0
+        self._failed = 0
+        self._kinds: Dict[str, int] = {}
+        self._seconds = 0.0
+        self._max_seconds = 0.0
+
+    def record(self, issues: List[CodeIssue], seconds: float) -> None:
+        with self._lock:
+            self._checks += 1
+            self._seconds += seconds
+            self._max_seconds = max(self._max_seconds, seconds)
+            if issues:
+                self._failed += 1
+                for issue in issues:
+                    self._kinds[issue.kind] = self._kinds.get(issue.kind, 0) + 1
+
+    def stats(self) -> Dict[str, Union[bool, str, int, float, Dict[str, int]]]:
+        index = symbol_index() if PREFLIGHT_ENABLED else None
+        with self._lock:
+            return {
+                "enabled": PREFLIGHT_ENABLED,
+                "manim_version": index.version if index else None,
+                "checks": self._checks,
+                "passed": self._checks - self._failed,
+                "failed": self._failed,
+                # Every failed check is a Modal render that was not started
+                "renders_saved": self._failed,
+                "issues": dict(self._kinds),
+                "avg_ms": round(self._seconds / self._checks * 1000, 2) if self._checks else 0.0,
+                "max_ms": round(self._max_seconds * 1000, 2),
+            }
+
+
+preflight_stats = PreflightStats()
+
+
+def preflight_check(session_id: str, code: str) -> Optional[str]:
+    """
+    Check code before rendering it
+
+    Returns:
+        str: The problems found, worded for fix_manim_code; None if the code may be rendered
+    """
+    if not PREFLIGHT_ENABLED:
+        return None
+    with span("render.preflight", session_id=session_id) as preflight_span:
+        start = time.perf_counter()
+        issues = validate_manim_code(code)
+        seconds = time.perf_counter() - start
+        preflight_span.set_attribute("issues", len(issues))
+    preflight_stats.record(issues, seconds)
+    PREFLIGHT_CHECKS.labels(issues[0].kind if issues else "passed").inc()
+    if not issues:
+        return None
+    print(f"Pre-render check found {len(issues)} problem(s) in {seconds * 1000:.1f} ms, skipping the render")
+    publish(session_id, "preflight", issues=[str(issue) for issue in issues][:20])
+    return format_issues(issues)
@@ -1,13 +1,195 @@
 """
 Functions for rendering Manim code into videos using Modal
 """
+import atexit
+import contextlib
+import contextvars
+import random
+import threading
 import time
-from typing import Dict, Union
-from src.config import supabase
-from src.storage import update_code_in_storage
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+from src.clients import modal_renderer
+from src.concurrency import Overloaded, stage_slot
+from src.config import CODEGEN_CANDIDATES, CODEGEN_CANDIDATE_TEMPERATURES
+from src.events import publish
+from src.journal import status_journal
+from src.llm_cache import llm_cache
+from src.metrics import (
+    RENDER_FAILURES,
+    RENDER_RETRIES,
+    SPECULATIVE_CANDIDATES,
+    count_storage_bytes,
+    error_class,
+    stage_timer,
+)
+from src.render.preflight import preflight_check
+from src.tracing import current_traceparent, export_remote_spans, span
+from src.storage import get_public_url, storage_backend, update_code_in_storage, upload_to_storage
+
+# Renders of fixed code after a failed render, each preceded by one fix_manim_code call
+MAX_RENDER_RETRIES = 3
+
+# Losing candidates still finishing after their race was decided, drained off the request path
+_draining: Set[threading.Thread] = set()
+_draining_lock = threading.Lock()
+
+def store_rendered_video(session_id: str, result: Dict) -> Optional[str]:
+    """
+    Store a video returned by the renderer in the configured storage backend and record the
+    render outcome on the project row
+
+    Args:
+        session_id (str): Unique session identifier
+        result (dict): Result of ManimRenderer.render_video
+
+    Returns:
+        str: Public URL of the video, or the URL the renderer uploaded to itself (None on failure)
+    """
+    # Taken out of the result so it is not kept around or printed
+    video_bytes = result.pop("video_bytes", None)
+    if video_bytes is None:
+        video_url = result.get("video_url")
+        # Uploaded by the renderer itself; it reports the size so storage traffic is still counted
+        if result.get("video_size"):
+            count_storage_bytes("out", result["video_size"])
+    else:
+        video_path = f"{session_id}/{random.randint(100000, 999999)}.mp4"
+        upload_to_storage(video_path, video_bytes, "video/mp4")
+        video_url = get_public_url(video_path)
+
+    # The renderer leaves the project row to us, so its statuses are ordered with ours in the journal
+    if video_url:
+        status_journal.update(session_id, {"status": "render_complete", "video_url": video_url})
+    else:
+        status_journal.update(session_id, {"status": "render_failed"})
+        RENDER_FAILURES.labels(error_class(result.get("error") or result.get("message"))).inc()
+    return video_url
+
+def render_attempt(renderer, session_id: str, manim_code: str, quality: str, upload: bool, attempt: int) -> Dict:
+    """
+    Run one render on Modal and store its video
+
+    The render is traced as a "render.attempt" span; the renderer joins the trace and returns
+    the spans it recorded (setup, the manim subprocess, the upload), which are exported here.
+
+    Code that fails the pre-render check is not sent to Modal; its problems are returned as the error.
+
+    Returns:
+        dict: Result of ManimRenderer.render_video, with the stored video's URL as "video_url"
+    """
+    problems = preflight_check(session_id, manim_code)
+    if problems:
+        llm_cache.forget(manim_code)
+        status_journal.update(session_id, {"status": "render_failed"})
+        return {"status": "preflight_failed", "video_url": None, "error": problems}
+    status_journal.update(session_id, {"status": "rendering"})
+    with stage_timer("render_attempt"), span("render.attempt", session_id=session_id, attempt=attempt, quality=quality) as attempt_span:
+        with span("modal.render_video"):
+            result = renderer.render_video.remote(
+                session_id, manim_code, quality, upload=upload, record_status=False, trace_context=current_traceparent()
+            )
+        export_remote_spans(result.pop("spans", None))
+        result["video_url"] = store_rendered_video(session_id, result)
+        attempt_span.set_attribute("status", "render_complete" if result["video_url"] else "render_failed")
+    if not result["video_url"]:
+        # A retry must not be answered with the same failing code
+        llm_cache.forget(manim_code)
+    return result
+
+def publish_render_result(session_id: str, attempt: int, video_url: str, error_message: str) -> None:
+    """Publish the outcome of a single render attempt on the session event stream"""
+    publish(
+        session_id,
+        "render_result",
+        attempt=attempt,
+        status="render_complete" if video_url else "render_failed",
+        video_url=video_url,
+        # Tracebacks can be long; the tail holds the actual exception
+        error=error_message[-1000:] if error_message else None,
+    )
+
+def open_renderer() -> Tuple[Any, contextlib.ExitStack]:
+    """
+    Get a handle to ManimRenderer
+
+    Returns:
+        tuple: The renderer, and a context to render within: empty for the deployed app, which is
+               reused through one cached handle, else it runs an ephemeral app for this render
+    """
+    modal_context = contextlib.ExitStack()
+    with span("modal.startup") as startup_span:
+        renderer = modal_renderer()
+        startup_span.set_attribute("deployed", renderer is not None)
+        if renderer is None:
+            from src.render.modal_renderer import app, ManimRenderer
+            renderer = ManimRenderer()
+            modal_context.enter_context(app.run())
+    return renderer, modal_context
+
+def fix_and_rerender(
+    renderer, session_id: str, manim_code: str, error_message: Optional[str], code_path: str, quality: str,
+    upload: bool, progress: Optional[Callable[[str, float], None]] = None, max_retries: int = MAX_RENDER_RETRIES
+) -> Dict[str, Union[str, Dict[str, str]]]:
+    """
+    Regenerate code that failed to render from its error and render it again, until a render
+    succeeds or max_retries renders have been made; each new program is stored at code_path.
+    Must be called within the renderer's context, after the failed render counted as attempt 1.
+
+    Returns:
+        dict: Result containing video_url, error (if any), and current_code
+    """
+    retry_count = 0
+    video_url = None
+    current_code = manim_code
+    while video_url is None and retry_count < max_retries:
+        print(f"Rendering failed with error: {error_message}")
+        print(f"Regenerating Manim code based on error ({retry_count + 1}/{max_retries})...")
+        retry_count += 1
+        if progress:
+            progress(f"fixing_code_attempt_{retry_count}", 0.5 + 0.45 * retry_count / (max_retries + 1))
+        
+        # Import here to avoid circular import
+        from src.generation.fixed_code import fix_manim_code
+        
+        # Regenerate the Manim code based on the error; without new code another render would fail the same way
+        try:
+            with stage_timer("fix_attempt"), span("render.fix", session_id=session_id, attempt=retry_count):
+                current_code = fix_manim_code(previous_code=current_code, error_message=error_message, session_id=session_id)
+        except Exception as fix_error:
+            print(f"Stopping render retries: {str(fix_error)}")
+            publish(session_id, "error", stage="fix_code", error=str(fix_error))
+            error_message = f"{error_message}\n\n{str(fix_error)}"
+            break
+
+        # Update code in storage (with error handling)
+        update_code_in_storage(code_path, current_code)
+        
+        # Wait a moment before retrying
+        time.sleep(2)
+        
+        print(f"Retrying rendering job ({retry_count}/{max_retries})...")
+        if progress:
+            progress(f"rendering_attempt_{retry_count + 1}", 0.5 + 0.45 * (retry_count + 0.5) / (max_retries + 1))
+        # Make a new render request with the regenerated code
+        publish(session_id, "render_attempt", attempt=retry_count + 1, max_attempts=max_retries + 1)
+        RENDER_RETRIES.inc()
+        result_future = render_attempt(renderer, session_id, current_code, quality, upload, retry_count + 1)
+        video_url = result_future["video_url"]
+        print(f"Retry {retry_count} result: {result_future}")
+        error_message = result_future.get("error")
+        publish_render_result(session_id, retry_count + 1, video_url, error_message)
+    
+    # Return the rendering result
+    return {
+        "video_url": video_url,
+        "error": error_message,
+        "current_code": current_code
+    }
 
 def queue_manim_rendering(
-    session_id: str, manim_code: str, code_path: str, quality: str
+    session_id: str, manim_code: str, code_path: str, quality: str,
+    progress: Optional[Callable[[str, float], None]] = None
 ) -> Dict[str, Union[str, Dict[str, str]]]:
     """
     Queue Manim rendering job and handle rendering process with retries.
@@ -17,6 +199,7 @@ def queue_manim_rendering(
         manim_code (str): Generated Manim code to render
         code_path (str): Path to the stored Manim code in Supabase
         quality (str): Video quality to render with
+        progress (callable, optional): Receives (stage, fraction_complete) updates per attempt
         
     Returns:
         dict: Result containing video_url, error (if any), and current_code
@@ -33,63 +216,261 @@ def queue_manim_rendering(
         dict: Result containing video_url, error (if any), and current_code
     """
     try:
-        from src.render.modal_renderer import app, ManimRenderer
-        
         # Update status
-        supabase.table("manim_projects").update({"status": "queued_for_rendering"}).eq("id", session_id).execute()
+        status_journal.update(session_id, {"status": "queued_for_rendering"})
         
-        renderer = ManimRenderer()
+        renderer, modal_context = open_renderer()
+        # Videos go straight to Supabase from Modal; other backends receive the bytes here
+        upload = storage_backend.remote_writable
         
         # Call the Modal function asynchronously
-        with app.run():
-            result_future = renderer.render_video.remote(session_id, manim_code, quality)
+        with modal_context:
+            publish(session_id, "render_attempt", attempt=1, max_attempts=MAX_RENDER_RETRIES + 1)
+            result_future = render_attempt(renderer, session_id, manim_code, quality, upload, 1)
         
-            print(result_future)
             # Check if rendering was successful
-            video_url = result_future.get("video_url")
+            video_url = result_future["video_url"]
+            print(result_future)
             error_message = result_future.get("error")
-            retry_count = 0
-            max_retries = 3
-            current_code = manim_code
-            
+            publish_render_result(session_id, 1, video_url, error_message)
+            if video_url:
+                return {
+                    "video_url": video_url,
+                    "error": error_message,
+                    "current_code": manim_code
+                }
+
             # Handle rendering failures and retries
-            while video_url is None and retry_count < max_retries:
-                print(f"Rendering failed with error: {error_message}")
-                print(f"Regenerating Manim code based on error ({retry_count + 1}/{max_retries})...")
-                retry_count += 1
-                
-                # Import here to avoid circular import
-                from src.generation.fixed_code import fix_manim_code
-                
-                # Regenerate the Manim code based on the error
-                current_code = fix_manim_code(previous_code=current_code, error_message=error_message, session_id=session_id)
-                
-                # Update code in storage (with error handling)
-                update_code_in_storage(code_path, current_code)
-                
-                # Wait a moment before retrying
-                time.sleep(2)
-                
-                print(f"Retrying rendering job ({retry_count}/{max_retries})...")
-                # Make a new render request with the regenerated code
-                result_future = renderer.render_video.remote(session_id, current_code, quality)
-                print(f"Retry {retry_count} result: {result_future}")
-                video_url = result_future.get("video_url")
-                error_message = result_future.get("error")
-            
-            # Return the rendering result
-            return {
-                "video_url": video_url,
-                "error": error_message,
-                "current_code": current_code
-            }
+            return fix_and_rerender(renderer, session_id, manim_code, error_message, code_path, quality, upload, progress)
                 
     except Exception as modal_error:
         print(f"Error queuing Modal job: {str(modal_error)}")
+        RENDER_FAILURES.labels(type(modal_error).__name__).inc()
         
         # Return error information
         return {
             "video_url": None,
             "error": str(modal_error),
             "current_code": manim_code
-        }
\ No newline at end of file
+        }
+
+class CandidateRace:
+    """Shared state of concurrently rendered candidates: the winner, and the renders to cancel once there is one"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._winner: Optional[int] = None
+        self._calls: List[Any] = []
+
+    def decided(self) -> bool:
+        with self._lock:
+            return self._winner is not None
+
+    def track(self, call) -> bool:
+        """Register a spawned render; if a candidate already won it is cancelled and False is returned"""
+        with self._lock:
+            if self._winner is None:
+                self._calls.append(call)
+                return True
+        _cancel_render(call)
+        return False
+
+    def claim(self, index: int, call) -> bool:
+        """Make a rendered candidate the winner unless another was first, and cancel the other renders"""
+        with self._lock:
+            if self._winner is not None:
+                return False
+            self._winner = index
+            others = [other for other in self._calls if other is not call]
+        for other in others:
+            _cancel_render(other)
+        return True
+
+def _cancel_render(call) -> None:
+    try:
+        call.cancel()
+    except Exception as e:
+        print(f"Could not cancel superseded render: {str(e)}")
+
+def _run_candidate(
+    renderer, session_id: str, generate: Callable[[float, bool], str], temperature: float, use_cache: bool,
+    quality: str, upload: bool, race: CandidateRace, index: int,
+) -> Dict:
+    """Generate one program, check it and render it, unless another candidate already won"""
+    code = None
+    try:
+        with stage_slot("codegen"):
+            code = generate(temperature, use_cache)
+        if race.decided():
+            return {"outcome": "cancelled", "code": code}
+        problems = preflight_check(session_id, code)
+        if problems:
+            llm_cache.forget(code)
+            return {"outcome": "invalid", "code": code, "error": problems}
+
+        with stage_slot("render"), stage_timer("render_attempt"), span("modal.render_video"):
+            call = renderer.render_video.spawn(
+                session_id, code, quality, upload=upload, record_status=False, trace_context=current_traceparent()
+            )
+            if not race.track(call):
+                return {"outcome": "cancelled", "code": code}
+            result = call.get()
+        export_remote_spans(result.pop("spans", None))
+        if result.get("status") != "render_complete":
+            llm_cache.forget(code)
+            return {"outcome": "render_failed", "code": code, "error": result.get("error") or result.get("message")}
+        if not race.claim(index, call):
+            return {"outcome": "superseded", "code": code}
+        result["video_url"] = store_rendered_video(session_id, result)
+        return {"outcome": "won", "code": code, "video_url": result["video_url"]}
+    except Exception as e:
+        if race.decided():
+            return {"outcome": "cancelled", "code": code}
+        return {"outcome": "error", "code": code, "error": str(e), "exception": e}
+
+def _candidate(renderer, session_id: str, generate: Callable[[float, bool], str], temperature: float, use_cache: bool,
+               quality: str, upload: bool, race: CandidateRace, index: int) -> Dict:
+    """Run one candidate in its own span and report its outcome"""
+    with span("render.candidate", session_id=session_id, candidate=index + 1, temperature=temperature) as candidate_span:
+        outcome = _run_candidate(renderer, session_id, generate, temperature, use_cache, quality, upload, race, index)
+        candidate_span.set_attribute("outcome", outcome["outcome"])
+    outcome["candidate"] = index + 1
+    SPECULATIVE_CANDIDATES.labels(outcome["outcome"]).inc()
+    if outcome["outcome"] == "render_failed":
+        RENDER_FAILURES.labels(error_class(outcome["error"])).inc()
+    # Cancelled and superseded candidates finish after the winner was announced, so they are only counted
+    if outcome["outcome"] not in ("cancelled", "superseded"):
+        error = outcome.get("error")
+        publish(session_id, "candidate", candidate=index + 1, status=outcome["outcome"], error=error[-1000:] if error else None)
+    return outcome
+
+def _drain_candidates(executor: ThreadPoolExecutor, modal_context: contextlib.ExitStack) -> None:
+    """
+    Let the losing candidates finish in the background and leave the renderer context once they have
+
+    Candidates still generating cannot be interrupted, but they see the race is decided and stop
+    before rendering; the context stays open until then so none of them uses a closed app.
+    """
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    def drain():
+        try:
+            executor.shutdown(wait=True)
+            modal_context.close()
+        except Exception as e:
+            print(f"Error closing the renderer after a candidate race: {str(e)}")
+        finally:
+            with _draining_lock:
+                _draining.discard(threading.current_thread())
+
+    thread = threading.Thread(target=drain, name="codegen-candidate-drain", daemon=True)
+    with _draining_lock:
+        _draining.add(thread)
+    thread.start()
+
+def wait_for_candidates(timeout: Optional[float] = None) -> None:
+    """Wait for losing candidates still draining, e.g. before the process exits"""
+    with _draining_lock:
+        threads = list(_draining)
+    for thread in threads:
+        thread.join(timeout)
+
+atexit.register(wait_for_candidates, 30)
+
+# Failed candidates in the order they are worth fixing: a render error says more than a check, which says more than nothing
+REPAIR_PREFERENCE = ("render_failed", "invalid", "error")
+
+def render_candidates(
+    session_id: str, generate: Callable[[float, bool], str], quality: str, code_path: str,
+    progress: Optional[Callable[[str, float], None]] = None
+) -> Dict[str, Union[str, Dict[str, str]]]:
+    """
+    Generate CODEGEN_CANDIDATES programs concurrently and render each as soon as it is written;
+    the first to render is returned at once, the renders still running are cancelled and
+    candidates still generating finish in the background without rendering.
+
+    This replaces the serial generate and render, so the worst case takes about one generation
+    and one render. Candidates use the CODEGEN_CANDIDATE_TEMPERATURES in turn, and each holds
+    its own codegen and render slot while it runs. If none renders, the most promising failed
+    candidate goes through the same fix loop as queue_manim_rendering.
+
+    Args:
+        session_id (str): Unique session identifier
+        generate (callable): Writes one program, given (temperature, use_cache)
+        quality (str): Video quality to render with
+        code_path (str): Path the fix loop stores fixed code at
+        progress (callable, optional): Receives (stage, fraction_complete) updates per fix attempt
+
+    Returns:
+        dict: Result containing video_url, error (if any), and current_code (the winner's code,
+              or the last fixed program if none rendered)
+
+    Raises:
+        Overloaded: If every candidate was turned away by admission control
+        Exception: If no candidate managed to generate code
+    """
+    temperatures = [float(t) for t in CODEGEN_CANDIDATE_TEMPERATURES.split(",") if t.strip()] or [0.2]
+    status_journal.update(session_id, {"status": "queued_for_rendering"})
+    renderer, modal_context = open_renderer()
+    upload = storage_backend.remote_writable
+    race = CandidateRace()
+    outcomes = []
+
+    executor = ThreadPoolExecutor(max_workers=CODEGEN_CANDIDATES, thread_name_prefix="codegen-candidate")
+    try:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run, _candidate, renderer, session_id, generate,
+                temperatures[index % len(temperatures)],
+                # Candidates sharing a temperature would otherwise get the same cached response
+                index < len(temperatures),
+                quality, upload, race, index,
+            )
+            for index in range(CODEGEN_CANDIDATES)
+        ]
+        for future in as_completed(futures):
+            outcomes.append(future.result())
+            if outcomes[-1]["outcome"] == "won":
+                break
+    except BaseException:
+        _drain_candidates(executor, modal_context)
+        raise
+
+    winner = next((outcome for outcome in outcomes if outcome["outcome"] == "won"), None)
+    if winner:
+        # The winner is returned at once; the losers' renders are cancelled and they finish in the background
+        _drain_candidates(executor, modal_context)
+        publish_render_result(session_id, winner["candidate"], winner["video_url"], None)
+        return {"video_url": winner["video_url"], "error": None, "current_code": winner["code"]}
+
+    # Every candidate has finished
+    executor.shutdown()
+    with modal_context:
+        rejected = [outcome["exception"] for outcome in outcomes if isinstance(outcome.get("exception"), Overloaded)]
+        if rejected and len(rejected) == len(outcomes):
+            raise rejected[0]
+        failed = [
+            outcome for outcome in outcomes
+            if outcome["code"] and outcome["outcome"] in REPAIR_PREFERENCE and not isinstance(outcome.get("exception"), Overloaded)
+        ]
+        if not failed:
+            errors = "\n\n".join(
+                f"Candidate {outcome['candidate']} ({outcome['outcome']}): {outcome['error']}"
+                for outcome in outcomes if outcome.get("error")
+            )
+            raise Exception(f"Failed to generate Manim code: {errors}")
+
+        # Outcomes are in the order the candidates finished, so ties go to the first written
+        best = min(failed, key=lambda outcome: REPAIR_PREFERENCE.index(outcome["outcome"]))
+        print(f"No candidate rendered, fixing candidate {best['candidate']} ({best['outcome']})")
+        status_journal.update(session_id, {"status": "render_failed"})
+        publish_render_result(session_id, 1, None, best["error"])
+        try:
+            with stage_slot("render"):
+                return fix_and_rerender(renderer, session_id, best["code"], best["error"], code_path, quality, upload, progress)
+        except Overloaded:
+            raise
+        except Exception as modal_error:
+            print(f"Error queuing Modal job: {str(modal_error)}")
+            RENDER_FAILURES.labels(type(modal_error).__name__).inc()
+            return {"video_url": None, "error": str(modal_error), "current_code": best["code"]}
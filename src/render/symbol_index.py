@@ -0,0 +1,366 @@
+"""
+Builds the index of the manim API that generated code is checked against before rendering
+
+The index is made from manim's source without importing it (manim needs Cairo, Pango and
+LaTeX, which only the Modal image has). It lists every name `from manim import *` provides,
+the keyword arguments each class and function accepts, and the Scene classes. Rebuild it when
+the renderer's manim version changes:
+
+    python -m src.render.symbol_index path/to/manim-0.19.0-py3-none-any.whl
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import zipfile
+from typing import Dict, List, Optional, Set, Tuple
+
+from src.config import RESOURCES_DIR
+
+INDEX_FILE = "manim_symbols.json"
+
+# Module-level binding: ("class" | "function", node, module), ("ref", module, name), ("module", module) or ("constant",)
+Binding = Tuple
+
+
+class ManimSource:
+    """The `manim` package sources, read from an installed package directory or a wheel"""
+
+    def __init__(self, path: str):
+        if zipfile.is_zipfile(path):
+            archive = zipfile.ZipFile(path)
+            self.files = {
+                name: archive.read(name).decode("utf-8")
+                for name in archive.namelist() if name.startswith("manim/") and name.endswith(".py")
+            }
+            metadata = next((name for name in archive.namelist() if name.endswith(".dist-info/METADATA")), None)
+            text = archive.read(metadata).decode("utf-8") if metadata else ""
+        else:
+            root = path[:-len("/manim")] if path.rstrip("/").endswith("/manim") else path
+            self.files = {}
+            for directory, _, names in os.walk(os.path.join(root, "manim")):
+                for name in names:
+                    if name.endswith(".py"):
+                        full = os.path.join(directory, name)
+                        with open(full, "r", encoding="utf-8") as f:
+                            self.files[os.path.relpath(full, root).replace(os.sep, "/")] = f.read()
+            text = ""
+        match = re.search(r"^Version:\s*(\S+)", text, re.MULTILINE)
+        self.version = match.group(1) if match else "unknown"
+
+    def path_of(self, module: str) -> Optional[str]:
+        base = module.replace(".", "/")
+        for path in (f"{base}/__init__.py", f"{base}.py"):
+            if path in self.files:
+                return path
+        return None
+
+
+class SymbolResolver:
+    """Resolves the module-level names of manim's modules to the classes and functions defining them"""
+
+    def __init__(self, source: ManimSource):
+        self.source = source
+        self._modules: Dict[str, Tuple[Dict[str, Binding], Optional[List[str]]]] = {}
+        self._keywords: Dict[Tuple[str, str], Optional[Set[str]]] = {}
+
+    def module(self, name: str) -> Tuple[Dict[str, Binding], Optional[List[str]]]:
+        """Return a module's bindings and its `__all__` (None when it has none)"""
+        if name not in self._modules:
+            # Cyclic star imports see the partial module, as Python would
+            self._modules[name] = ({}, None)
+            self._modules[name] = self._parse(name)
+        return self._modules[name]
+
+    def exports(self, name: str) -> Dict[str, Binding]:
+        """The names `from <module> import *` provides"""
+        bindings, names = self.module(name)
+        if names is None:
+            return {key: value for key, value in bindings.items() if not key.startswith("_")}
+        return {key: bindings.get(key, ("constant",)) for key in names}
+
+    def _absolute(self, module: str, level: int, target: Optional[str]) -> str:
+        path = self.source.path_of(module)
+        package = module if path and path.endswith("__init__.py") else module.rpartition(".")[0]
+        for _ in range(level - 1):
+            package = package.rpartition(".")[0]
+        if not level:
+            return target or ""
+        return f"{package}.{target}" if target else package
+
+    def _parse(self, name: str) -> Tuple[Dict[str, Binding], Optional[List[str]]]:
+        path = self.source.path_of(name)
+        if path is None:
+            return {}, None
+        tree = ast.parse(self.source.files[path])
+        bindings: Dict[str, Binding] = {}
+        names: Optional[List[str]] = None
+
+        def bind_target(target: ast.AST, value: Binding) -> None:
+            if isinstance(target, ast.Name):
+                bindings[target.id] = value
+            elif isinstance(target, (ast.Tuple, ast.List)):
+                for element in target.elts:
+                    bind_target(element, ("constant",))
+
+        def visit(statements: List[ast.stmt]) -> None:
+            nonlocal names
+            for node in statements:
+                if isinstance(node, ast.ClassDef):
+                    bindings[node.name] = ("class", node, name)
+                elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    bindings[node.name] = ("function", node, name)
+                elif isinstance(node, ast.Import):
+                    for alias in node.names:
+                        if alias.asname:
+                            bindings[alias.asname] = ("module", alias.name)
+                        else:
+                            head = alias.name.split(".")[0]
+                            bindings[head] = ("module", head)
+                elif isinstance(node, ast.ImportFrom):
+                    source = self._absolute(name, node.level, node.module)
+                    internal = source == "manim" or source.startswith("manim.")
+                    for alias in node.names:
+                        if alias.name == "*":
+                            if internal:
+                                bindings.update(self.exports(source))
+                            continue
+                        bound = alias.asname or alias.name
+                        submodule = f"{source}.{alias.name}"
+                        if not internal:
+                            bindings[bound] = ("constant",)
+                        elif alias.name not in self.module(source)[0] and self.source.path_of(submodule):
+                            bindings[bound] = ("module", submodule)
+                        else:
+                            bindings[bound] = ("ref", source, alias.name)
+                elif isinstance(node, ast.Assign):
+                    if any(isinstance(target, ast.Name) and target.id == "__all__" for target in node.targets):
+                        names = _string_list(node.value, names)
+                        continue
+                    value = _alias_of(node.value, name)
+                    for target in node.targets:
+                        bind_target(target, value)
+                elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name) and node.target.id == "__all__":
+                    names = (names or []) + (_string_list(node.value, []) or [])
+                elif isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+                    bind_target(node.target, ("constant",))
+                elif (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+                      and isinstance(node.value.func, ast.Attribute) and node.value.func.attr == "extend"
+                      and isinstance(node.value.func.value, ast.Name) and node.value.func.value.id == "__all__"):
+                    names = (names or []) + (_string_list(node.value.args[0], []) or [])
+                elif isinstance(node, ast.If):
+                    visit(node.body)
+                    visit(node.orelse)
+                elif isinstance(node, ast.Try):
+                    visit(node.body)
+                    for handler in node.handlers:
+                        visit(handler.body)
+                    visit(node.orelse)
+                    visit(node.finalbody)
+                elif isinstance(node, ast.With):
+                    visit(node.body)
+
+        visit(tree.body)
+        return bindings, names
+
+    def resolve(self, binding: Binding, seen: int = 0) -> Binding:
+        """Follow re-exports and aliases to the defining class, function or module"""
+        while binding[0] == "ref" and seen < 50:
+            module, name = binding[1], binding[2]
+            bindings = self.module(module)[0]
+            if name in bindings:
+                binding = bindings[name]
+            elif self.source.path_of(f"{module}.{name}"):
+                binding = ("module", f"{module}.{name}")
+            else:
+                binding = ("constant",)
+            seen += 1
+        return binding
+
+    def resolve_expr(self, node: ast.expr, module: str) -> Optional[Binding]:
+        """Resolve a base class expression such as `VMobject` or `mobject.Mobject` in a module"""
+        if isinstance(node, ast.Subscript):
+            node = node.value
+        if isinstance(node, ast.Name):
+            binding = self.module(module)[0].get(node.id)
+            return self.resolve(binding) if binding else None
+        if isinstance(node, ast.Attribute):
+            owner = self.resolve_expr(node.value, module)
+            if owner and owner[0] == "module":
+                return self.resolve(("ref", owner[1], node.attr))
+        return None
+
+    def bases(self, node: ast.ClassDef, module: str) -> List[Optional[Binding]]:
+        """Resolved base classes; None for bases outside manim (Generic and object are left out)"""
+        resolved = []
+        for base in node.bases:
+            name = base.value if isinstance(base, ast.Subscript) else base
+            if isinstance(name, ast.Name) and name.id in ("object", "Generic"):
+                continue
+            binding = self.resolve_expr(base, module)
+            resolved.append(binding if binding and binding[0] == "class" else None)
+        return resolved
+
+    def class_keywords(self, node: ast.ClassDef, module: str) -> Optional[Set[str]]:
+        """
+        Keyword arguments a class's constructor accepts, or None if any might be
+
+        A constructor passing **kwargs only on to super().__init__ accepts its own parameters and
+        those of its bases; **kwargs used in any other way, decorators and bases outside manim
+        make the class accept anything.
+        """
+        key = (module, node.name)
+        if key in self._keywords:
+            return self._keywords[key]
+        # Guards against inheritance cycles while this class is being resolved
+        self._keywords[key] = None
+        self._keywords[key] = result = self._class_keywords(node, module)
+        return result
+
+    def _class_keywords(self, node: ast.ClassDef, module: str) -> Optional[Set[str]]:
+        if node.decorator_list:
+            return None
+        methods = {
+            item.name: item for item in node.body
+            if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)) and not _is_overload(item)
+        }
+        if any(isinstance(item, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "__init__" for t in item.targets)
+               for item in node.body):
+            return None
+        init = methods.get("__init__")
+        if init is None:
+            if "__new__" in methods:
+                return None
+            return self._inherited(node, module)
+        if init.decorator_list:
+            return None
+        params = _keyword_params(init.args)[1:] if init.args.args else _keyword_params(init.args)
+        keywords = set(params)
+        if init.args.kwarg is None:
+            return keywords
+        if not _forwards_to_super(init, init.args.kwarg.arg):
+            return None
+        inherited = self._inherited(node, module)
+        return None if inherited is None else keywords | inherited
+
+    def _inherited(self, node: ast.ClassDef, module: str) -> Optional[Set[str]]:
+        keywords: Set[str] = set()
+        for base in self.bases(node, module):
+            if base is None:
+                return None
+            accepted = self.class_keywords(base[1], base[2])
+            if accepted is None:
+                return None
+            keywords |= accepted
+        return keywords
+
+    def is_subclass(self, node: ast.ClassDef, module: str, target: Tuple[str, str], depth: int = 0) -> bool:
+        if (module, node.name) == target:
+            return True
+        if depth > 30:
+            return False
+        return any(
+            base is not None and self.is_subclass(base[1], base[2], target, depth + 1)
+            for base in self.bases(node, module)
+        )
+
+
+def _string_list(node: ast.expr, current: Optional[List[str]]) -> Optional[List[str]]:
+    """Evaluate an `__all__` value: a list or tuple of strings, possibly concatenated"""
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [element.value for element in node.elts if isinstance(element, ast.Constant) and isinstance(element.value, str)]
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _string_list(node.left, current), _string_list(node.right, current)
+        if left is not None and right is not None:
+            return left + right
+    return current
+
+
+def _alias_of(node: ast.expr, module: str) -> Binding:
+    """A module-level `Alias = Name` re-binds what Name is; anything else is a constant"""
+    if isinstance(node, ast.Name):
+        return ("ref", module, node.id)
+    return ("constant",)
+
+
+def _is_overload(node: ast.AST) -> bool:
+    return any(
+        (isinstance(d, ast.Name) and d.id == "overload") or (isinstance(d, ast.Attribute) and d.attr == "overload")
+        for d in node.decorator_list
+    )
+
+
+def _keyword_params(args: ast.arguments) -> List[str]:
+    """Parameters that can be passed by keyword (positional-only ones cannot)"""
+    return [arg.arg for arg in args.args] + [arg.arg for arg in args.kwonlyargs]
+
+
+def _forwards_to_super(init: ast.FunctionDef, kwargs_name: str) -> bool:
+    """Whether **kwargs is only ever passed on whole, to super().__init__ or Base.__init__"""
+    forwarded = {
+        id(keyword.value)
+        for call in ast.walk(init)
+        if isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == "__init__"
+        for keyword in call.keywords if keyword.arg is None
+    }
+    uses = [node for node in ast.walk(init) if isinstance(node, ast.Name) and node.id == kwargs_name]
+    return bool(uses) and all(id(node) in forwarded for node in uses)
+
+
+def build_symbol_index(path: str) -> Dict:
+    """
+    Build the symbol index from a manim wheel or source tree
+
+    Returns:
+        dict: version; exports (name -> "class", "function", "module" or "constant"); keywords
+              (name -> accepted keyword arguments, for classes and functions whose keywords are known);
+              scenes (exported Scene classes)
+    """
+    source = ManimSource(path)
+    resolver = SymbolResolver(source)
+    bindings = resolver.module("manim")[0]
+    # Subpackages imported while manim loads are attributes of the package, so the star import provides them too
+    for file in source.files:
+        parts = file.split("/")
+        if len(parts) > 2 and not parts[1].startswith("_"):
+            bindings.setdefault(parts[1], ("module", f"manim.{parts[1]}"))
+
+    scene_binding = resolver.resolve(("ref", "manim.scene.scene", "Scene"))
+    scene = (scene_binding[2], scene_binding[1].name)
+    exports, keywords, scenes = {}, {}, []
+    for name, binding in sorted(bindings.items()):
+        if name.startswith("_"):
+            continue
+        binding = resolver.resolve(binding)
+        kind = binding[0]
+        exports[name] = kind
+        accepted = None
+        if kind == "class":
+            accepted = resolver.class_keywords(binding[1], binding[2])
+            if resolver.is_subclass(binding[1], binding[2], scene):
+                scenes.append(name)
+        elif kind == "function":
+            node = binding[1]
+            if node.args.kwarg is None and not node.decorator_list:
+                accepted = set(_keyword_params(node.args))
+        if accepted is not None:
+            keywords[name] = sorted(accepted)
+    return {"version": source.version, "exports": exports, "keywords": keywords, "scenes": scenes}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build the manim symbol index used by the pre-render check")
+    parser.add_argument("source", help="manim wheel, or a directory containing the manim package")
+    parser.add_argument("-o", "--output", default=os.path.join(RESOURCES_DIR, INDEX_FILE))
+    args = parser.parse_args()
+    index = build_symbol_index(args.source)
+    with open(args.output, "w") as f:
+        json.dump(index, f, indent=0, sort_keys=True)
+        f.write("\n")
+    print(f"manim {index['version']}: {len(index['exports'])} names, {len(index['keywords'])} signatures, "
+          f"{len(index['scenes'])} scenes -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
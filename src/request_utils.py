@@ -0,0 +1,49 @@
+"""
+Request parsing shared by the Flask (WSGI) and ASGI servers
+"""
+import logging
+from typing import Dict, Optional, Tuple, Union
+
+from src.pipeline import run_video_generation, run_video_improvement
+
+logger = logging.getLogger('image-to-manim')
+
+
+def configure_logging() -> None:
+    """Log to the console and to app.log"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler('app.log')
+        ]
+    )
+
+
+def flag_enabled(value: Union[str, bool, None]) -> bool:
+    """Interpret a boolean request flag sent as JSON or as a form/query string value"""
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ['1', 'true', 'yes']
+
+
+def parse_video_request(data: Optional[Dict]) -> Tuple[Optional[str], str]:
+    """Extract the session id and a validated video quality from a request body"""
+    if not data or 'session_id' not in data:
+        return None, 'medium'
+    
+    # Optional video quality parameter with default value
+    video_quality = data.get('video_quality', 'medium')
+    if video_quality not in ['low', 'medium', 'high']:
+        logger.warning(f"Invalid video quality '{video_quality}' requested, defaulting to 'medium'")
+        video_quality = 'medium'  # Default to medium if invalid quality is provided
+    
+    return data['session_id'], video_quality
+
+
+# Stage functions that can run as background jobs, keyed by job type
+JOB_STAGES = {
+    "generate-video": run_video_generation,
+    "improve-video": run_video_improvement,
+}
@@ -0,0 +1,116 @@
+"""
+Coalescing of identical concurrent calls onto a single execution
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time.
+
+    The first caller for a key executes the function; callers arriving while it is in flight
+    wait on the same future and receive the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._executions = 0
+        self._coalesced = 0
+
+    def do(self, key: str, func: Callable[[], Any]) -> Any:
+        """
+        Execute func for the key, or join the execution already in flight
+
+        Args:
+            key: Identity of the work, e.g. a content hash of its input
+            func: Function to run if no call for the key is in flight
+
+        Returns:
+            The result of the shared execution
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self._executions += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+        return future.result()
+
+    def stats(self) -> Dict[str, int]:
+        """Return how many calls executed and how many joined an in-flight call"""
+        with self._lock:
+            return {
+                "executions": self._executions,
+                "coalesced": self._coalesced,
+                "in_flight": len(self._in_flight),
+            }
+
+
+class AsyncSingleFlight:
+    """
+    Event-loop counterpart of SingleFlight: callers of a key already in flight await the first
+    caller's result instead of starting another execution.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._executions = 0
+        self._coalesced = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await func for the key, or join the execution already in flight
+
+        Args:
+            key: Identity of the work, e.g. a content hash of its input
+            func: Coroutine function to run if no call for the key is in flight
+
+        Returns:
+            The result of the shared execution
+        """
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._coalesced += 1
+            # Shield so one cancelled follower does not cancel the shared execution
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self._executions += 1
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody joined the call
+            future.exception()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Return how many calls executed and how many joined an in-flight call"""
+        return {
+            "executions": self._executions,
+            "coalesced": self._coalesced,
+            "in_flight": len(self._in_flight),
+        }
@@ -1,17 +1,171 @@
 """
-Functions for handling storage operations with Supabase
+Functions for handling storage operations on session artifacts (images, scripts, code and videos)
+
+Artifacts go to the backend selected by STORAGE_BACKEND: the Supabase storage bucket, or a
+local directory whose files are served by the app under /files and read back through mmap.
 """
-from src.config import supabase
+import asyncio
+import logging
+import mmap
+import os
+import threading
+from typing import Optional, Union
+
+from src.clients import get_async_supabase, get_supabase
+from src.config import STORAGE_BACKEND, STORAGE_LOCAL_ROOT, STORAGE_PUBLIC_URL
+from src.metrics import count_storage_bytes
+from src.tracing import span
+
+logger = logging.getLogger('image-to-manim')
+
+# Supabase storage bucket holding every session's artifacts
+SUPABASE_BUCKET = "manim-generator"
+
+Content = Union[bytes, bytearray, memoryview]
+
+
+class StorageBackend:
+    """Interface for artifact stores: objects are addressed by paths like "<session_id>/script.txt" """
+
+    # Whether the Modal renderer can upload videos itself; otherwise it returns the bytes to the caller
+    remote_writable = False
+
+    def upload(self, path: str, content: Content, content_type: Optional[str] = None) -> None:
+        raise NotImplementedError
+
+    async def aupload(self, path: str, content: Content, content_type: Optional[str] = None) -> None:
+        await asyncio.to_thread(self.upload, path, content, content_type)
+
+    def public_url(self, path: str) -> str:
+        raise NotImplementedError
+
+    def read_url(self, url: str) -> Optional[memoryview]:
+        """Return the object behind a public URL if it can be read without a network hop, else None"""
+        return None
+
+
+class SupabaseStorage(StorageBackend):
+    """Objects in the Supabase storage bucket, read back through their public URLs"""
+
+    remote_writable = True
+
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+
+    @staticmethod
+    def _file_options(content_type: Optional[str]) -> dict:
+        file_options = {    "cacheControl": '3600',    "upsert": "true"  }
+        if content_type:
+            file_options["content-type"] = content_type
+        return file_options
+
+    def upload(self, path: str, content: Content, content_type: Optional[str] = None) -> None:
+        get_supabase().storage.from_(self.bucket).upload(
+            path,
+            bytes(content),
+            self._file_options(content_type)
+        )
+
+    async def aupload(self, path: str, content: Content, content_type: Optional[str] = None) -> None:
+        client = await get_async_supabase()
+        await client.storage.from_(self.bucket).upload(
+            path,
+            bytes(content),
+            self._file_options(content_type)
+        )
+
+    def public_url(self, path: str) -> str:
+        return get_supabase().storage.from_(self.bucket).get_public_url(path)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Objects as files under a root directory, for on-box deployments and benchmarks.
+
+    Writes go to a temporary file that is renamed into place, so readers never see a partial
+    object. Reads map the file into memory instead of copying it; public URLs point at the
+    app's /files route, which serves the same files.
+    """
+
+    def __init__(self, root: str, base_url: str):
+        self.root = os.path.realpath(root)
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def local_path(self, path: str) -> str:
+        """Resolve an object path to its file, refusing paths that escape the root"""
+        full_path = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, full_path]) != self.root or full_path == self.root:
+            raise ValueError(f"Invalid storage path: {path}")
+        return full_path
+
+    def upload(self, path: str, content: Content, content_type: Optional[str] = None) -> None:
+        full_path = self.local_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        tmp_path = f"{full_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, full_path)
+
+    def public_url(self, path: str) -> str:
+        return f"{self.base_url}/{path}"
+
+    def read(self, path: str) -> memoryview:
+        """Map an object into memory; the view stays valid after the file is replaced"""
+        with open(self.local_path(path), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def read_url(self, url: str) -> Optional[memoryview]:
+        prefix = f"{self.base_url}/"
+        if not url or not url.startswith(prefix):
+            return None
+        try:
+            return self.read(url[len(prefix):].split("?", 1)[0])
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+def create_backend(kind: str) -> StorageBackend:
+    """Build the storage backend selected by STORAGE_BACKEND ("supabase" or "local")"""
+    if kind == "local":
+        return LocalStorage(STORAGE_LOCAL_ROOT, STORAGE_PUBLIC_URL)
+    if kind != "supabase":
+        logger.warning(f"Unknown STORAGE_BACKEND '{kind}', using Supabase storage")
+    return SupabaseStorage(SUPABASE_BUCKET)
+
+
+storage_backend = create_backend(STORAGE_BACKEND)
+
+def upload_to_storage(path, content, content_type=None):
+    """Upload bytes to storage, overwriting any existing object at the path"""
+    with span("storage.upload", path=path, bytes=len(content), backend=type(storage_backend).__name__):
+        storage_backend.upload(path, content, content_type)
+    count_storage_bytes("out", len(content))
+
+def get_public_url(path):
+    """Return the public URL of an object in storage"""
+    return storage_backend.public_url(path)
+
+def read_from_url(url):
+    """Read an artifact directly from the storage backend, or return None if it must be fetched over HTTP"""
+    content = storage_backend.read_url(url)
+    if content is not None:
+        count_storage_bytes("in", len(content))
+    return content
 
 def update_code_in_storage(code_path, code_content):
-    """Helper function to update code in Supabase storage with error handling"""
-    
+    """Helper function to update code in storage with error handling"""
+
     try:
-        supabase.storage.from_("manim-generator").upload(
-            code_path,
-            code_content.encode('utf-8'),
-            {    "cacheControl": '3600',    "upsert": "true"  }
-        )
+        upload_to_storage(code_path, code_content.encode('utf-8'))
         print(f"Uploaded new code to: {code_path}")
     except Exception as upload_error:
         print(f"Error uploading new code file: {str(upload_error)}")
+
+async def async_upload_to_storage(path, content, content_type=None):
+    """Async counterpart of upload_to_storage"""
+    with span("storage.upload", path=path, bytes=len(content), backend=type(storage_backend).__name__):
+        await storage_backend.aupload(path, content, content_type)
+    count_storage_bytes("out", len(content))
@@ -0,0 +1,224 @@
+"""
+Trace spans for requests, pipeline stages and outbound calls
+
+The current span lives in a context variable, so spans opened in a request, a job or an LLM
+call nest under whatever span was active when the work started. Context crosses process
+boundaries as a W3C traceparent string: it is read from incoming requests and passed to the
+Modal renderer, whose spans are sent back with its result. Finished spans are exported in the
+Zipkin v2 JSON format, to a file or to a collector (Zipkin, Jaeger or an OpenTelemetry collector
+with the Zipkin receiver).
+"""
+import atexit
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.config import (
+    TRACE_COLLECTOR_URL,
+    TRACE_EXPORTER,
+    TRACE_FILE,
+    TRACE_FLUSH_INTERVAL_SECONDS,
+    TRACE_SERVICE_NAME,
+)
+
+logger = logging.getLogger('image-to-manim')
+
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# Spans exported per write, so one slow collector call cannot hold an unbounded batch
+EXPORT_BATCH = 500
+
+
+class Span:
+    """
+    One timed operation in a trace; used as a context manager that makes it the current span
+
+    An exception leaving the block is recorded on the span and re-raised.
+    """
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start: Optional[float] = None
+        self._token = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.start = time.time()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        duration = time.time() - self.start
+        if exc_type is not None:
+            self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Closed from another context (e.g. a request torn down on another thread)
+            pass
+        span_exporter.export(self.to_zipkin(duration))
+        return False
+
+    def traceparent(self) -> str:
+        """Return the W3C traceparent identifying this span, for calls into other processes"""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_zipkin(self, duration: float) -> Dict[str, Any]:
+        record = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.start * 1_000_000),
+            "duration": max(1, int(duration * 1_000_000)),
+            "localEndpoint": {"serviceName": TRACE_SERVICE_NAME},
+            "tags": {key: str(value) for key, value in self.attributes.items() if value is not None},
+        }
+        if self.parent_id:
+            record["parentId"] = self.parent_id
+        return record
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Return (trace_id, parent_span_id) from a W3C traceparent header, or None if it is missing or malformed"""
+    match = _TRACEPARENT.match((header or "").strip().lower())
+    return (match.group(1), match.group(2)) if match else None
+
+
+def span(name: str, traceparent: Optional[str] = None, **attributes: Any) -> Span:
+    """
+    Create a span to be entered with `with`
+
+    Args:
+        name: Operation name, e.g. "llm.completion"
+        traceparent: Remote parent, e.g. an incoming request's header; defaults to the current span
+        **attributes: Tags recorded on the span
+
+    Returns:
+        Span: Child of the remote parent or current span, or the root of a new trace
+    """
+    remote = parse_traceparent(traceparent)
+    if remote:
+        trace_id, parent_id = remote
+    else:
+        parent = _current_span.get()
+        if parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+    return Span(name, trace_id, parent_id, attributes)
+
+
+def current_span() -> Optional[Span]:
+    """Return the innermost open span of the caller, if any"""
+    return _current_span.get()
+
+
+def current_traceparent() -> Optional[str]:
+    """Return the traceparent of the current span, to propagate it to another process"""
+    current = _current_span.get()
+    return current.traceparent() if current is not None else None
+
+
+def export_remote_spans(spans: Optional[List[Dict[str, Any]]]) -> None:
+    """Export spans recorded by another process (the Modal renderer) with this trace"""
+    for record in spans or []:
+        span_exporter.export(record)
+
+
+class SpanExporter:
+    """
+    Buffers finished spans and writes them in batches from a background thread
+
+    Tracing must never slow down or fail a request: export errors are logged and the batch
+    is dropped.
+    """
+
+    def __init__(self, kind: str, path: str, url: str, flush_interval: float):
+        self.kind = kind
+        self.path = path
+        self.url = url
+        self.flush_interval = flush_interval
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._lock = threading.Condition()
+        self._buffer: List[Dict[str, Any]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _after_fork(self) -> None:
+        self._init_state()
+
+    def export(self, record: Dict[str, Any]) -> None:
+        if self.kind == "none":
+            return
+        with self._lock:
+            self._buffer.append(record)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._flush_loop, name="span-exporter", daemon=True)
+                self._thread.start()
+            if len(self._buffer) >= EXPORT_BATCH:
+                self._lock.notify()
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._lock:
+                if not self._closed and len(self._buffer) < EXPORT_BATCH:
+                    self._lock.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self) -> None:
+        """Write every buffered span"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        for start in range(0, len(batch), EXPORT_BATCH):
+            try:
+                self._write(batch[start:start + EXPORT_BATCH])
+            except Exception as e:
+                logger.warning(f"Failed to export {len(batch[start:start + EXPORT_BATCH])} spans: {str(e)}")
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        if self.kind == "file":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in batch))
+        else:
+            from src.clients import http_session
+            http_session().post(self.url, json=batch).raise_for_status()
+
+    def close(self) -> None:
+        """Stop the background thread and write what is left; called when the process exits"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self.flush()
+
+
+def create_exporter(kind: str) -> SpanExporter:
+    """Build the span exporter selected by TRACE_EXPORTER ("none", "file" or "zipkin")"""
+    if kind not in ("none", "file", "zipkin"):
+        logger.warning(f"Unknown TRACE_EXPORTER '{kind}', traces are not exported")
+        kind = "none"
+    return SpanExporter(kind, TRACE_FILE, TRACE_COLLECTOR_URL, TRACE_FLUSH_INTERVAL_SECONDS)
+
+
+span_exporter = create_exporter(TRACE_EXPORTER)
+os.register_at_fork(after_in_child=span_exporter._after_fork)
+atexit.register(span_exporter.close)
@@ -0,0 +1,211 @@
+"""
+Per-session accounting of LLM usage: tokens, latency and cost of every call, totalled by stage
+and stored on the session's manim_projects row
+"""
+import functools
+import inspect
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from src.clients import get_supabase, llm
+from src.config import LLM_PRICES, USAGE_MAX_SESSIONS
+from src.journal import PROJECTS_TABLE, status_journal
+from src.metrics import current_stage, observe_llm_call
+
+logger = logging.getLogger('image-to-manim')
+
+# Session the running code is working for; LLM calls made inside are charged to it
+_current_session: ContextVar[Optional[str]] = ContextVar("current_session", default=None)
+
+
+def parse_prices(spec: str) -> Dict[str, Tuple[float, float]]:
+    """
+    Parse a "model=prompt:completion,..." string of USD prices per million tokens
+
+    Returns:
+        dict: (prompt, completion) price per token for every listed model
+    """
+    prices = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, pair = item.rpartition("=")
+        prompt_price, _, completion_price = pair.partition(":")
+        prices[model.strip()] = (float(prompt_price) / 1_000_000, float(completion_price or 0) / 1_000_000)
+    return prices
+
+
+llm_prices = parse_prices(LLM_PRICES)
+# Models litellm has no price for; looked up once so unknown models do not repeat the lookup on every call
+_unpriced_models = set()
+
+
+def call_cost(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """Return the USD cost of a call, or None when the model's price is unknown"""
+    if model in llm_prices:
+        prompt_price, completion_price = llm_prices[model]
+        return prompt_tokens * prompt_price + completion_tokens * completion_price
+    if model in _unpriced_models:
+        return None
+    try:
+        prompt_cost, completion_cost = llm().cost_per_token(
+            model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+        )
+        return prompt_cost + completion_cost
+    except Exception:
+        logger.warning(f"No price known for model {model}; add it to LLM_PRICES to account for its cost")
+        _unpriced_models.add(model)
+        return None
+
+
+@contextmanager
+def usage_session(session_id: Optional[str]) -> Iterator[None]:
+    """Charge the LLM calls made inside the block to session_id"""
+    token = _current_session.set(session_id)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+
+
+def tracks_usage(func: Callable) -> Callable:
+    """Decorate a pipeline function so LLM calls made while it runs are charged to its session_id argument"""
+    signature = inspect.signature(func)
+
+    def session_of(args, kwargs) -> Optional[str]:
+        return signature.bind_partial(*args, **kwargs).arguments.get("session_id")
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with usage_session(session_of(args, kwargs)):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with usage_session(session_of(args, kwargs)):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "cost_usd": 0.0, "models": []}
+
+
+class UsageLedger:
+    """
+    Running LLM usage totals per session and stage.
+
+    Every call updates the session's totals in memory and records them on the project row
+    through the status journal, so the row always holds the complete totals and the writes are
+    coalesced with the session's other updates. Sessions continued by another process are
+    seeded from their row when the pipeline fetches it. Memo hits and calls coalesced onto
+    another session's identical request cost nothing and are not counted.
+    """
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, Dict[str, Dict[str, Any]]]" = OrderedDict()
+
+    def seed(self, session_id: str, stored: Optional[Dict[str, Any]]) -> None:
+        """Start from the totals stored on the project row, unless this process already tracks the session"""
+        with self._lock:
+            if session_id in self._sessions or not stored:
+                return
+            self._sessions[session_id] = {
+                stage: dict(totals, models=list(totals.get("models", []))) for stage, totals in stored.get("stages", {}).items()
+            }
+            self._evict()
+
+    def record(self, session_id: str, stage: str, model: str, seconds: float,
+               prompt_tokens: int, completion_tokens: int, cost: Optional[float]) -> None:
+        """Add one call to the session's totals and journal the new totals on its row"""
+        with self._lock:
+            stages = self._sessions.pop(session_id, {})
+            self._sessions[session_id] = stages
+            self._evict()
+            totals = stages.setdefault(stage, _empty_totals())
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["seconds"] = round(totals["seconds"] + seconds, 3)
+            if cost is not None:
+                totals["cost_usd"] = round(totals["cost_usd"] + cost, 6)
+            if model not in totals["models"]:
+                totals["models"].append(model)
+            fields = self._fields(stages)
+        status_journal.update(session_id, fields)
+
+    def fields(self, session_id: str) -> Dict[str, Any]:
+        """Return the usage columns of a session's row, or {} when nothing was recorded"""
+        with self._lock:
+            stages = self._sessions.get(session_id)
+            return self._fields(stages) if stages else {}
+
+    def _evict(self) -> None:
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    @staticmethod
+    def _fields(stages: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        total = _empty_totals()
+        del total["models"]
+        for totals in stages.values():
+            for key in total:
+                total[key] += totals[key]
+        total["seconds"] = round(total["seconds"], 3)
+        total["cost_usd"] = round(total["cost_usd"], 6)
+        return {
+            "llm_usage": {"stages": {stage: dict(totals, models=list(totals["models"])) for stage, totals in stages.items()}, "total": total},
+            "llm_tokens": total["prompt_tokens"] + total["completion_tokens"],
+            "llm_cost_usd": total["cost_usd"],
+        }
+
+
+def record_llm_call(model: str, seconds: float, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> Optional[float]:
+    """
+    Account for one finished LLM call in the metrics and, inside a session, in its usage totals
+
+    Args:
+        model: Model that served the call
+        seconds: Latency of the call
+        prompt_tokens: Tokens sent, None if the provider did not report usage
+        completion_tokens: Tokens generated, None if the provider did not report usage
+
+    Returns:
+        float: USD cost of the call, or None when the model's price is unknown
+    """
+    prompt_tokens, completion_tokens = prompt_tokens or 0, completion_tokens or 0
+    cost = call_cost(model, prompt_tokens, completion_tokens)
+    observe_llm_call(model, seconds, prompt_tokens, completion_tokens, cost)
+    session_id = _current_session.get()
+    if session_id:
+        usage_ledger.record(session_id, current_stage(), model, seconds, prompt_tokens, completion_tokens, cost)
+    return cost
+
+
+def load_usage(session_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the LLM usage of a session
+
+    Args:
+        session_id: Project whose usage to return
+
+    Returns:
+        dict: Per-stage and total usage ({} if no call was recorded), or None if the project does not exist
+    """
+    fields = usage_ledger.fields(session_id)
+    if fields:
+        return fields["llm_usage"]
+    response = get_supabase().table(PROJECTS_TABLE).select("id, llm_usage").eq("id", session_id).execute()
+    row = status_journal.overlay(session_id, response.data[0] if response.data else None)
+    if row is None:
+        return None
+    return row.get("llm_usage") or {}
+
+
+usage_ledger = UsageLedger(USAGE_MAX_SESSIONS)